@@ -0,0 +1,350 @@
+import asyncio
+import selectors
+from ChatServer import *
+
+# uvloop is an optional, faster drop-in replacement for asyncio's event loop. It is used when it is installed
+# unless the server's options ask for the standard event loop.
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+##############################################################################################################
+
+class AsyncConnection(asyncio.Protocol):
+    """ AsyncConnection is the asyncio protocol object for a single connection. It plays the same role as the
+    SelectorKey (io_device) objects that CRCServer's message handlers receive: io_device.fileobj is the
+    connection's transport and io_device.data is the connection's BaseConnectionData object. This allows
+    AsyncCRCServer to reuse CRCServer's message handlers without any changes.
+    """
+    def __init__(self, server, data=None):
+        self.server = server
+        self.fileobj = None                             # The transport once the connection has been made
+        self.data = data if data else BaseConnectionData()
+        self.writing_paused = False                     # True while the transport's write buffer is full
+        self.flush_scheduled = False                    # True while a call to flush() is waiting to run
+        self.backlogged = False                         # True while messages over the budget are waiting
+        self.serve_scheduled = False                    # True while a call to serve() is waiting to run
+
+    def connection_made(self, transport):
+        self.fileobj = transport
+        self.data.sock = transport
+        self.server.sel.register(transport, self.server.io_device_events(self.data), self)
+        self.server.watch_connection(self.data)
+        self.server.print_info(f"Accepted new connection from {transport.get_extra_info('peername')}")
+
+    def data_received(self, data):
+        self.server.handle_received_data(self, data)
+
+    def connection_lost(self, exc):
+        self.server.handle_connection_lost(self)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        """ Arranges for the write buffer to be flushed once the current batch of callbacks has finished
+        running. Deferring the flush lets every message queued while handling a single read be handed to the
+        transport in one call.
+        """
+        if not self.flush_scheduled and self.fileobj is not None:
+            self.flush_scheduled = True
+            self.server.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        write_buffer = self.data.write_buffer
+        if self.writing_paused or not write_buffer or self.fileobj.is_closing():
+            return
+        self.server.compress_write_buffer(self.data)
+        if write_buffer.offset:
+            write_buffer.messages[0] = memoryview(write_buffer.messages[0])[write_buffer.offset:]
+        cork = self.server.tcp_cork and isinstance(self.data, ServerConnectionData)
+        if cork:
+            self.server.set_cork(self.server.link_socket(self.data), True)
+        self.fileobj.writelines(write_buffer.messages)
+        if cork:
+            self.server.set_cork(self.server.link_socket(self.data), False)
+        self.data.bytes_sent += write_buffer.pending_bytes
+        self.data.writes += 1
+        write_buffer.messages.clear()
+        write_buffer.offset = 0
+        write_buffer.pending_bytes = 0
+        if self.data.congested:
+            self.server.relieve_backpressure(self.data)
+
+    def schedule_serve(self):
+        """ Arranges for more of the messages waiting in the read buffer to be handled once every callback 
+        that is already waiting has run, which gives every other connection its turn first.
+        """
+        if not self.serve_scheduled:
+            self.serve_scheduled = True
+            self.server.loop.call_soon(self.serve)
+
+    def serve(self):
+        self.serve_scheduled = False
+        if not self.fileobj.is_closing() and not self.data.paused_by:
+            self.server.serve_connection(self)
+
+    def set_reading(self, reading):
+        """ Pauses or resumes reading from the transport. Reading is paused by the server's backpressure policy
+        while a connection this one feeds messages to is congested, and while messages received from this
+        connection are waiting for their turn to be handled.
+        """
+        if self.fileobj is not None and not self.fileobj.is_closing():
+            if reading and self.backlogged:
+                self.schedule_serve()
+                reading = False
+            if reading:
+                self.fileobj.resume_reading()
+            else:
+                self.fileobj.pause_reading()
+
+
+class AsyncConnectionRegistry():
+    """ AsyncConnectionRegistry stands in for the selector used by CRCServer. CRCServer's message handlers
+    look up and modify the data associated with a socket through the selector's get_key() and modify()
+    methods. This class provides those same methods for transports, treats a request for WRITE events as a 
+    request to flush the connection's write buffer to its transport, and pauses reading from the transport 
+    when READ events are not requested.
+    """
+    def __init__(self):
+        self.connections = {}
+
+    def register(self, transport, events, connection):
+        self.connections[transport] = connection
+        self.modify(transport, events, connection.data)
+
+    def unregister(self, transport):
+        return self.connections.pop(transport, None)
+
+    def get_key(self, transport):
+        return self.connections[transport]
+
+    def get_map(self):
+        return self.connections
+
+    def modify(self, transport, events, data):
+        connection = self.connections[transport]
+        connection.data = data
+        connection.set_reading(events & selectors.EVENT_READ)
+        if events & selectors.EVENT_WRITE:
+            connection.schedule_flush()
+
+    def close(self):
+        self.connections.clear()
+
+##############################################################################################################
+
+class AsyncCRCServer(CRCServer):
+    """ AsyncCRCServer is an alternative engine for CRCServer built on asyncio protocols instead of a
+    selectors loop. All routing logic (the message handlers, hosts_db, and the adjacent server and client
+    lists) is inherited from CRCServer unchanged. Only the way bytes are read from and written to sockets is
+    different. If uvloop is installed it is used as the event loop unless options.use_uvloop is False.
+    """
+    def __init__(self, options, run_on_localhost=False):
+        super(AsyncCRCServer, self).__init__(options, run_on_localhost)
+        self.sel.close()
+        self.sel = AsyncConnectionRegistry()
+        self.edge_triggered = False                     # The event loop chooses how to wait for sockets
+        self.loop = None
+        self.listener = None
+        self.terminate_event = None                     # Set when the server is asked to terminate
+        self.timer_handle = None                        # The event loop callback that runs self.timers
+        self.timer_deadline = None                      # When that callback is due, in the event loop's time
+        self.use_uvloop = getattr(options, "use_uvloop", True) and uvloop is not None
+
+    def run(self):
+        """ This method is called to start the server. It creates the event loop and runs the server until
+        self.request_terminate is set.
+
+        Args:
+            None
+        Returns:
+            None
+        """
+        self.print_info("Launching server %s..." % self.server_name)
+        loop = uvloop.new_event_loop() if self.use_uvloop else asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.serve())
+        finally:
+            loop.close()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.terminate_event = asyncio.Event()
+        self.loop = loop
+        await self.setup_server_socket_async()
+
+        if self.connect_to_host and self.connect_to_port:
+            await self.connect_to_server_async()
+
+        self.print_info("Listening for new connections on port " + str(self.port))
+        self.start_stats_server()
+        self.start_timers()
+        try:
+            # request_terminate is set from another thread by the testing application, which wakes us up
+            if not self.request_terminate:
+                await self.terminate_event.wait()
+        finally:
+            self.cleanup()
+
+    def wake_up(self):
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.terminate_event.set)
+            except RuntimeError:
+                pass            # The event loop has already been closed
+
+    def schedule_timer(self, delay, callback, *args):
+        timer = super(AsyncCRCServer, self).schedule_timer(delay, callback, *args)
+        self.arm_timers()
+        return timer
+
+    def arm_timers(self):
+        """ Makes sure the event loop runs the timer wheel by the time its next timer is due """
+        if self.loop is None:
+            return
+        delay = self.timers.time_until_next()
+        if delay is None:
+            return
+        deadline = self.loop.time() + delay
+        if self.timer_handle is not None:
+            if self.timer_deadline <= deadline:
+                return
+            self.timer_handle.cancel()
+        self.timer_deadline = deadline
+        self.timer_handle = self.loop.call_at(deadline, self.run_timers)
+
+    def run_timers(self):
+        self.timer_handle = None
+        self.run_periodic_tasks()
+        self.disconnect_pending_connections()
+        self.arm_timers()
+
+    async def setup_server_socket_async(self):
+        """ Creates the listening server. Every accepted connection is handled by a new AsyncConnection. """
+        self.print_info("Configuring the server socket...")
+        self.listener = await self.loop.create_server(lambda: AsyncConnection(self), '', self.port, backlog=100)
+        self.print_info(f"Server socket configured and listening on port {self.port}")
+
+    async def connect_to_server_async(self):
+        """ Connects to the remote CRC server this server registers with on startup, and to any peers """
+        await self.connect_to_upstream_async()
+        for peer_port in self.peer_ports:
+            await self.connect_to_peer_async(peer_port)
+
+    async def connect_to_upstream_async(self, attempt=0):
+        """ Connects to the remote CRC server this server registers with on startup. The registration message
+        is queued before the connection is made and is flushed as soon as the connection is established.
+        """
+        self.print_info("Connecting to remote server %s:%i..." % (self.connect_to_host, self.connect_to_port))
+        data = ServerConnectionData(self.id, self.server_name, self.server_info)
+        data.write_buffer.append(self.server_startup_messages())
+        self.upstream_connection = data
+        try:
+            await self.loop.create_connection(lambda: AsyncConnection(self, data),
+                                              self.connect_to_host_addr, self.connect_to_port)
+            self.print_info("Server registration message queued for sending.")
+        except OSError as e:
+            self.print_info(f"Failed to connect to remote server: {e}")
+            self.retry_connection(attempt, self.connect_to_upstream)
+
+    async def connect_to_peer_async(self, port, attempt=0):
+        """ Opens an extra link to another server in the network. See CRCServer.connect_to_peer(). """
+        self.print_info("Connecting to peer server %s:%i..." % (self.connect_to_host_addr, port))
+        data = ServerConnectionData(self.id, self.server_name, self.server_info)
+        data.write_buffer.append(self.link_options_message() 
+                                 + ServerRegistrationMessage.bytes(self.id, 0, self.server_name, self.server_info))
+        try:
+            await self.loop.create_connection(lambda: AsyncConnection(self, data), self.connect_to_host_addr, port)
+        except OSError as e:
+            self.print_info(f"Failed to connect to peer server: {e}")
+            self.retry_connection(attempt, self.connect_to_peer, port)
+
+    # Retries are run by the timer wheel, which can't wait for a coroutine, so they start a task instead
+    def connect_to_upstream(self, attempt=0):
+        self.loop.create_task(self.connect_to_upstream_async(attempt))
+
+    def connect_to_peer(self, port, attempt=0):
+        self.loop.create_task(self.connect_to_peer_async(port, attempt))
+
+    def handle_received_data(self, io_device, received_data):
+        """ Handles bytes received on a connection. Only complete messages are passed on to be handled; a
+        trailing partial message stays in the read buffer until the rest of it arrives.
+
+        Args:
+            io_device (AsyncConnection): the connection the bytes were received on
+            received_data (bytes): the received bytes
+        Returns:
+            None
+        """
+        io_device.data.bytes_received += len(received_data)
+        io_device.data.read_buffer += received_data
+        if not io_device.backlogged:
+            self.serve_connection(io_device)
+
+    def serve_connection(self, io_device):
+        """ Handles the messages waiting in a connection's read buffer, up to its message budget (see 
+        CRCServer.handle_read_buffer()). If messages are left over, reading from the connection is paused and
+        the rest are handled by a callback queued behind every other connection's reads, which takes the 
+        place of the round robin in CRCServer.handle_ready_connections(). Links to other servers are not 
+        served first with trunk_priority, but they still get the larger budget.
+
+        Args:
+            io_device (AsyncConnection): the connection to serve
+        Returns:
+            None
+        """
+        start = time.perf_counter()
+        try:
+            io_device.backlogged = self.handle_read_buffer(io_device)
+            self.disconnect_pending_connections()
+            self.metrics.loop_iteration.record(time.perf_counter() - start)
+        except Exception as e:
+            self.print_error("Error handling messages: %s", e)
+            io_device.fileobj.close()
+            return
+        io_device.set_reading(not io_device.data.paused_by)
+
+    def resume_ready_connection(self, connection_data):
+        """ Connections that are no longer paused are served by AsyncConnection.set_reading() instead """
+        pass
+
+    def update_io_device_events(self, connection_data):
+        """ Transports never need to be unregistered, so always pass the requested events on to the registry """
+        if connection_data.sock is not None and connection_data.sock in self.sel.connections:
+            self.sel.modify(connection_data.sock, self.io_device_events(connection_data), connection_data)
+
+    def start_batch(self, connection_data):
+        """ Holds back the writes to an adjacent server for self.batch_window seconds. See CRCServer.start_batch() """
+        self.pending_batches[connection_data] = None
+        self.loop.call_later(self.batch_window, self.flush_batch, connection_data)
+
+    def link_socket(self, connection_data):
+        transport = connection_data.sock
+        return transport.get_extra_info("socket") if transport is not None else None
+
+    def handle_connection_lost(self, io_device):
+        self.print_info(f"Connection closed by peer: {io_device.fileobj.get_extra_info('peername')}")
+        if self.sel.unregister(io_device.fileobj) is not None:
+            self.handle_connection_closed(io_device.data)
+
+    def cleanup(self):
+        """ Closes the listening server and every open connection. """
+        self.print_info("Cleaning up the server")
+        self.stop_stats_server()
+        self.save_snapshot()
+        if self.timer_handle is not None:
+            self.timer_handle.cancel()
+        if self.listener:
+            self.listener.close()
+        for connection in list(self.sel.connections.values()):
+            connection.fileobj.close()
+        self.sel.close()
+        self.logger.close()
@@ -0,0 +1,365 @@
+import json, multiprocessing, random, resource, selectors, threading, time, types
+from optparse import OptionParser
+from ChatServer import *
+from AsyncChatServer import AsyncCRCServer
+from ShardedChatServer import ShardedCRCServer
+
+# Measures how a network of CRC servers performs under load. A configurable topology of servers is started
+# on localhost, either as threads of this process or as separate processes, and thousands of synthetic
+# clients are connected to them. The synthetic clients are driven from a single selectors loop in this
+# process instead of being full CRCClient objects, which would need a thread each. The benchmark then runs
+# three workloads:
+#
+# * register: every client registers and the time until every client has been told about every other
+#   client is measured
+# * chat: clients send chat messages to random other clients for a fixed amount of time. Each message
+#   carries the time it was sent, so the latency of every delivered message is known.
+# * quit: a fraction of the clients quit and the time until every other client has been told is measured
+#
+# The results, along with the CPU time used and the peak RSS, are printed and can be saved as JSON. A saved
+# result can be passed back in with --baseline to compare two runs.
+
+SERVER_ENGINES = {
+    "select": CRCServer,
+    "async": AsyncCRCServer,
+    "sharded": ShardedCRCServer,
+}
+
+# Each topology maps the index of a server (other than the first) to the index of the server it connects to
+TOPOLOGIES = {
+    "chain": lambda index: index - 1,
+    "star": lambda index: 0,
+    "tree": lambda index: (index - 1) // 2,
+}
+
+# The ID of the first synthetic client. Servers are numbered from 1.
+FIRST_CLIENT_ID = 100000
+
+##############################################################################################################
+
+def latency_summary(latencies):
+    """ Summarizes a list of latencies in seconds as percentiles in microseconds """
+    if not latencies:
+        return {"count": 0}
+    latencies = sorted(latencies)
+    def percentile(fraction):
+        return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000000, 1)
+    return {
+        "count": len(latencies),
+        "mean_us": round(sum(latencies) / len(latencies) * 1000000, 1),
+        "p50_us": percentile(0.5),
+        "p99_us": percentile(0.99),
+        "p999_us": percentile(0.999),
+        "max_us": round(latencies[-1] * 1000000, 1),
+    }
+
+
+def run_server_process(server_class, options):
+    """ The entry point of each server process when the servers are run as separate processes """
+    server_class(options, True).run()
+
+##############################################################################################################
+
+class SyntheticClient():
+    """ The state of a single synthetic client's connection """
+    def __init__(self, id, sock):
+        self.id = id
+        self.sock = sock
+        self.read_buffer = bytearray()
+        self.write_buffer = SendQueue()
+        self.registrations_seen = 0             # The number of client registration messages received
+        self.quits_seen = 0                     # The number of client quit messages received
+        self.quit = False
+
+
+class LoadGenerator():
+    """ LoadGenerator drives every synthetic client from one selectors loop. Messages to be sent are queued
+    for each client just like CRCServer queues them, and every received message is counted (and timed, for
+    chat messages) as it arrives.
+    """
+    def __init__(self, ports, client_count, seed=0):
+        self.ports = ports
+        self.client_count = client_count
+        self.random = random.Random(seed)
+        self.sel = selectors.DefaultSelector()
+        self.clients = []
+        self.latencies = []
+        self.chats_received = 0
+
+    def connect(self):
+        for i in range(self.client_count):
+            sock = create_connection(("127.0.0.1", self.ports[i % len(self.ports)]))
+            sock.setblocking(False)
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            client = SyntheticClient(FIRST_CLIENT_ID + i, sock)
+            self.sel.register(sock, selectors.EVENT_READ, client)
+            self.clients.append(client)
+            self.queue_message(client, ClientRegistrationMessage.bytes(client.id, 0, "load%i" % i, ""))
+
+    def queue_message(self, client, message):
+        was_idle = not client.write_buffer
+        client.write_buffer.append(message)
+        if was_idle:
+            self.sel.modify(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+
+    def poll(self, timeout):
+        for key, event_mask in self.sel.select(timeout):
+            client = key.data
+            if event_mask & selectors.EVENT_READ:
+                received_data = client.sock.recv(RECV_BATCH_SIZE)
+                if not received_data:
+                    raise ConnectionError("Server closed the connection of client %i" % client.id)
+                client.read_buffer += received_data
+                complete_messages = MessageParser.split_complete_messages(client.read_buffer)
+                if complete_messages:
+                    self.handle_messages(client, complete_messages)
+            if event_mask & selectors.EVENT_WRITE:
+                client.write_buffer.send(client.sock)
+                if not client.write_buffer:
+                    self.sel.modify(client.sock, selectors.EVENT_READ, client)
+
+    def handle_messages(self, client, data):
+        now = time.perf_counter()
+        for message in MessageParser.parse_messages(data):
+            if message.message_type == 0x81:
+                self.latencies.append(now - float(message.content))
+                self.chats_received += 1
+            elif message.message_type == 0x80:
+                client.registrations_seen += 1
+            elif message.message_type == 0x82:
+                client.quits_seen += 1
+
+    def run_until(self, condition, timeout):
+        """ Runs the loop until condition() is True. Returns the time taken and whether condition() became
+        True before the timeout.
+        """
+        start = time.perf_counter()
+        while not condition():
+            if time.perf_counter() - start > timeout:
+                return time.perf_counter() - start, False
+            self.poll(0.01)
+        return time.perf_counter() - start, True
+
+    def register(self, timeout):
+        """ The register workload: connects and registers every client """
+        start = time.perf_counter()
+        self.connect()
+        others = self.client_count - 1
+        elapsed, complete = self.run_until(lambda: all(c.registrations_seen >= others for c in self.clients),
+                                           timeout)
+        elapsed = time.perf_counter() - start
+        return {
+            "clients": self.client_count,
+            "seconds": round(elapsed, 4),
+            "registrations_per_second": round(self.client_count / elapsed, 1),
+            "registration_messages_delivered": sum(c.registrations_seen for c in self.clients),
+            "complete": complete,
+        }
+
+    def chat(self, duration, window, timeout):
+        """ The chat workload: sends chat messages between random pairs of clients for duration seconds,
+        keeping at most window messages in flight at once.
+        """
+        self.latencies = []
+        self.chats_received = 0
+        sent = 0
+        start = time.perf_counter()
+        end = start + duration
+        while time.perf_counter() < end:
+            while sent - self.chats_received < window:
+                source, destination = self.random.sample(self.clients, 2)
+                self.queue_message(source, ClientChatMessage.bytes(source.id, destination.id,
+                                                                   "%.9f" % time.perf_counter()))
+                sent += 1
+            self.poll(0)
+        drained, complete = self.run_until(lambda: self.chats_received >= sent, timeout)
+        elapsed = time.perf_counter() - start
+        return {
+            "messages_sent": sent,
+            "messages_received": self.chats_received,
+            "seconds": round(elapsed, 4),
+            "messages_per_second": round(self.chats_received / elapsed, 1),
+            "latency": latency_summary(self.latencies),
+            "complete": complete,
+        }
+
+    def quit(self, fraction, timeout):
+        """ The quit workload: a fraction of the clients quit """
+        quitters = self.clients[:int(self.client_count * fraction)]
+        remaining = self.clients[len(quitters):]
+        start = time.perf_counter()
+        for client in quitters:
+            client.quit = True
+            self.queue_message(client, ClientQuitMessage.bytes(client.id, "benchmark"))
+        elapsed, complete = self.run_until(lambda: all(c.quits_seen >= len(quitters) for c in remaining), timeout)
+        return {
+            "clients_quit": len(quitters),
+            "seconds": round(elapsed, 4),
+            "quits_per_second": round(len(quitters) / elapsed, 1) if elapsed else 0,
+            "complete": complete,
+        }
+
+    def close(self):
+        for client in self.clients:
+            self.sel.unregister(client.sock)
+            client.sock.close()
+        self.sel.close()
+
+##############################################################################################################
+
+class CRCBenchmark(object):
+    """ Starts the servers, runs every workload against them, and collects the results """
+    def __init__(self, options):
+        self.options = options
+        self.server_class = SERVER_ENGINES[options.engine]
+        self.ports = [options.port + i for i in range(options.servers)]
+        self.servers = []                                   # The servers when they are run as threads
+        self.processes = []                                 # The servers when they are run as processes
+
+    def server_options(self, index):
+        parent = TOPOLOGIES[self.options.topology](index) if index else None
+        return types.SimpleNamespace(id=index + 1, servername="Server%i" % (index + 1), info="",
+                                     port=self.ports[index],
+                                     connect_to_host=None if parent is None else "Server%i" % (parent + 1),
+                                     connect_to_port=None if parent is None else self.ports[parent],
+                                     log_file=None, log_level="off", workers=self.options.workers,
+                                     batch_window_us=self.options.batch_window_us, 
+                                     tcp_nodelay=self.options.tcp_nodelay, tcp_cork=self.options.tcp_cork,
+                                     link_compression=self.options.link_compression,
+                                     message_budget=self.options.message_budget, 
+                                     trunk_priority=self.options.trunk_priority,
+                                     client_rate_limit=self.options.client_rate_limit,
+                                     edge_triggered=self.options.edge_triggered)
+
+    def start_servers(self):
+        context = multiprocessing.get_context("fork")
+        for index in range(self.options.servers):
+            options = self.server_options(index)
+            if self.options.processes:
+                process = context.Process(target=run_server_process, args=(self.server_class, options), daemon=True)
+                process.start()
+                self.processes.append(process)
+            else:
+                server = self.server_class(options, True)
+                threading.Thread(target=server.run, daemon=True).start()
+                self.servers.append(server)
+            # Give each server time to start listening before the next server connects to it
+            time.sleep(self.options.startup_delay)
+
+    def stop_servers(self):
+        for server in self.servers:
+            server.request_terminate = True
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        time.sleep(0.2)
+
+    def run(self):
+        raise_file_limit()
+        self.start_servers()
+        generator = LoadGenerator(self.ports, self.options.clients, self.options.seed)
+        start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        results = {}
+        try:
+            results["register"] = generator.register(self.options.timeout)
+            results["chat"] = generator.chat(self.options.duration, self.options.window, self.options.timeout)
+            results["quit"] = generator.quit(self.options.quit_fraction, self.options.timeout)
+            if self.servers and hasattr(self.servers[0], "metrics_snapshot"):
+                # How well each server coalesced and compressed its writes to the other servers
+                snapshots = {server.server_name: server.metrics_snapshot() for server in self.servers}
+                results["server_link_batching"] = {name: snapshot["server_link_batching"] 
+                                                   for name, snapshot in snapshots.items()}
+                results["link_compression"] = {name: snapshot["link_compression"] 
+                                               for name, snapshot in snapshots.items()}
+        finally:
+            generator.close()
+            self.stop_servers()
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        results["resources"] = {
+            "cpu_user_seconds": round(usage.ru_utime - start_usage.ru_utime, 3),
+            "cpu_system_seconds": round(usage.ru_stime - start_usage.ru_stime, 3),
+            "max_rss_kb": usage.ru_maxrss,
+        }
+        if self.processes:
+            # The servers' usage is only known once the processes have been joined. Without processes, the
+            # figures above include the servers' threads as well as the load generator.
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            results["resources"]["server_cpu_user_seconds"] = round(children.ru_utime, 3)
+            results["resources"]["server_cpu_system_seconds"] = round(children.ru_stime, 3)
+            results["resources"]["server_max_rss_kb"] = children.ru_maxrss
+        return {"config": vars(self.options), "results": results}
+
+
+def raise_file_limit():
+    """ Every synthetic client needs a socket, and so does the server side of its connection """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def print_results(report, baseline=None):
+    """ Prints the results of a run, along with the relative change from a baseline run if one is given """
+    def flatten(results, prefix=""):
+        for key, value in results.items():
+            if isinstance(value, dict):
+                yield from flatten(value, prefix + key + ".")
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield prefix + key, value
+
+    previous = dict(flatten(baseline["results"])) if baseline else {}
+    for name, value in flatten(report["results"]):
+        line = "%-45s %14s" % (name, value)
+        if previous.get(name):
+            line += " %+8.1f%%" % ((value - previous[name]) / previous[name] * 100)
+        print(line)
+
+
+if __name__ == "__main__":
+    op = OptionParser(description="Measures the throughput and latency of a network of CRC servers")
+    op.add_option("--engine", default="select", choices=sorted(SERVER_ENGINES),
+                  help="The server implementation to benchmark (select, async, or sharded)")
+    op.add_option("--servers", type="int", default=3, help="The number of servers in the network")
+    op.add_option("--topology", default="chain", choices=sorted(TOPOLOGIES),
+                  help="How the servers are connected (chain, star, or tree)")
+    op.add_option("--processes", action="store_true", default=False,
+                  help="Run each server in its own process instead of in a thread of the benchmark")
+    op.add_option("--workers", type="int", default=None, help="The number of workers of each sharded server")
+    op.add_option("--clients", type="int", default=1000, help="The number of synthetic clients")
+    op.add_option("--duration", type="float", default=10.0, help="How long to run the chat workload for")
+    op.add_option("--window", type="int", default=1000,
+                  help="The most chat messages that may be waiting to be delivered at once")
+    op.add_option("--batch_window_us", type="int", default=0,
+                  help="How long the servers hold back writes to other servers to batch them, in microseconds")
+    op.add_option("--tcp_nodelay", action="store_true", default=False,
+                  help="Disable Nagle's algorithm on the links between servers")
+    op.add_option("--tcp_cork", action="store_true", default=False,
+                  help="Cork the links between servers while each batch is written (Linux only)")
+    op.add_option("--link_compression", action="store_true", default=False,
+                  help="Compress the links between servers")
+    op.add_option("--message_budget", type="int", default=None,
+                  help="The most messages each server handles from one connection before serving the next")
+    op.add_option("--trunk_priority", action="store_true", default=False,
+                  help="Serve the links between servers before clients, with a larger message budget")
+    op.add_option("--client_rate_limit", type="float", default=None,
+                  help="The most chat messages per second each server accepts from each of its clients")
+    op.add_option("--edge_triggered", action="store_true", default=False,
+                  help="Use edge-triggered epoll in the servers' select() loops (Linux only)")
+    op.add_option("--quit_fraction", type="float", default=0.5, help="The fraction of clients that quit")
+    op.add_option("--timeout", type="float", default=60.0, help="How long to wait for each workload to finish")
+    op.add_option("--port", type="int", default=31000, help="The port of the first server")
+    op.add_option("--startup_delay", type="float", default=0.2, help="The time to wait after starting a server")
+    op.add_option("--seed", type="int", default=0, help="The seed used to pick senders and receivers")
+    op.add_option("--output", default=None, help="Save the results to this JSON file")
+    op.add_option("--baseline", default=None, help="Compare the results to a JSON file saved by a previous run")
+    options, args = op.parse_args()
+
+    report = CRCBenchmark(options).run()
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as fp:
+            baseline = json.load(fp)
+    print_results(report, baseline)
+    if options.output:
+        with open(options.output, "w") as fp:
+            json.dump(report, fp, indent=2)
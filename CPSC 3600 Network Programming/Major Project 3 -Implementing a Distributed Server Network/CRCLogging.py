@@ -0,0 +1,106 @@
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+# The log levels that can be passed in options.log_level, by name. "off" disables logging entirely.
+LOG_LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "off": logging.CRITICAL + 1,
+}
+
+def parse_log_level(level):
+    """ Converts a log level given as a name (e.g. "debug") or as a number into a logging level number.
+    Defaults to INFO when no level is given.
+    """
+    if level is None:
+        return logging.INFO
+    if isinstance(level, str):
+        if level.lower() not in LOG_LEVELS:
+            raise ValueError("Unknown log level: %s" % level)
+        return LOG_LEVELS[level.lower()]
+    return int(level)
+
+##############################################################################################################
+
+class ConsoleHandler(logging.Handler):
+    """ Writes log records to whatever sys.stdout is when the record is written. The testing application
+    replaces sys.stdout for each test, so the handler can't hold on to the stream it was created with.
+    """
+    def emit(self, record):
+        try:
+            sys.stdout.write(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """ A QueueHandler that leaves formatting to the listener thread. The standard QueueHandler formats every
+    record before queueing it, which is exactly the work that should be kept off the event loop. The
+    arguments of a record must therefore not be changed after they are logged (bytes and numbers never are).
+    """
+    def prepare(self, record):
+        return record
+
+##############################################################################################################
+
+class CRCLog():
+    """ CRCLog is the logger shared by CRCServer and CRCClient. Records are written to the console prefixed
+    with the name of the server or client and, if a log file is given, to that file in the Logs directory.
+
+    debug(), info() and error() take the format string and its arguments separately, and check the level
+    before doing anything else, so a message below the log level costs one integer comparison and is never
+    formatted. When use_queue is True, records are handed to a background thread through a queue and are
+    formatted and written there, so logging never blocks the caller on the console or the disk.
+    """
+    def __init__(self, name, log_file=None, level=None, use_queue=False):
+        self.level = parse_log_level(level)
+        self.logger = logging.Logger(name, self.level)
+        self.handlers = []
+        self.listener = None
+
+        console = ConsoleHandler()
+        console.setFormatter(logging.Formatter("[%s] \t%%(message)s" % name.replace("%", "%%")))
+        self.handlers.append(console)
+
+        if log_file:
+            __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+            fh = logging.FileHandler(os.path.join(__location__, 'Logs', '%s' % log_file), mode='w')
+            fh.setFormatter(logging.Formatter(
+                ("%(asctime)s - %(name)s[%(process)d] - "
+                 "%(levelname)s - %(message)s")))
+            self.handlers.append(fh)
+
+        if use_queue:
+            records = queue.SimpleQueue()
+            self.logger.addHandler(DeferredQueueHandler(records))
+            self.listener = logging.handlers.QueueListener(records, *self.handlers)
+            self.listener.start()
+        else:
+            for handler in self.handlers:
+                self.logger.addHandler(handler)
+
+    def debug(self, msg, *args):
+        if self.level <= logging.DEBUG:
+            self.logger.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        if self.level <= logging.INFO:
+            self.logger.log(logging.INFO, msg, *args)
+
+    def error(self, msg, *args):
+        if self.level <= logging.ERROR:
+            self.logger.log(logging.ERROR, msg, *args)
+
+    def close(self):
+        """ Flushes any queued records and closes the log. Nothing is logged after the log is closed. """
+        self.level = LOG_LEVELS["off"]
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        for handler in self.handlers:
+            handler.close()
@@ -0,0 +1,202 @@
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latencies are recorded in power of two buckets of microseconds. Bucket i counts latencies of less than 2**i
+# microseconds (and at least 2**(i-1)), so recording a latency is just a bit_length() and an increment.
+HISTOGRAM_BUCKETS = 32
+
+##############################################################################################################
+
+class LatencyHistogram():
+    """ LatencyHistogram counts how many times an operation took each range of time. It is cheap enough to
+    update on every message, and percentiles can still be estimated from it to within a factor of two.
+    """
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0                        # The sum of every recorded latency, in seconds
+        self.maximum = 0.0                      # The longest recorded latency, in seconds
+
+    def record(self, seconds):
+        bucket = int(seconds * 1000000).bit_length()
+        self.buckets[bucket if bucket < HISTOGRAM_BUCKETS else HISTOGRAM_BUCKETS - 1] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def percentile(self, fraction):
+        """ Returns the upper bound, in microseconds, of the bucket containing the given percentile
+
+        Args:
+            fraction (float): the percentile to find, between 0 and 1 (e.g. 0.99)
+        Returns:
+            int: an upper bound on the latency of the given percentile in microseconds
+        """
+        if not self.count:
+            return 0
+        target = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return 1 << bucket
+        return 1 << (HISTOGRAM_BUCKETS - 1)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_us": round(self.total / self.count * 1000000, 3) if self.count else 0,
+            "max_us": round(self.maximum * 1000000, 3),
+            "p50_us": self.percentile(0.5),
+            "p99_us": self.percentile(0.99),
+            "p999_us": self.percentile(0.999),
+        }
+
+##############################################################################################################
+
+class ServerMetrics():
+    """ ServerMetrics holds the counters and histograms a CRCServer updates while it runs. The server only
+    ever increments counters and records latencies; all of the formatting happens in snapshot(), which is
+    only called when someone asks for the metrics.
+    """
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.messages = collections.Counter()           # Maps message class names to the number handled
+        self.message_latency = LatencyHistogram()       # The time taken to handle (and forward) each message
+        self.loop_iteration = LatencyHistogram()        # The time taken to process each batch of select() events
+        self.previous_snapshot_time = self.start_time
+        self.previous_messages = collections.Counter()
+
+    def record_message(self, message, seconds):
+        self.messages[message.__class__.__name__] += 1
+        self.message_latency.record(seconds)
+
+    def snapshot(self, server):
+        """ Collects the current metrics of a server into a dictionary that can be encoded as JSON.
+
+        Message rates are reported both over the server's whole uptime and over the time since the previous
+        snapshot, which is the more useful number when the metrics are polled regularly.
+
+        Args:
+            server (CRCServer): the server these metrics belong to
+        Returns:
+            dict: the server's current metrics
+        """
+        now = time.monotonic()
+        uptime = max(now - self.start_time, 1e-9)
+        interval = max(now - self.previous_snapshot_time, 1e-9)
+        messages = collections.Counter(self.messages)
+
+        message_rates = {}
+        for name, count in messages.items():
+            message_rates[name] = {
+                "count": count,
+                "per_second": round(count / uptime, 3),
+                "recent_per_second": round((count - self.previous_messages[name]) / interval, 3),
+            }
+        self.previous_snapshot_time = now
+        self.previous_messages = messages
+
+        connections = {}
+        for host_id, host in list(server.adjacent_server_ids.items()) + list(server.adjacent_user_ids.items()):
+            connections[host_id] = {
+                "bytes_in": host.bytes_received,
+                "bytes_out": host.bytes_sent,
+                "queued_bytes": len(host.write_buffer),
+                "paused": bool(host.paused_by),
+                "frames_out": host.frames_queued,
+                "writes": host.writes,
+            }
+
+        # How well writes to other servers are being coalesced
+        server_links = list(server.adjacent_server_ids.values())
+        frames = sum(link.frames_queued for link in server_links)
+        writes = sum(link.writes for link in server_links)
+        bytes_sent = sum(link.bytes_sent for link in server_links)
+        batching = {
+            "window_us": round(server.batch_window * 1000000),
+            "frames": frames,
+            "writes": writes,
+            "frames_per_write": round(frames / writes, 3) if writes else 0,
+            "bytes_per_write": round(bytes_sent / writes, 1) if writes else 0,
+        }
+
+        compression = {
+            "links": sum(1 for link in server_links if link.compressor is not None),
+            "uncompressed_bytes": server.compression_input_bytes,
+            "compressed_bytes": server.compression_output_bytes,
+            "ratio": (round(server.compression_input_bytes / server.compression_output_bytes, 3) 
+                      if server.compression_output_bytes else 0),
+        }
+
+        # Repeated floods and channel messages dropped in link-state mode
+        link_state = server.link_state
+        duplicate_floods = (link_state.seen_floods.suppressed + link_state.seen_publishes.suppressed
+                            if link_state else 0)
+
+        return {
+            "server_id": server.id,
+            "server_name": server.server_name,
+            "uptime": round(uptime, 3),
+            "known_hosts": len(server.hosts_db),
+            "messages": message_rates,
+            "message_latency": self.message_latency.summary(),
+            "loop_iteration": self.loop_iteration.summary(),
+            "connections": connections,
+            "server_link_batching": batching,
+            "link_compression": compression,
+            "backpressure_events": server.backpressure_events,
+            "dropped_messages": server.dropped_messages,
+            "idle_disconnects": server.idle_disconnects,
+            "evicted_hosts": server.evicted_hosts,
+            "exhausted_budgets": server.exhausted_budgets,
+            "throttled_messages": server.throttled_messages,
+            "scheduled_timers": len(server.timers),
+            "duplicate_floods": duplicate_floods,
+        }
+
+##############################################################################################################
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    """ Answers every GET request with the server's current metrics encoded as JSON """
+    def do_GET(self):
+        try:
+            body = json.dumps(self.server.crc_server.metrics_snapshot(), indent=2).encode()
+        except RuntimeError:
+            # A dictionary changed size while the server's thread was updating it. Ask the client to retry.
+            self.send_error(503, "Metrics are being updated, try again")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't print a line for every stats request
+        pass
+
+
+class StatsServer():
+    """ StatsServer serves a CRCServer's metrics over HTTP on the loopback interface from a background
+    thread, so the metrics can be polled (e.g. with curl http://127.0.0.1:<port>/) without touching the
+    server's own select() loop.
+    """
+    def __init__(self, crc_server, port, host="127.0.0.1"):
+        self.httpd = ThreadingHTTPServer((host, port), StatsRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.crc_server = crc_server
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, kwargs={"poll_interval": 0.1},
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,87 @@
+import math
+import select
+import selectors
+
+# The most events a single call to epoll_wait() returns. selectors.EpollSelector asks for as many events as
+# there are registered sockets, and so allocates an array that large on every call, which adds up with tens of
+# thousands of connections. Events that don't fit stay queued in the kernel and are returned by the next call.
+DEFAULT_EPOLL_MAX_EVENTS = 1024
+
+##############################################################################################################
+
+if hasattr(select, "epoll"):
+
+    class EdgeTriggeredEpollSelector(selectors.EpollSelector):
+        """ EdgeTriggeredEpollSelector is an epoll selector that registers every socket with EPOLLET. A
+        level-triggered selector reports every socket that is ready on every call to select(), whether or not
+        anything has changed since the last call, while an edge-triggered one only reports a socket when it
+        becomes ready again. That is, when new bytes arrive, or when a full send buffer has room again.
+
+        The owner has to either read from a reported socket until recv() raises BlockingIOError (and write
+        to it until send() does), or call keep_ready() to have the socket reported by the next call to
+        select() even though nothing has changed. Changing the events a socket is registered for makes epoll
+        check the socket again, so asking for WRITE events on a socket that is already writable reports it
+        straight away, just like a level-triggered selector would.
+
+        Only available on Linux.
+        """
+        # selectors.EpollSelector builds the mask passed to epoll from these
+        _EVENT_READ = select.EPOLLIN | select.EPOLLET
+        _EVENT_WRITE = select.EPOLLOUT | select.EPOLLET
+
+        def __init__(self, max_events=None):
+            super(EdgeTriggeredEpollSelector, self).__init__()
+            self.max_events = max_events or DEFAULT_EPOLL_MAX_EVENTS
+            self.still_ready = {}                       # Maps file descriptors to the events to report again
+
+        def keep_ready(self, fileobj, events):
+            """ Reports a socket as ready for the given events on the next call to select(), which then does not
+            wait. Use this when a socket was not read from (or written to) until it would block.
+
+            Args:
+                fileobj (socket): a registered socket
+                events (int): EVENT_READ and/or EVENT_WRITE
+            Returns:
+                None
+            """
+            fd = self.get_key(fileobj).fd
+            self.still_ready[fd] = self.still_ready.get(fd, 0) | events
+
+        def unregister(self, fileobj):
+            key = super(EdgeTriggeredEpollSelector, self).unregister(fileobj)
+            self.still_ready.pop(key.fd, None)
+            return key
+
+        def select(self, timeout=None):
+            """ Returns the (key, events) pairs of the sockets that have become ready since the last call, and
+            of the sockets passed to keep_ready() since then, in the same form as selectors.EpollSelector.
+            """
+            if self.still_ready:
+                timeout = 0
+            if timeout is None:
+                timeout = -1
+            elif timeout > 0:
+                timeout = math.ceil(timeout * 1e3) * 1e-3     # epoll has a resolution of 1 millisecond
+            else:
+                timeout = 0
+            try:
+                fd_event_list = self._selector.poll(timeout, self.max_events)
+            except InterruptedError:
+                fd_event_list = []
+
+            ready = self.still_ready
+            self.still_ready = {}
+            for fd, event in fd_event_list:
+                events = 0
+                if event & ~select.EPOLLIN:
+                    events |= selectors.EVENT_WRITE
+                if event & ~select.EPOLLOUT:
+                    events |= selectors.EVENT_READ
+                ready[fd] = ready.get(fd, 0) | events
+
+            fd_to_key = self._fd_to_key
+            return [(fd_to_key[fd], events & fd_to_key[fd].events) for fd, events in ready.items()
+                    if fd in fd_to_key and events & fd_to_key[fd].events]
+
+else:
+    EdgeTriggeredEpollSelector = None
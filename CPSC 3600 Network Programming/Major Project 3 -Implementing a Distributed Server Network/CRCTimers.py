@@ -0,0 +1,161 @@
+import time
+
+# The resolution of the timer wheel in seconds. Every timer fires on a tick of this length, never early.
+DEFAULT_TIMER_TICK = 0.01
+
+# The wheel has WHEEL_LEVELS levels of 2**WHEEL_BITS slots each. A slot on level 0 holds the timers due on a
+# single tick, and a slot on each level above holds the timers due within one full turn of the level below it.
+# Four levels of 64 slots cover 2**24 ticks (about 46 hours with 10 ms ticks). Timers due after that are kept
+# in the last slot of the top level and are placed again when it is reached.
+WHEEL_BITS = 6
+WHEEL_SLOTS = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SLOTS - 1
+WHEEL_LEVELS = 4
+WHEEL_SPAN = 1 << (WHEEL_BITS * WHEEL_LEVELS)
+
+##############################################################################################################
+
+class Timer():
+    """ Timer is a callback scheduled on a TimerWheel. It is returned by TimerWheel.schedule() so that it can
+    be cancelled. A cancelled timer stays in its slot until the wheel reaches it, but is never run.
+    """
+    __slots__ = ("tick", "callback", "args", "wheel")
+
+    def __init__(self, tick, callback, args, wheel):
+        self.tick = tick                    # The tick the timer is due on
+        self.callback = callback            # None once the timer has run or been cancelled
+        self.args = args
+        self.wheel = wheel
+
+    @property
+    def deadline(self):
+        return self.tick * self.wheel.tick_length
+
+    def cancel(self):
+        if self.callback is not None:
+            self.callback = None
+            self.wheel.count -= 1
+            self.wheel.cancelled += 1
+
+
+class TimerWheel():
+    """ TimerWheel is a hierarchical timing wheel, as used by operating system kernels to keep track of very
+    many timeouts at once. Scheduling and cancelling a timer are O(1) whatever the number of timers, and
+    advancing the wheel costs O(1) per tick plus O(1) per timer, since each timer is moved down a level at
+    most WHEEL_LEVELS - 1 times before it runs. This makes it cheap to keep a timer for every connection.
+
+    The owner of the wheel calls run() from its event loop, and can wait for time_until_next() seconds
+    between calls instead of waking up at a fixed interval.
+    """
+    def __init__(self, tick_length=None):
+        self.tick_length = tick_length or DEFAULT_TIMER_TICK
+        self.current_tick = self.tick_of(time.monotonic())  # The next tick whose timers have not run yet
+        self.levels = [[[] for slot in range(WHEEL_SLOTS)] for level in range(WHEEL_LEVELS)]
+        self.count = 0                                      # The number of timers waiting to run
+        self.cancelled = 0                                  # The number of cancelled timers still in a slot
+
+    def __len__(self):
+        return self.count
+
+    def tick_of(self, seconds):
+        return int(seconds / self.tick_length)
+
+    def schedule(self, delay, callback, *args):
+        """ Schedules callback(*args) to be called once delay seconds have passed.
+
+        Args:
+            delay (float): how long to wait, in seconds
+            callback (function): the function to call
+        Returns:
+            Timer: the scheduled timer, which can be cancelled
+        """
+        # Round up so that the timer never runs early
+        tick = -int(-(time.monotonic() + delay) // self.tick_length)
+        timer = Timer(tick, callback, args, self)
+        self.place(timer)
+        self.count += 1
+        return timer
+
+    def place(self, timer):
+        """ Puts a timer in the slot of the level whose range covers the number of ticks until it is due """
+        tick = max(timer.tick, self.current_tick)
+        ticks = tick - self.current_tick
+        if ticks >= WHEEL_SPAN:
+            tick = self.current_tick + WHEEL_SPAN - 1
+            ticks = WHEEL_SPAN - 1
+        level = 0
+        while ticks >= WHEEL_SLOTS << (WHEEL_BITS * level):
+            level += 1
+        self.levels[level][(tick >> (WHEEL_BITS * level)) & WHEEL_MASK].append(timer)
+
+    def cascade(self, level):
+        """ Moves the timers in the current slot of a level down to the levels below it. Returns the index of
+        the slot, which is 0 when the level above is due to be cascaded as well.
+        """
+        index = (self.current_tick >> (WHEEL_BITS * level)) & WHEEL_MASK
+        slot = self.levels[level][index]
+        self.levels[level][index] = []
+        for timer in slot:
+            if timer.callback is not None:
+                self.place(timer)
+            else:
+                self.cancelled -= 1
+        return index
+
+    def run(self, now=None):
+        """ Runs every timer that is due, in the order they are due. Timers scheduled by the callbacks are run
+        in the same call if they are already due.
+
+        Args:
+            now (float): the current time.monotonic(), if the caller already has it
+        Returns:
+            int: the number of timers that were run
+        """
+        target = self.tick_of(time.monotonic() if now is None else now)
+        run = 0
+        level_zero = self.levels[0]
+        while self.current_tick <= target and self.count:
+            index = self.current_tick & WHEEL_MASK
+            if not index:
+                level = 1
+                while level < WHEEL_LEVELS and not self.cascade(level):
+                    level += 1
+            # A callback may schedule a timer that is already due, which goes into this same slot
+            while level_zero[index]:
+                slot = level_zero[index]
+                level_zero[index] = []
+                for timer in slot:
+                    callback = timer.callback
+                    if callback is None:
+                        self.cancelled -= 1
+                        continue
+                    timer.callback = None
+                    self.count -= 1
+                    callback(*timer.args)
+                    run += 1
+            self.current_tick += 1
+
+        if not self.count and self.current_tick <= target:
+            # Nothing is left to run, so skip straight to the current tick. Any cancelled timers left in the 
+            # slots that are skipped would never be reached, so throw them away.
+            if self.cancelled:
+                self.levels = [[[] for slot in range(WHEEL_SLOTS)] for level in range(WHEEL_LEVELS)]
+                self.cancelled = 0
+            self.current_tick = target + 1
+        return run
+
+    def time_until_next(self, now=None):
+        """ Returns how many seconds the owner can wait before calling run() again without any timer running
+        late, or None if there are no timers. This is the time until the next timer on level 0 is due, or
+        until the next time timers are moved down from a higher level, whichever is sooner.
+        """
+        if not self.count:
+            return None
+        now = time.monotonic() if now is None else now
+        level_zero = self.levels[0]
+        for tick in range(self.current_tick, self.current_tick + WHEEL_SLOTS):
+            if not tick & WHEEL_MASK:
+                break                       # Timers are moved down from the levels above on this tick
+            if any(timer.callback is not None for timer in level_zero[tick & WHEEL_MASK]):
+                break
+        return max(0.0, tick * self.tick_length - now)
@@ -5,6 +5,7 @@ import selectors
 import logging
 import types
 from ChatMessageParser import *
+from CRCLogging import CRCLog
 
 
 class CRCClient(object):
@@ -23,8 +24,12 @@ class CRCClient(object):
         self.info = options.info
 
         self.connected_user_ids = {}
+        self.read_buffer = bytearray()
         self.status_updates_log = []
         self.chat_messages_log = []
+        self.channels = set()                   # The channels this client has joined
+        self.channel_messages_log = []          # (channel, content) of every channel message received
+        self.channel_sequence = 0               # Numbers the messages this client publishes
 
 
         # This dictionary contains mappings from commands to command handlers.
@@ -35,11 +40,15 @@ class CRCClient(object):
             0x80:self.handle_client_registration_message,
             0x81:self.handle_client_chat_message,
             0x82:self.handle_client_quit_message,
+            0x85:self.handle_channel_publish_message,
+            0x0A:self.handle_heartbeat_message,
         }
 
 
         # Options to help with debugging and logging
         self.log_file = options.log_file
+        self.log_level = getattr(options, "log_level", None)
+        self.log_queue = getattr(options, "log_queue", False)
         self.logger = None
 
         self.init_logging()
@@ -70,12 +79,17 @@ class CRCClient(object):
 
     def listen_for_server_input(self):
         while not self.request_terminate:
-            rcvd = self.sock.recv(2048)
+            rcvd = self.sock.recv(65536)
             if rcvd:
-                self.handle_messages(rcvd)
+                # Messages can be split across reads, so only handle the complete ones and keep the rest
+                self.read_buffer += rcvd
+                complete_messages = MessageParser.split_complete_messages(self.read_buffer)
+                if complete_messages:
+                    self.handle_messages(complete_messages)
             else:
                 self.print_info("Server has disconnected!")
                 self.request_terminate = True
+        self.logger.close()
 
     # This is a function stub that will be completed in a future assignment
     def handle_messages(self, recv_data):
@@ -84,7 +98,7 @@ class CRCClient(object):
         for message in messages:
              # If we recognize the command, then process it using the assigned message handler
             if message.message_type in self.message_handlers:
-                self.print_info("Received message from Host ID #%s \"%s\"" % (message.source_id, message.bytes))
+                self.logger.info("Received message from Host ID #%s \"%s\"", message.source_id, message.bytes)
                 self.message_handlers[message.message_type](message)
             else:
                 raise Exception("Unrecognized command: " + message)
@@ -93,7 +107,7 @@ class CRCClient(object):
     ######################################################################
     # This block of functions ...
     def send_message_to_server(self, message):
-        self.print_info("Sending message to " + str(message))
+        self.logger.info("Sending message to %s", message)
         self.sock.send(message)
 
     ######################################################################
@@ -112,6 +126,14 @@ class CRCClient(object):
     def handle_client_quit_message(self, message):
         del self.connected_user_ids[message.source_id]
 
+    def handle_channel_publish_message(self, message):
+        self.channel_messages_log.append((message.channel, message.content))
+
+    def handle_heartbeat_message(self, message):
+        # Answer the server so that it knows this connection is still alive
+        if not message.flags & HeartbeatMessage.REPLY:
+            self.send_message_to_server(HeartbeatMessage.bytes(self.id, HeartbeatMessage.REPLY))
+
 
     ######################################################################
     # Quit message    
@@ -120,11 +142,37 @@ class CRCClient(object):
         self.send_message_to_server(msg)
 
 
+    ######################################################################
+    # Channel messages. A message published to a channel is delivered to every member of the channel except
+    # the client that published it. A client does not have to be a member to publish to a channel.
+    def join_channel(self, channel):
+        self.channels.add(channel)
+        self.send_message_to_server(ChannelJoinMessage.bytes(self.id, channel))
+
+    def leave_channel(self, channel):
+        self.channels.discard(channel)
+        self.send_message_to_server(ChannelLeaveMessage.bytes(self.id, channel))
+
+    def publish_to_channel(self, channel, content):
+        self.channel_sequence += 1
+        self.send_message_to_server(ChannelPublishMessage.bytes(self.id, self.channel_sequence, channel, content))
+
+
     ######################################################################
     # Quit message    
     def quit(self, quit_message=''):
         msg = ClientQuitMessage.bytes(self.id, quit_message)
         self.send_message_to_server(msg)
+
+
+    ######################################################################
+    # Logging helpers that sit alongside the template's print_info(). The values to be formatted into the
+    # message are passed as separate arguments, and CRCLog only formats messages at or above the log level.
+    def print_debug(self, msg, *args):
+        self.logger.debug(msg, *args)
+
+    def print_error(self, msg, *args):
+        self.logger.error(msg, *args)
     
 
     ######################################################################
@@ -134,32 +182,8 @@ class CRCClient(object):
     # messages useful to you in development
 
     def init_logging(self):
-        # If we don't include a log file name, then don't log
-        if not self.log_file:
-            return
-
-        # Get a reference to the logger for this program
-        self.logger = logging.getLogger("IRCServer")
-        __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
-
-        # Create a file handler to store the log files
-        fh = logging.FileHandler(os.path.join(__location__, 'Logs', '%s' % self.log_file), mode='w')
-
-        # Set up the logging level. It defaults to INFO
-        log_level = logging.INFO
-
-        # Define a formatter that will be used to format each line in the log
-        formatter = logging.Formatter(
-            ("%(asctime)s - %(name)s[%(process)d] - "
-             "%(levelname)s - %(message)s"))
-
-        # Assign all of the necessary parameters
-        fh.setLevel(log_level)
-        fh.setFormatter(formatter)
-        self.logger.setLevel(log_level)
-        self.logger.addHandler(fh)
+        # See CRCLogging.CRCLog for the log level, log file and log queue options
+        self.logger = CRCLog(self.client_name, self.log_file, self.log_level, self.log_queue)
 
     def print_info(self, msg):
-        print("[%s] \t%s" % (self.client_name,msg))
-        if self.logger:
-            self.logger.info(msg)
\ No newline at end of file
+        self.logger.info(msg)
@@ -1,40 +1,145 @@
 from os import replace
 from abc import ABC
 from enum import Enum
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
+import zlib
 
 # Message codes
 # 0x00 - Server Registration Message
 # 0x01 - Status Message
 # 0x02 - Server Quit Message
+# 0x03 - Directory Snapshot Message
+# 0x04 - Directory Version Message
+# 0x05 - Link State Advertisement Message
+# 0x06 - Link Probe Message
+# 0x07 - Flood Message
+# 0x08 - Link Options Message
+# 0x09 - Compressed Message
+# 0x0A - Heartbeat Message
+# 0x0B - Hosts Quit Message
 # 0x80 - User Registration message
 # 0x81 - User Message
 # 0x82 - User Quit Message
+# 0x83 - Channel Join Message
+# 0x84 - Channel Leave Message
+# 0x85 - Channel Publish Message
+
+# The size of the fixed-length header of each message type and a struct format that extracts only the
+# length fields from that header. The full length of a message is its header size plus the sum of the
+# extracted length fields, which lets us find message boundaries before any bytes are decoded.
+MESSAGE_HEADERS = {
+    0x00: (12, "!9xBH"),    # Server Registration Message: ServerNameLength, ServerInfoLength
+    0x01: (15, "!11xI"),    # Status Update Message: MessageLength
+    0x02: (13, "!9xI"),     # Server Quit Message: MessageLength
+    0x03: (14, "!10xI"),    # Directory Snapshot Message: PayloadLength
+    0x04: (22, "!18xI"),    # Directory Version Message: RemovedIDsLength
+    0x05: (17, "!13xI"),    # Link State Advertisement Message: LinksLength
+    0x06: (14, "!"),        # Link Probe Message: fixed length
+    0x07: (17, "!13xI"),    # Flood Message: PayloadLength
+    0x08: (6, "!"),         # Link Options Message: fixed length
+    0x09: (9, "!5xI"),      # Compressed Message: PayloadLength
+    0x0A: (6, "!"),         # Heartbeat Message: fixed length
+    0x0B: (9, "!5xI"),      # Hosts Quit Message: HostIDsLength
+    0x80: (12, "!9xBH"),    # User Registration Message: UserNameLength, UserInfoLength
+    0x81: (13, "!9xI"),     # User Chat Message: MessageLength
+    0x82: (9, "!5xI"),      # User Quit Message: MessageLength
+    0x83: (6, "!5xB"),      # Channel Join Message: ChannelNameLength
+    0x84: (6, "!5xB"),      # Channel Leave Message: ChannelNameLength
+    0x85: (14, "!9xBI"),    # Channel Publish Message: ChannelNameLength, MessageLength
+}
+
 class MessageParser:
     
+    @staticmethod
+    def message_length(data, offset=0):
+        """ Returns the full length of the message that starts at data[offset], or None if not enough bytes
+        have arrived yet to know how long the message is.
+        """
+        code = data[offset]
+        if code not in MESSAGE_HEADERS:
+            raise Exception("Unrecognized message type!!")
+        header_length, length_format = MESSAGE_HEADERS[code]
+        if len(data) - offset < header_length:
+            return None
+        return header_length + sum(unpack_from(length_format, data, offset))
+
+    @staticmethod
+    def split_complete_messages(buffer, max_messages=None):
+        """ Removes every complete message from the front of buffer (a bytearray) and returns them as a 
+        single bytes object. Any trailing partial message is left in the buffer so that it can be completed 
+        by a later read. If max_messages is given, at most that many messages are removed and the rest are 
+        left in the buffer as well.
+        """
+        end = 0
+        count = 0
+        while end < len(buffer) and count != max_messages:
+            length = MessageParser.message_length(buffer, end)
+            if length is None or end + length > len(buffer):
+                break
+            end += length
+            count += 1
+
+        complete = bytes(buffer[:end])
+        del buffer[:end]
+        return complete
+
+    @staticmethod
+    def has_complete_message(buffer):
+        """ Returns True if buffer starts with a complete message """
+        if not buffer:
+            return False
+        length = MessageParser.message_length(buffer)
+        return length is not None and length <= len(buffer)
+
     @staticmethod
     def parse_messages(bytes):
         data = bytes
         messages = []
-        while(len(data) > 0):           
+        offset = 0
+        while(offset < len(data)):
             msg = None
-            code = data[0]
+            code = data[offset]
+            frame = data[offset:offset + MessageParser.message_length(data, offset)]
             if code == 0x00:
-                msg = ServerRegistrationMessage(data)
+                msg = ServerRegistrationMessage(frame)
             elif code == 0x80:
-                msg = ClientRegistrationMessage(data)
+                msg = ClientRegistrationMessage(frame)
             elif code == 0x01:
-                msg =  StatusUpdateMessage(data)
+                msg =  StatusUpdateMessage(frame)
             elif code == 0x81:
-                msg =  ClientChatMessage(data)
-            elif code == 0x01:
-                msg =  ServerQuitMessage(data)
+                msg =  ClientChatMessage(frame)
+            elif code == 0x02:
+                msg =  ServerQuitMessage(frame)
+            elif code == 0x03:
+                msg =  DirectorySnapshotMessage(frame)
+            elif code == 0x04:
+                msg =  DirectoryVersionMessage(frame)
+            elif code == 0x05:
+                msg =  LinkStateAdvertisementMessage(frame)
+            elif code == 0x06:
+                msg =  LinkProbeMessage(frame)
+            elif code == 0x07:
+                msg =  FloodMessage(frame)
+            elif code == 0x08:
+                msg =  LinkOptionsMessage(frame)
+            elif code == 0x09:
+                msg =  CompressedMessage(frame)
+            elif code == 0x0A:
+                msg =  HeartbeatMessage(frame)
+            elif code == 0x0B:
+                msg =  HostsQuitMessage(frame)
             elif code == 0x82:
-                msg =  ClientQuitMessage(data)
+                msg =  ClientQuitMessage(frame)
+            elif code == 0x83:
+                msg =  ChannelJoinMessage(frame)
+            elif code == 0x84:
+                msg =  ChannelLeaveMessage(frame)
+            elif code == 0x85:
+                msg =  ChannelPublishMessage(frame)
             
             if msg:
                 messages.append(msg)
-                data = data[msg.variable_message_length:]
+                offset += msg.variable_message_length
             else:
                 raise Exception("Unrecognized message type!!")
         
@@ -102,7 +207,8 @@ class ClientRegistrationMessage(Message):
 # MessageType (byte = 0x01)
 # SourceID (int)
 # DestinationID (int)
-# MessageCode (half)
+# MessageCode (half): 0x00 welcome, 0x01 unknown ID, 0x02 ID already registered, 0x03 throttled (a message 
+#   was dropped because the client is sending messages faster than the server's rate limit allows)
 # MessageLength (int)
 # MessageString (variable length, UTF-8 encoding)
 class StatusUpdateMessage(Message):
@@ -163,7 +269,7 @@ class ServerQuitMessage(Message):
 
     @staticmethod
     def bytes(source_id, replacement_server_id, content):
-        return pack("!BIII{0}s".format(len(content)), 0x81, source_id, replacement_server_id, len(content), content.encode())
+        return pack("!BIII{0}s".format(len(content)), 0x02, source_id, replacement_server_id, len(content), content.encode())
 
 
 # #### User Quit Message ####
@@ -183,4 +289,320 @@ class ClientQuitMessage(Message):
 
     @staticmethod
     def bytes(source_id, content):
-        return pack("!BII{0}s".format(len(content)), 0x82, source_id, len(content), content.encode())
\ No newline at end of file
+        return pack("!BII{0}s".format(len(content)), 0x82, source_id, len(content), content.encode())
+
+
+# #### Directory Snapshot Message ####
+# MessageType (byte = 0x03)
+# SourceID (int)
+# LastHopID (int)
+# Flags (byte, bit 0 is set if the payload is compressed with zlib)
+# PayloadLength (int)
+# Payload (variable length): the Server and User Registration Messages of every host in the directory, back to
+#   back. The LastHopID field of the registration messages inside the payload is only used by servers using 
+#   link-state routing, where it holds the ID of the server the host is attached to.
+class DirectorySnapshotMessage(Message):
+    COMPRESSED = 0x01
+
+    def __init__(self, bytes):
+        self.message_type = 0x03
+        msg = unpack("!xIIBI", bytes[:14])
+        self.source_id = msg[0]
+        self.last_hop_id = msg[1]
+        self.flags = msg[2]
+        self.payload_length = msg[3]
+        payload = bytes[14:14+self.payload_length]
+        if self.flags & DirectorySnapshotMessage.COMPRESSED:
+            payload = zlib.decompress(payload)
+        self.hosts = DirectorySnapshotMessage.decode_hosts(payload)
+        self.variable_message_length = 14 + self.payload_length
+        self.bytes = bytes[:self.variable_message_length]
+
+    @staticmethod
+    def decode_hosts(payload):
+        """ Decodes every registration message in the payload in a single pass, without creating a message
+        object for each one. Returns a list of (message_type, host_id, name, info, last_hop_id) tuples.
+        """
+        hosts = []
+        offset = 0
+        while offset < len(payload):
+            message_type, host_id, last_hop_id, name_length, info_length = unpack_from("!BIIBH", payload, offset)
+            name_start = offset + 12
+            info_start = name_start + name_length
+            offset = info_start + info_length
+            hosts.append((message_type, host_id, str(payload[name_start:info_start], "utf-8"),
+                          str(payload[info_start:offset], "utf-8"), last_hop_id))
+        return hosts
+
+    @staticmethod
+    def bytes(source_id, last_hop_id, registration_messages, compress=False):
+        flags = 0
+        if compress:
+            registration_messages = zlib.compress(registration_messages)
+            flags |= DirectorySnapshotMessage.COMPRESSED
+        return pack("!BIIBI", 0x03, source_id, last_hop_id, flags, len(registration_messages)) + registration_messages
+
+
+# #### Directory Version Message ####
+# MessageType (byte = 0x04)
+# SourceID (int)
+# Epoch (int): a random number chosen by the source server each time it starts
+# Version (unsigned long long): the number of changes made to the source server's directory since it started
+# Flags (byte):
+#   bit 0 (RESYNC_REQUEST) is set when a restarting server asks the server it is reconnecting to for only the
+#     changes made to its directory since the given epoch and version. The request is sent before the 
+#     restarting server's registration message.
+#   bit 1 (DELTA) is set in the reply to a resync request that could be answered with only the changes. The
+#     IDs of the hosts removed since the requested version follow, and a DirectorySnapshotMessage holding
+#     only the hosts added since then is sent after this message. Without it, the full directory is sent.
+# RemovedIDsLength (int): the length of the RemovedIDs field in bytes
+# RemovedIDs (variable length): the IDs of the hosts removed from the directory, 4 bytes each
+class DirectoryVersionMessage(Message):
+    RESYNC_REQUEST = 0x01
+    DELTA = 0x02
+
+    def __init__(self, bytes):
+        self.message_type = 0x04
+        msg = unpack("!xIIQBI", bytes[:22])
+        self.source_id = msg[0]
+        self.epoch = msg[1]
+        self.version = msg[2]
+        self.flags = msg[3]
+        self.removed_ids_length = msg[4]
+        self.removed_ids = unpack("!{0}I".format(self.removed_ids_length // 4), bytes[22:22+self.removed_ids_length])
+        self.variable_message_length = 22 + self.removed_ids_length
+        self.bytes = bytes[:self.variable_message_length]
+
+    @staticmethod
+    def bytes(source_id, epoch, version, flags=0, removed_ids=()):
+        return pack("!BIIQBI{0}I".format(len(removed_ids)), 0x04, source_id, epoch, version, flags, 
+                    4 * len(removed_ids), *removed_ids)
+
+
+# #### Link State Advertisement Message ####
+# MessageType (byte = 0x05)
+# OriginID (int): the ID of the server whose links are advertised
+# Sequence (unsigned long long): increases every time the origin server advertises its links
+# LinksLength (int): the length of the Links field in bytes
+# Links (variable length): an (adjacent server ID (int), cost (int)) pair for every server adjacent to the 
+#   origin server, 8 bytes each. The cost of a link is its measured round trip time in microseconds.
+class LinkStateAdvertisementMessage(Message):
+    def __init__(self, bytes):
+        self.message_type = 0x05
+        msg = unpack("!xIQI", bytes[:17])
+        self.source_id = msg[0]
+        self.sequence = msg[1]
+        self.links_length = msg[2]
+        costs = unpack("!{0}I".format(self.links_length // 4), bytes[17:17+self.links_length])
+        self.links = dict(zip(costs[0::2], costs[1::2]))
+        self.variable_message_length = 17 + self.links_length
+        self.bytes = bytes[:self.variable_message_length]
+
+    @staticmethod
+    def bytes(origin_id, sequence, links):
+        costs = [value for link in sorted(links.items()) for value in link]
+        return pack("!BIQI{0}I".format(len(costs)), 0x05, origin_id, sequence, 4 * len(costs), *costs)
+
+
+# #### Link Probe Message ####
+# MessageType (byte = 0x06)
+# SourceID (int)
+# Flags (byte, bit 0 is set if this is the reply to a probe)
+# Timestamp (double): the time the probe was sent, in the sender's clock. A reply echoes the probe's timestamp.
+class LinkProbeMessage(Message):
+    REPLY = 0x01
+
+    def __init__(self, bytes):
+        self.message_type = 0x06
+        msg = unpack("!xIBd", bytes[:14])
+        self.source_id = msg[0]
+        self.flags = msg[1]
+        self.timestamp = msg[2]
+        self.variable_message_length = 14
+        self.bytes = bytes[:self.variable_message_length]
+
+    @staticmethod
+    def bytes(source_id, flags, timestamp):
+        return pack("!BIBd", 0x06, source_id, flags, timestamp)
+
+
+# #### Flood Message ####
+# MessageType (byte = 0x07)
+# OriginID (int): the ID of the server that started the flood
+# Sequence (unsigned long long): numbers the floods started by the origin server, so repeats can be detected
+# PayloadLength (int)
+# Payload (variable length): the messages being flooded to every server, back to back
+class FloodMessage(Message):
+    def __init__(self, bytes):
+        self.message_type = 0x07
+        msg = unpack("!xIQI", bytes[:17])
+        self.source_id = msg[0]
+        self.sequence = msg[1]
+        self.payload_length = msg[2]
+        self.payload = bytes[17:17+self.payload_length]
+        self.variable_message_length = 17 + self.payload_length
+        self.bytes = bytes[:self.variable_message_length]
+
+    @staticmethod
+    def bytes(origin_id, sequence, payload):
+        return pack("!BIQI", 0x07, origin_id, sequence, len(payload)) + payload
+
+
+# #### Link Options Message ####
+# MessageType (byte = 0x08)
+# SourceID (int)
+# Flags (byte):
+#   bit 0 (COMPRESSION) asks for, or in a reply agrees to, compressing the messages sent over the link
+#   bit 1 (REPLY) is set in the reply, which only has the bits of the request that were agreed to set
+# A server that opens a link to another server sends this message ahead of its registration message. The other
+# server replies before it sends anything else, so every message after the reply may use the agreed options.
+class LinkOptionsMessage(Message):
+    COMPRESSION = 0x01
+    REPLY = 0x02
+
+    def __init__(self, bytes):
+        self.message_type = 0x08
+        msg = unpack("!xIB", bytes[:6])
+        self.source_id = msg[0]
+        self.flags = msg[1]
+        self.variable_message_length = 6
+        self.bytes = bytes[:self.variable_message_length]
+
+    @staticmethod
+    def bytes(source_id, flags):
+        return pack("!BIB", 0x08, source_id, flags)
+
+
+# #### Compressed Message ####
+# MessageType (byte = 0x09)
+# SourceID (int): the server that compressed the messages
+# PayloadLength (int)
+# Payload (variable length): messages back to back, compressed with the zlib stream of the link they are sent 
+#   over and flushed with Z_SYNC_FLUSH so that the payload decompresses to whole messages. The stream carries 
+#   on from one Compressed Message to the next, so the payloads can only be decompressed in order.
+class CompressedMessage(Message):
+    def __init__(self, bytes):
+        self.message_type = 0x09
+        msg = unpack("!xII", bytes[:9])
+        self.source_id = msg[0]
+        self.payload_length = msg[1]
+        self.payload = bytes[9:9+self.payload_length]
+        self.variable_message_length = 9 + self.payload_length
+        self.bytes = bytes[:self.variable_message_length]
+
+    @staticmethod
+    def bytes(source_id, payload):
+        return pack("!BII", 0x09, source_id, len(payload)) + payload
+
+
+# #### Heartbeat Message ####
+# MessageType (byte = 0x0A)
+# SourceID (int)
+# Flags (byte, bit 0 is set if this is the reply to a heartbeat)
+# Sent by a server over a connection it has not received anything from for a while. Servers and clients 
+# answer every heartbeat, so a connection that stays silent is known to be dead even if it was never closed.
+class HeartbeatMessage(Message):
+    REPLY = 0x01
+
+    def __init__(self, bytes):
+        self.message_type = 0x0A
+        msg = unpack("!xIB", bytes[:6])
+        self.source_id = msg[0]
+        self.flags = msg[1]
+        self.variable_message_length = 6
+        self.bytes = bytes[:self.variable_message_length]
+
+    @staticmethod
+    def bytes(source_id, flags):
+        return pack("!BIB", 0x0A, source_id, flags)
+
+
+# #### Hosts Quit Message ####
+# MessageType (byte = 0x0B)
+# SourceID (int): the server passing the message on
+# HostIDsLength (int): the length of the HostIDs field in bytes
+# HostIDs (variable length): the IDs of the servers and clients that have left the network, 4 bytes each
+# Sent between servers in place of a quit message for every host when the link to an adjacent server closes
+# and every host on the far side of that link becomes unreachable at once.
+class HostsQuitMessage(Message):
+    def __init__(self, bytes):
+        self.message_type = 0x0B
+        msg = unpack("!xII", bytes[:9])
+        self.source_id = msg[0]
+        self.host_ids_length = msg[1]
+        self.host_ids = unpack("!{0}I".format(self.host_ids_length // 4), bytes[9:9+self.host_ids_length])
+        self.variable_message_length = 9 + self.host_ids_length
+        self.bytes = bytes[:self.variable_message_length]
+
+    @staticmethod
+    def bytes(source_id, host_ids):
+        return pack("!BII{0}I".format(len(host_ids)), 0x0B, source_id, 4 * len(host_ids), *host_ids)
+
+
+# #### Channel Join Message ####
+# MessageType (byte = 0x83)
+# SourceID (int): the client joining the channel, or the server telling an adjacent server that it has 
+#   members of the channel behind it
+# ChannelNameLength (byte)
+# ChannelNameString (variable length, UTF-8 encoding)
+class ChannelJoinMessage(Message):
+    def __init__(self, bytes):
+        self.message_type = 0x83
+        msg = unpack("!xIB", bytes[:6])
+        self.source_id = msg[0]
+        self.channel_name_length = msg[1]
+        self.channel = str(bytes[6:6+self.channel_name_length], "utf-8")
+        self.variable_message_length = 6 + self.channel_name_length
+        self.bytes = bytes[:self.variable_message_length]
+
+    @staticmethod
+    def bytes(source_id, channel):
+        channel = channel.encode()
+        return pack("!BIB", 0x83, source_id, len(channel)) + channel
+
+
+# #### Channel Leave Message ####
+# MessageType (byte = 0x84)
+# SourceID (int): the client leaving the channel, or the server telling an adjacent server that it no longer
+#   has members of the channel behind it
+# ChannelNameLength (byte)
+# ChannelNameString (variable length, UTF-8 encoding)
+class ChannelLeaveMessage(ChannelJoinMessage):
+    def __init__(self, bytes):
+        super(ChannelLeaveMessage, self).__init__(bytes)
+        self.message_type = 0x84
+
+    @staticmethod
+    def bytes(source_id, channel):
+        channel = channel.encode()
+        return pack("!BIB", 0x84, source_id, len(channel)) + channel
+
+
+# #### Channel Publish Message ####
+# MessageType (byte = 0x85)
+# SourceID (int): the client that published the message
+# Sequence (int): numbers the messages published by the source client. In link-state mode the client's server
+#   replaces it with its own number, so that repeats can be detected
+# ChannelNameLength (byte)
+# MessageLength (int)
+# ChannelNameString (variable length, UTF-8 encoding)
+# MessageString (variable length, UTF-8 encoding)
+class ChannelPublishMessage(Message):
+    def __init__(self, bytes):
+        self.message_type = 0x85
+        msg = unpack("!xIIBI", bytes[:14])
+        self.source_id = msg[0]
+        self.sequence = msg[1]
+        self.channel_name_length = msg[2]
+        self.content_length = msg[3]
+        content_start = 14 + self.channel_name_length
+        self.channel = str(bytes[14:content_start], "utf-8")
+        self.content = str(bytes[content_start:content_start+self.content_length], "utf-8")
+        self.variable_message_length = content_start + self.content_length
+        self.bytes = bytes[:self.variable_message_length]
+
+    @staticmethod
+    def bytes(source_id, sequence, channel, content):
+        channel = channel.encode()
+        content = content.encode()
+        return pack("!BIIBI", 0x85, source_id, sequence, len(channel), len(content)) + channel + content
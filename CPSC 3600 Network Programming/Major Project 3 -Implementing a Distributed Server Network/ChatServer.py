@@ -3,10 +3,188 @@
 #CPSC 3600
 
 from ChatMessageParser import *
+from CRCMetrics import ServerMetrics, StatsServer
+from CRCLogging import CRCLog
+from LinkStateRouting import LinkStateRouting
+from CRCTimers import TimerWheel
+from CRCSelectors import EdgeTriggeredEpollSelector
 from socket import *
 import os
+import sys
+import time
+import mmap
+import random
+import struct
 import selectors
 import logging
+import collections
+import itertools
+import zlib
+
+# The maximum number of bytes read from a socket in a single recv() call. Reading in large batches lets a 
+# burst of coalesced messages be pulled off the socket in one pass of the select() loop.
+RECV_BATCH_SIZE = 65536
+
+# Each pass of the select() loop reads at most options.read_budget bytes (RECV_BATCH_SIZE by default) from each
+# ready connection and handles at most options.message_budget of the complete messages received from it, so a
+# single busy connection can't hold up every other connection. A connection with messages left over is served
+# again on the next pass, after every other ready connection has had its turn, and is not read from until it
+# has caught up. With options.trunk_priority, links to other servers are served before clients on each pass 
+# and may handle TRUNK_BUDGET_MULTIPLIER times as many messages.
+DEFAULT_MESSAGE_BUDGET = 128
+TRUNK_BUDGET_MULTIPLIER = 4
+
+# The maximum number of separate buffers passed to a single sendmsg() call. The operating system will reject
+# a scatter-gather write with more buffers than its IOV_MAX limit.
+try:
+    SEND_BATCH_BUFFERS = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    SEND_BATCH_BUFFERS = 1024
+
+# Directory snapshots sent to newly connected servers are compressed once they are at least this many bytes
+# long. Smaller snapshots are not worth the time it takes to compress them.
+DIRECTORY_COMPRESSION_THRESHOLD = 4096
+
+# The default number of bytes that may be waiting in a connection's write buffer before the server applies its
+# backpressure policy to the connection, and the number the buffer must drain back down to before the policy 
+# is lifted. Both can be overridden with options.high_watermark and options.low_watermark.
+DEFAULT_HIGH_WATERMARK = 4 * 1024 * 1024
+DEFAULT_LOW_WATERMARK = 1024 * 1024
+
+# Writes to other servers can be held back for a short window so that the messages queued in the meantime 
+# are sent in a single write, which means fewer system calls and fuller TCP segments on busy links between 
+# servers. The window is set in microseconds with options.batch_window_us and is off (0) by default. A batch 
+# is sent early once it holds options.batch_bytes bytes.
+DEFAULT_BATCH_BYTES = 64 * 1024
+
+# TCP_CORK is only available on Linux. With options.tcp_cork, links to other servers are corked while each 
+# batch is written so that the kernel only sends full segments.
+try:
+    TCP_CORK_OPTION = TCP_CORK
+except NameError:
+    TCP_CORK_OPTION = None
+
+# Links between servers can be compressed with options.link_compression. The two servers agree to it with a 
+# LinkOptionsMessage sent ahead of the registration message, and each direction of the link then keeps a single
+# zlib stream for as long as the link is open, so repeated names and text are compressed against everything 
+# sent over the link before them. The messages queued since the previous write are compressed together, unless
+# they add up to fewer than options.link_compression_threshold bytes, in which case they are sent as they are.
+# The zlib compression level can be set with options.link_compression_level.
+DEFAULT_LINK_COMPRESSION_THRESHOLD = 256
+DEFAULT_LINK_COMPRESSION_LEVEL = 6
+
+# With options.heartbeat_interval, a HeartbeatMessage is sent over every connection nothing has been received 
+# from for that many seconds, which the other side answers. With options.idle_timeout, a connection nothing has 
+# been received from for that many seconds is closed, which is how half-open connections whose other end went
+# away without closing them are found. Both are off by default. If only heartbeats are enabled, the idle 
+# timeout defaults to IDLE_TIMEOUT_HEARTBEATS heartbeat intervals.
+IDLE_TIMEOUT_HEARTBEATS = 3
+
+# A link to another server that can't be opened is retried options.connect_retries times (none by default),
+# waiting options.connect_retry_delay seconds before the first retry and twice as long before each retry after
+# that, up to MAX_CONNECT_RETRY_DELAY seconds.
+DEFAULT_CONNECT_RETRY_DELAY = 0.5
+MAX_CONNECT_RETRY_DELAY = 30.0
+
+# The policies a server can apply to a connection whose write buffer has grown past the high watermark:
+# * "pause": stop reading from the connections that are feeding it messages until it drains
+# * "drop": drop any new messages queued for it until it drains
+# * "disconnect": disconnect it
+BACKPRESSURE_POLICIES = ("pause", "drop", "disconnect")
+
+# Chat and channel messages from adjacent clients can be rate limited with token buckets. Each adjacent client
+# gets a bucket that holds up to options.client_burst messages and refills at options.client_rate_limit 
+# messages per second, and all of a server's adjacent clients share a bucket set by options.server_rate_limit 
+# and options.server_burst. A burst defaults to one second's worth of messages. A message that finds either 
+# bucket empty is dropped before it is routed, and the client is sent a status update with the code 
+# THROTTLED_STATUS, once, until one of its messages gets through again.
+THROTTLED_STATUS = 0x03
+
+# The number of directory changes remembered so that a server reconnecting after a restart can be sent only 
+# the changes it missed. A server that missed more changes than this is sent the full directory instead. Can 
+# be overridden with options.changelog_size.
+DEFAULT_CHANGELOG_SIZE = 65536
+
+# How often, in seconds, the directory is saved to options.snapshot_file and its version is announced to 
+# adjacent servers. Can be overridden with options.snapshot_interval.
+DEFAULT_SNAPSHOT_INTERVAL = 30.0
+
+# The header of a directory snapshot file: a magic number, the format version, the ID of the server this server
+# registered with on startup, the epoch and version of that server's directory the snapshot is up to date 
+# with, and the number of hosts. The header is followed by the first_link_id of every host and then by the 
+# registration message of every host, in the same order.
+SNAPSHOT_MAGIC = b"CRCS"
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_HEADER = "!4sBIIQI"
+
+# The ways a server can route messages, selected with options.routing:
+# * "tree": the server network must be a tree. Every host is reached through the adjacent server that told us
+#   about it, and broadcasts are passed on to every adjacent server except the one they came from.
+# * "link_state": the server network may contain cycles. Servers advertise their links and the measured 
+#   latency of each one to each other, route along the shortest paths computed from those advertisements, and
+#   flood broadcasts along a shared spanning tree with duplicate suppression (see LinkStateRouting).
+ROUTING_MODES = ("tree", "link_state")
+
+##############################################################################################################
+
+class SendQueue():
+    """ SendQueue stores the messages that are waiting to be sent over a socket. Each queued message is kept 
+    as its own bytes object instead of being copied onto the end of one large buffer, so queueing a message 
+    never copies the messages already waiting in the queue. The same bytes object can safely be queued for 
+    many sockets at once since bytes objects are immutable.
+
+    When the socket becomes writable, as many queued messages as possible are handed to the operating system 
+    in a single scatter-gather sendmsg() call. If only part of a message is accepted, the remainder is sent 
+    later through a memoryview, which also avoids copying.
+    """
+    def __init__(self):
+        self.messages = collections.deque()     # The messages waiting to be sent, oldest first
+        self.offset = 0                         # The number of bytes of the oldest message already sent
+        self.pending_bytes = 0                  # The total number of bytes still waiting to be sent
+
+    def __len__(self):
+        return self.pending_bytes
+
+    def append(self, message):
+        if message:
+            self.messages.append(message)
+            self.pending_bytes += len(message)
+
+    def extend(self, other):
+        """ Moves every message waiting in another SendQueue onto the end of this queue """
+        if other.offset:
+            self.append(memoryview(other.messages.popleft())[other.offset:])
+        self.messages.extend(other.messages)
+        self.pending_bytes += sum(len(message) for message in other.messages)
+        other.messages.clear()
+        other.offset = 0
+        other.pending_bytes = 0
+
+    def send(self, sock):
+        """ Sends as much of the queue as the socket will accept and removes the sent bytes from the queue.
+
+        Args:
+            sock (socket): the socket to send the queued messages over
+        Returns:
+            int: the number of bytes that were sent
+        """
+        if not self.messages:
+            return 0
+
+        first_message = memoryview(self.messages[0])[self.offset:]
+        if hasattr(sock, "sendmsg"):
+            buffers = [first_message]
+            buffers.extend(itertools.islice(self.messages, 1, SEND_BATCH_BUFFERS))
+            bytes_sent = sock.sendmsg(buffers)
+        else:
+            bytes_sent = sock.send(first_message)
+
+        self.pending_bytes -= bytes_sent
+        remaining = bytes_sent + self.offset
+        while remaining and remaining >= len(self.messages[0]):
+            remaining -= len(self.messages.popleft())
+        self.offset = remaining
+        return bytes_sent
 
 ##############################################################################################################
 
@@ -16,38 +194,148 @@ class BaseConnectionData():
     one representing data associated with a connected server and one representing data associated with a 
     connected client.         
     
-    The fundamental responsibility of classes derived from ConnectionData is to store a write buffer 
-    associated with a particular socket. This server will append messages to be sent to this write buffer and 
-    will then send the messages at a later point when it is possible to do so (i.e. the next time select() is 
-    called by the main loop). This functionality is defined in this base class. Other functionality will be 
-    defined in derived subclasses.
+    The fundamental responsibility of classes derived from ConnectionData is to store a write buffer (a
+    SendQueue) associated with a particular socket. This server will append messages to be sent to this write
+    buffer and will then send the messages at a later point when it is possible to do so (i.e. the next time
+    select() is called by the main loop). This functionality is defined in this base class. Other
+    functionality will be defined in derived subclasses.
+
+    Classes derived from ConnectionData also store a read buffer. TCP does not preserve message boundaries, so
+    a single read may end part way through a message. The bytes of that partial message are kept in the read 
+    buffer until the rest of the message arrives on a later read.
+
+    Finally, classes derived from ConnectionData store the socket they are associated with. The socket is only
+    registered for WRITE events while its write buffer has messages waiting to be sent, and the socket is 
+    needed to change that registration when a message is queued. The socket is also not registered for READ
+    events while reading from it is paused because a connection it feeds messages to has fallen behind.
+
+    These classes define __slots__ so that the many records kept in hosts_db don't each carry a __dict__.
     """    
+    __slots__ = ("write_buffer", "read_buffer", "sock", "congested", "paused_feeders", "paused_by", 
+                 "bytes_received", "bytes_sent", "frames_queued", "writes", "resync_request", "compressor",
+                 "decompressor", "uncompressed_frames", "uncompressed_bytes", "idle_timer", "idle_since", 
+                 "idle_bytes_received")
+
     def __init__(self):
-        self.write_buffer = b''
+        self.write_buffer = SendQueue()
+        self.read_buffer = bytearray()
+        self.sock = None
+        self.congested = False              # True while the write buffer is above the high watermark
+        self.paused_feeders = set()         # The connections we stopped reading from because this one is congested
+        self.paused_by = set()              # The congested connections that reading from this one is paused for
+        self.bytes_received = 0             # The total number of bytes read from the socket
+        self.bytes_sent = 0                 # The total number of bytes written to the socket
+        self.frames_queued = 0              # The total number of messages queued to be sent
+        self.writes = 0                     # The total number of writes made to the socket
+        self.resync_request = None          # The DirectoryVersionMessage a restarting server sent before registering
+        self.compressor = None              # The zlib streams of a compressed link to another server
+        self.decompressor = None
+        self.uncompressed_frames = 0        # The messages queued on a compressed link since the previous write
+        self.uncompressed_bytes = 0
+        self.idle_timer = None              # The timer that checks the connection for heartbeats and idle timeouts
+        self.idle_since = 0                 # When bytes_received was last seen to change by the idle timer
+        self.idle_bytes_received = 0
 
 class ServerConnectionData(BaseConnectionData):
     """ ServerConnectionData encapsulates data associated with a connection to another server. It derives from 
     BaseConnectionData which means it contains a write buffer, in addition to additional properties defined 
     in this class that are specific to connections with other servers.
     """    
+    __slots__ = ("id", "server_name", "server_info", "first_link_id", "registration_message")
+
     def __init__(self, id, server_name, server_info):
         super(ServerConnectionData, self).__init__()
         self.id = id
-        self.server_name = server_name     # Stores the name of the server
+        self.server_name = sys.intern(server_name)  # Stores the name of the server
         self.server_info = server_info     # Stores a human-readable description of the server
         self.first_link_id = None          # The ID of the first host on the path to this server
+        self.registration_message = None   # This server's registration message as this server rebroadcasts it
 
 class ClientConnectionData(BaseConnectionData):    
     """ ClientConnectionData encapsulates data associated with a connection to a client application. It 
     derives from BaseConnectionData which means it contains a write buffer, in addition to additional 
     properties defined in this class that are specific to connections with client applications.
     """
+    __slots__ = ("id", "client_name", "client_info", "first_link_id", "registration_message", "rate_limiter",
+                 "throttled")
+
     def __init__(self, id, client_name, client_info):
         super(ClientConnectionData, self).__init__()
         self.id = id
-        self.client_name = client_name      # Stores the name of the client
+        self.client_name = sys.intern(client_name)  # Stores the name of the client
         self.client_info = client_info      # Stores a human-readable description of the client
         self.first_link_id = None           # The ID of the first host on the path to this client
+        self.registration_message = None    # This client's registration message as this server rebroadcasts it
+        self.rate_limiter = None            # The client's TokenBucket, if clients are rate limited
+        self.throttled = False              # True once the client has been told it is being throttled
+
+class RemoteServerData(ServerConnectionData):
+    """ RemoteServerData stores a server that is not adjacent to this server. Messages are never sent to a 
+    remote server directly, only to the adjacent host on the path to it, so a remote server has no socket 
+    and none of the buffers or counters that go with one. Those attributes are left unset, which keeps these
+    records small in a network with many servers. It derives from ServerConnectionData so that 
+    isinstance(host, ServerConnectionData) is still True for every server in hosts_db.
+    """
+    __slots__ = ()
+
+    def __init__(self, id, server_name, server_info, first_link_id):
+        self.id = id
+        self.server_name = sys.intern(server_name)
+        self.server_info = server_info
+        self.first_link_id = first_link_id
+        self.registration_message = None
+
+class RemoteClientData(ClientConnectionData):
+    """ RemoteClientData stores a client that is not adjacent to this server. See RemoteServerData. """
+    __slots__ = ()
+
+    def __init__(self, id, client_name, client_info, first_link_id):
+        self.id = id
+        self.client_name = sys.intern(client_name)
+        self.client_info = client_info
+        self.first_link_id = first_link_id
+        self.registration_message = None
+
+class ChannelData():
+    """ ChannelData stores what a server knows about the members of a channel. A server does not know every 
+    member of a channel, only which of its adjacent clients are members and which of its links to adjacent 
+    servers lead to members. A message published to the channel is therefore sent once over each of those 
+    links and is only copied for each member by the member's own server.
+    """
+    __slots__ = ("name", "local_members", "member_links", "joined_links")
+
+    def __init__(self, name):
+        self.name = sys.intern(name)
+        self.local_members = set()          # The IDs of the adjacent clients that are members of the channel
+        self.member_links = set()           # The IDs of the adjacent servers that have members behind them
+        self.joined_links = set()           # The IDs of the adjacent servers we have told we have members
+
+class TokenBucket():
+    """ TokenBucket limits the rate of messages from a client (or from all of a server's clients). The bucket
+    holds up to burst tokens and gains rate tokens every second. Each message takes a token, and a message 
+    that finds the bucket empty is refused, so messages can arrive in bursts of up to burst messages but not
+    faster than rate messages per second on average.
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """ Takes a token from the bucket if it has one. Returns True if it did. """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self):
+        """ Puts back a token taken for a message that was refused anyway, e.g. by another bucket. """
+        self.tokens = min(self.burst, self.tokens + 1)
 
 ##############################################################################################################
 
@@ -58,11 +346,22 @@ class CRCServer(object):
         * self.hosts_db (dictionary): this dictionary should be used to store information about all other 
             servers and clients that this server knows about. The key should be the remote machine's ID and 
             the value should be its corresponding ServerConnectionData or ClientConnectionData that you create
-            when processing the remote machine's Registration Message.
-        * self.adjacent_server_ids (list): this list should store the IDs of all adjacent servers. You can use
-            this list to find the appropriate ServerConnectionData objects stored in self.hosts_db when needed
-        * self.adjacent_client_ids (list): this list should store the IDs of all adjacent clients. It serves
-            the same purpose as self.adjacent_server_ids except for client machines.
+            when processing the remote machine's Registration Message. Hosts that are not adjacent to this
+            server are stored as the smaller RemoteServerData and RemoteClientData records.
+        * self.routes (dictionary): this dictionary maps the ID of every known host straight to the 
+            ServerConnectionData or ClientConnectionData of the adjacent machine that is the next hop on the 
+            path to that host. It is updated whenever a host registers or quits so that forwarding a message
+            only takes a single lookup. Use set_route() and remove_route() to change it.
+        * self.routed_hosts (dictionary): the reverse of self.routes. It maps the connection data object of
+            each adjacent server to the set of IDs of the other hosts that are reached through it, so that
+            every host cut off by a closed link can be found without scanning self.routes.
+        * self.adjacent_server_ids (dictionary): this dictionary maps the ID of every adjacent server to its
+            ServerConnectionData, in the order the servers connected. Broadcasts iterate over its values to
+            queue messages without looking each server up in self.hosts_db, and checking whether a host is an
+            adjacent server, or removing one, is a single dictionary operation.
+        * self.adjacent_user_ids (dictionary): this dictionary maps the ID of every adjacent client to its
+            ClientConnectionData, in the order the clients connected. It serves the same purpose as
+            self.adjacent_server_ids except for client machines.
         * self.status_updates_log (list): the message of any status updates addressed to this server should be
             placed in this list. This is purely for the purpose of grading.
         * self.id (int): the ID of this server. It is initialized upon class instantiation.
@@ -89,7 +388,14 @@ class CRCServer(object):
         """
 
         # TODO: Create your selector and store it in self.sel
-        self.sel = selectors.DefaultSelector()
+        # With options.edge_triggered, sockets are registered with epoll in edge-triggered mode, where available
+        # (see CRCSelectors.EdgeTriggeredEpollSelector). options.epoll_max_events sets how many events are 
+        # taken from the kernel in each pass of the select() loop.
+        self.edge_triggered = getattr(options, "edge_triggered", False) and EdgeTriggeredEpollSelector is not None
+        if self.edge_triggered:
+            self.sel = EdgeTriggeredEpollSelector(getattr(options, "epoll_max_events", None))
+        else:
+            self.sel = selectors.DefaultSelector()
 
         # The following four variables will be used to track information about the state of the network
         # -----------------------------------------------------------------------------
@@ -100,16 +406,147 @@ class CRCServer(object):
         # ServerData or ClientData object should be set to the id number of that Server or Client.
         self.hosts_db = {}
 
-        # This list should contain the ids of all servers that are directly connected to this server.
-        self.adjacent_server_ids = []
+        # This dictionary maps the ID of every known host to the connection data object of the adjacent 
+        # server or client that messages to that host should be sent to (i.e. the next hop)
+        self.routes = {}
+
+        # This dictionary maps the connection data object of each adjacent server to the set of IDs of the 
+        # hosts (other than the server itself) that self.routes sends through it
+        self.routed_hosts = {}
+
+        # This dictionary maps the ids of all servers that are directly connected to this server to their
+        # ServerConnectionData objects. Dictionaries keep their insertion order and support O(1) membership
+        # tests and removals, which lists do not.
+        self.adjacent_server_ids = {}
 
-        # This list should contain the ids of all clients that are directly connected to this server 
-        self.adjacent_user_ids = []
+        # This dictionary maps the ids of all clients that are directly connected to this server to their
+        # ClientConnectionData objects
+        self.adjacent_user_ids = {}
         
         # Store the content of all status messages directed to this server in this list. This is purely 
         # for grading purposes
         self.status_updates_log = []
 
+        # Every host's registration message is packed once, when it registers, and is kept with the host's
+        # data object. These variables cache the registration messages of all known servers and of all known 
+        # clients joined into a single buffer, which is what a newly connected machine needs to be told. They 
+        # are reset to None whenever a server or client joins or leaves the network.
+        self.server_directory_cache = None
+        self.client_directory_cache = None
+        self.directory_snapshot_cache = None
+
+        # The directory (self.hosts_db) is versioned so that a server reconnecting after a restart only needs 
+        # to be sent the changes it missed. Every host that joins or leaves increments self.directory_version 
+        # and is recorded in self.directory_changelog as a (version, host ID, added) tuple. The changelog does
+        # not survive a restart, so a new epoch is chosen every time the server starts.
+        self.directory_epoch = random.getrandbits(32)
+        self.directory_version = 0
+        self.directory_changelog = collections.deque(
+            maxlen=getattr(options, "changelog_size", None) or DEFAULT_CHANGELOG_SIZE)
+        self.announced_directory_version = 0
+
+        # The ID of the server this server registered with on startup, and the epoch and version of that 
+        # server's directory that this server is up to date with
+        self.upstream_id = None
+        self.upstream_epoch = 0
+        self.upstream_version = 0
+
+        # If options.snapshot_file is set, the directory is saved to that file every snapshot_interval seconds
+        # and is loaded from it when the server restarts (see save_snapshot() and load_snapshot()). Hosts 
+        # loaded from the snapshot wait in self.restored_hosts until the server this server registered with 
+        # says whether they are still up to date.
+        self.snapshot_file = getattr(options, "snapshot_file", None)
+        self.snapshot_interval = getattr(options, "snapshot_interval", None) or DEFAULT_SNAPSHOT_INTERVAL
+        self.restored_hosts = None
+        self.upstream_connection = None         # The data object of the connection opened on startup
+
+        # In link-state mode, self.link_state holds the link state database and the routes computed from it, 
+        # and self.current_flood is the FloodMessage whose payload is being handled, if any. Extra links to 
+        # other servers, which make the network a mesh rather than a tree, are opened on startup to the ports
+        # in options.peer_ports.
+        self.routing = getattr(options, "routing", None) or "tree"
+        if self.routing not in ROUTING_MODES:
+            raise ValueError("Unknown routing mode: %s" % self.routing)
+        self.link_state = None
+        if self.routing == "link_state":
+            self.link_state = LinkStateRouting(options.id, getattr(options, "link_probe_interval", None), 
+                                               getattr(options, "seen_cache_size", None), 
+                                               getattr(options, "seen_cache_ttl", None))
+        self.current_flood = None
+        self.peer_ports = list(getattr(options, "peer_ports", None) or [])
+
+        # This dictionary maps the names of the channels that have members anywhere in the network to their 
+        # ChannelData objects
+        self.channels = {}
+
+        # Backpressure settings used to stop a slow reader's write buffer from growing without limit. See 
+        # BACKPRESSURE_POLICIES for the available policies.
+        self.high_watermark = getattr(options, "high_watermark", None) or DEFAULT_HIGH_WATERMARK
+        self.low_watermark = getattr(options, "low_watermark", None) or DEFAULT_LOW_WATERMARK
+        self.backpressure_policy = getattr(options, "backpressure_policy", None) or "pause"
+        if self.backpressure_policy not in BACKPRESSURE_POLICIES:
+            raise ValueError("Unknown backpressure policy: %s" % self.backpressure_policy)
+        self.current_io_device = None                   # The io_device of the message currently being handled
+        self.pending_disconnects = []                   # Congested connections waiting to be disconnected
+        self.dropped_messages = 0                       # Messages dropped by the "drop" policy
+        self.backpressure_events = 0                    # Times a connection has crossed the high watermark
+
+        # Rate limiting of messages from adjacent clients (see THROTTLED_STATUS)
+        self.client_rate_limit = getattr(options, "client_rate_limit", None)
+        self.client_burst = getattr(options, "client_burst", None)
+        self.server_rate_limiter = None
+        if getattr(options, "server_rate_limit", None):
+            self.server_rate_limiter = TokenBucket(options.server_rate_limit, getattr(options, "server_burst", None))
+        self.throttled_messages = 0                     # Messages dropped by the rate limits
+
+        # Fair scheduling of reads (see DEFAULT_MESSAGE_BUDGET). self.ready_connections maps the socket of every 
+        # connection that has received messages which have not been handled yet to its data object, in the 
+        # order the connections will be served.
+        self.read_budget = getattr(options, "read_budget", None) or RECV_BATCH_SIZE
+        self.message_budget = getattr(options, "message_budget", None) or DEFAULT_MESSAGE_BUDGET
+        self.trunk_priority = getattr(options, "trunk_priority", False)
+        self.ready_connections = {}
+        self.exhausted_budgets = 0                      # Times a connection had messages left over
+
+        # Counters and latency histograms updated on the hot path. If options.stats_port is set, they are 
+        # served as JSON over HTTP on that port of the loopback interface (see CRCMetrics.StatsServer).
+        self.metrics = ServerMetrics()
+        self.stats_port = getattr(options, "stats_port", None)
+        self.stats_server = None
+
+        # Batching of writes to adjacent servers. self.pending_batches maps the data object of every server 
+        # link whose writes are being held back to when its batch is due to be sent, in that order.
+        self.batch_window = (getattr(options, "batch_window_us", None) or 0) / 1000000
+        self.batch_bytes = getattr(options, "batch_bytes", None) or DEFAULT_BATCH_BYTES
+        self.pending_batches = {}
+        self.tcp_nodelay = getattr(options, "tcp_nodelay", False)
+        self.tcp_cork = getattr(options, "tcp_cork", False) and TCP_CORK_OPTION is not None
+
+        # Compression of links to adjacent servers, and the number of bytes compressed and the number they 
+        # were compressed to
+        self.link_compression = getattr(options, "link_compression", False)
+        self.link_compression_level = (getattr(options, "link_compression_level", None)
+                                       or DEFAULT_LINK_COMPRESSION_LEVEL)
+        self.link_compression_threshold = (getattr(options, "link_compression_threshold", None) 
+                                           or DEFAULT_LINK_COMPRESSION_THRESHOLD)
+        self.compression_input_bytes = 0
+        self.compression_output_bytes = 0
+
+        # Everything the server does at a later time (checkpoints, link probes, heartbeats, idle timeouts and
+        # retries) is scheduled on self.timers, and select() waits until the next timer is due instead of 
+        # waking up at a fixed interval. The testing application sets request_terminate from another thread, 
+        # which wakes select() up through self.wakeup_sender.
+        self.timers = TimerWheel()
+        self.terminate_requested = False
+        self.wakeup_socket = None
+        self.wakeup_sender = None
+        self.heartbeat_interval = getattr(options, "heartbeat_interval", None)
+        self.idle_timeout = getattr(options, "idle_timeout", None) or (
+            IDLE_TIMEOUT_HEARTBEATS * self.heartbeat_interval if self.heartbeat_interval else None)
+        self.idle_disconnects = 0                       # Connections closed by the idle timeout
+        self.evicted_hosts = 0                          # Hosts removed because the link to them closed
+        self.connect_retries = getattr(options, "connect_retries", None) or 0
+        self.connect_retry_delay = getattr(options, "connect_retry_delay", None) or DEFAULT_CONNECT_RETRY_DELAY
 
         # Do not change the contents of any variables in __init__ below this line
         # -----------------------------------------------------------------------------
@@ -134,15 +571,41 @@ class CRCServer(object):
             # Message handlers
             0x00:self.handle_server_registration_message,
             0x01:self.handle_status_message,
+            0x03:self.handle_directory_snapshot_message,
+            0x04:self.handle_directory_version_message,
+            0x05:self.handle_link_state_advertisement_message,
+            0x06:self.handle_link_probe_message,
+            0x07:self.handle_flood_message,
+            0x08:self.handle_link_options_message,
+            0x09:self.handle_compressed_message,
+            0x0A:self.handle_heartbeat_message,
+            0x0B:self.handle_hosts_quit_message,
             0x80:self.handle_client_registration_message,
             0x81:self.handle_client_chat_message,
             0x82:self.handle_client_quit_message,
+            0x83:self.handle_channel_join_message,
+            0x84:self.handle_channel_leave_message,
+            0x85:self.handle_channel_publish_message,
         }
 
         self.log_file = options.log_file                # The log file output will be written to
+        self.log_level = getattr(options, "log_level", None)   # The lowest level of message that is logged
+        self.log_queue = getattr(options, "log_queue", False)  # Write the log from a background thread
         self.logger = None                              # The logger initialized in self.init_logging()
         self.init_logging()                             # Setup and begin logging functionality
 
+    # The testing application sets request_terminate from another thread. Setting it wakes up the event loop, 
+    # which would otherwise wait in select() until its next timer is due.
+    @property
+    def request_terminate(self):
+        return self.terminate_requested
+
+    @request_terminate.setter
+    def request_terminate(self, value):
+        self.terminate_requested = value
+        if value:
+            self.wake_up()
+
 ##############################################################################################################
 
     def run(self):
@@ -226,6 +689,19 @@ class CRCServer(object):
         """
         if not self.connect_to_port:
             return  # No server to connect to, so return early
+        self.connect_to_upstream()
+        for peer_port in self.peer_ports:
+            self.connect_to_peer(peer_port)
+
+    def connect_to_upstream(self, attempt=0):
+        """ Opens the link to the remote server this server registers with on startup (see 
+        connect_to_server()). If the link can't be opened, it is retried later.
+
+        Args:
+            attempt (int): the number of times opening the link has already failed
+        Returns:
+            None        
+        """
         self.print_info("Connecting to remote server %s:%i..." % (self.connect_to_host, self.connect_to_port))
 
         try:
@@ -234,23 +710,62 @@ class CRCServer(object):
             server_socket.connect((self.connect_to_host_addr, self.connect_to_port))
             server_socket.setblocking(False)
 
-            # Register the socket with the selector for read and write events
+            # Register the socket with the selector. It starts out registered for write events as well since
+            # the registration message is waiting to be sent.
             data = ServerConnectionData(self.id, self.server_name, self.server_info)
-            
+            data.sock = server_socket
 
-            # Send a Server Registrtation Message 
-            server_registration_message = ServerRegistrationMessage.bytes(
-                self.id,
-                0,
-                self.server_name,
-                self.server_info
-            )
-            # Append the message to the write buffer
-            data.write_buffer += server_registration_message
-            self.sel.register(server_socket, selectors.EVENT_READ | selectors.EVENT_WRITE, data)
+            # Send a Server Registrtation Message, preceded by a resync request if we are restarting
+            data.write_buffer.append(self.server_startup_messages())
+            self.sel.register(server_socket, self.io_device_events(data), data)
+            self.upstream_connection = data
+            self.watch_connection(data)
             self.print_info("Server registration message queued for sending.")
         except Exception as e:
             self.print_info(f"Failed to connect to remote server: {e}")
+            self.retry_connection(attempt, self.connect_to_upstream)
+
+    def connect_to_peer(self, port, attempt=0):
+        """ Opens an extra link to another server in the network, which registers with it like any other 
+        server. This is only useful in link-state mode, where the server network may contain cycles. If the
+        link can't be opened, it is retried later.
+
+        Args:
+            port (int): the port of the server to connect to
+            attempt (int): the number of times opening the link has already failed
+        Returns:
+            None        
+        """
+        self.print_info("Connecting to peer server %s:%i..." % (self.connect_to_host_addr, port))
+        try:
+            peer_socket = socket(AF_INET, SOCK_STREAM)
+            peer_socket.connect((self.connect_to_host_addr, port))
+            peer_socket.setblocking(False)
+            data = ServerConnectionData(self.id, self.server_name, self.server_info)
+            data.sock = peer_socket
+            registration = ServerRegistrationMessage.bytes(self.id, 0, self.server_name, self.server_info)
+            data.write_buffer.append(self.link_options_message() + registration)
+            self.sel.register(peer_socket, self.io_device_events(data), data)
+            self.watch_connection(data)
+        except Exception as e:
+            self.print_info(f"Failed to connect to peer server: {e}")
+            self.retry_connection(attempt, self.connect_to_peer, port)
+
+    def retry_connection(self, attempt, connect, *args):
+        """ Schedules another attempt at opening a link to another server, waiting twice as long after each 
+        failed attempt. Gives up once the link has been retried self.connect_retries times.
+
+        Args:
+            attempt (int): the number of times opening the link has already failed, not counting this time
+            connect (function): the method that opens the link, which is passed the attempt number last
+        Returns:
+            None        
+        """
+        if attempt >= self.connect_retries:
+            return
+        delay = min(self.connect_retry_delay * 2 ** attempt, MAX_CONNECT_RETRY_DELAY)
+        self.print_info("Retrying in %.1f seconds" % delay)
+        self.schedule_timer(delay, connect, *args, attempt + 1)
 
 
 
@@ -282,17 +797,33 @@ class CRCServer(object):
             None        
         """
         self.print_info("Listening for new connections on port " + str(self.port))
+        self.start_stats_server()
+        self.wakeup_socket, self.wakeup_sender = socketpair()
+        self.wakeup_sender.setblocking(False)
+        self.sel.register(self.wakeup_socket, selectors.EVENT_READ, None)
+        self.start_timers()
         
         try:
             while not self.request_terminate:
-                events = self.sel.select(timeout=0.1)  # Use a short timeout to check for termination
+                # Wait until the next timer is due, unless there are messages left over from the last pass
+                events = self.sel.select(timeout=0 if self.ready_connections else self.select_timeout())
+                self.run_periodic_tasks()
+                self.flush_due_batches()
+                if not events and not self.ready_connections:
+                    continue
+                start = time.perf_counter()
                 for key, event_mask in events:
-                    if key.data == None:
+                    if key.fileobj is self.wakeup_socket:
+                        self.wakeup_socket.recv(RECV_BATCH_SIZE)
+                    elif key.data == None:
                         self.accept_new_connection(key)
                     else:
                         self.handle_io_device_events(key, event_mask)
+                self.handle_ready_connections()
+                self.disconnect_pending_connections()
+                self.metrics.loop_iteration.record(time.perf_counter() - start)
         except Exception as e:
-            self.print_info(f"Error in main loop: {e}")
+            self.print_error("Error in main loop: %s", e)
         finally:
             if self.request_terminate:
                 self.cleanup()
@@ -319,6 +850,8 @@ class CRCServer(object):
             None        
         """
         self.print_info("Cleaning up the server")
+        self.stop_stats_server()
+        self.save_snapshot()
         keys = list(self.sel._fd_to_key.values())
 
         # Close and unregister all sockets
@@ -327,13 +860,21 @@ class CRCServer(object):
             self.sel.unregister(key.fileobj)
         self.sel.close()
 
+        # Sockets that are paused and have nothing to write are not registered with the selector
+        for host in list(self.adjacent_server_ids.values()) + list(self.adjacent_user_ids.values()):
+            if host.sock is not None:
+                host.sock.close()
+        if self.wakeup_sender is not None:
+            self.wakeup_sender.close()
+        self.logger.close()
+
     def accept_new_connection(self, io_device):
         """ This function is responsible for handling new connection requests from other servers and from 
         clients. This function should be called from self.check_IO_devices_for_messages whenever the listening 
         socket has data that can be read.
         
-        TODO: Accept the connection request and register it with your selector. All sockets registered here  
-            should be registered for both READ and WRITE events. 
+        TODO: Accept the connection request and register it with your selector. Sockets registered here are 
+            only registered for READ events until there is a message waiting to be written to them.
 
         NOTE: You don't know at this point whether new connection requests are comming from a new server or a  
             new client (you'll find that out when processing the registration message sent over the connected  
@@ -351,11 +892,17 @@ class CRCServer(object):
             # Accept the incoming connection and get the client address
             conn, addr = io_device.fileobj.accept()
             conn.setblocking(False)
-            # Register the new connection socket with the selector for READ and WRITE events
+            # Register the new connection socket with the selector for READ events
             selector_data = BaseConnectionData()
-            selector_data.write_buffer = b''
-            self.sel.register(conn, selectors.EVENT_READ | selectors.EVENT_WRITE, selector_data)
+            selector_data.sock = conn
+            self.sel.register(conn, self.io_device_events(selector_data), selector_data)
+            self.watch_connection(selector_data)
             self.print_info(f"Accepted new connection from {addr}")
+            if self.edge_triggered:
+                # More connections may be waiting, and the selector won't report them until another arrives
+                self.sel.keep_ready(io_device.fileobj, selectors.EVENT_READ)
+        except BlockingIOError:
+            pass                # Every waiting connection has been accepted
         except Exception as e:
             self.print_info(f"Error accepting new connection: {e}")
 
@@ -386,27 +933,110 @@ class CRCServer(object):
         Returns:
             None        
         """
-        # Handle READ event
-        if event_mask & selectors.EVENT_READ:
-            received_data = io_device.fileobj.recv(1024)
+        # Handle READ event. A connection that still has messages left over from the last pass is not read 
+        # from until they have been handled. An edge-triggered selector has to be told to report such a 
+        # connection again, and also one that may have more bytes waiting than were read.
+        if event_mask & selectors.EVENT_READ and io_device.fileobj in self.ready_connections:
+            if self.edge_triggered:
+                self.sel.keep_ready(io_device.fileobj, selectors.EVENT_READ)
+        elif event_mask & selectors.EVENT_READ:
+            try:
+                received_data = io_device.fileobj.recv(self.read_budget)
+            except BlockingIOError:
+                received_data = None        # Kept ready by an edge-triggered selector, but nothing was left
             if received_data:
-                self.handle_messages(io_device, received_data)
-            else:
+                io_device.data.bytes_received += len(received_data)
+                # The messages are handled once every ready socket has been read from (see 
+                # handle_ready_connections()). A trailing partial message stays in the read buffer until the 
+                # rest of it arrives.
+                io_device.data.read_buffer += received_data
+                self.ready_connections[io_device.fileobj] = io_device.data
+                if self.edge_triggered and len(received_data) == self.read_budget:
+                    self.sel.keep_ready(io_device.fileobj, selectors.EVENT_READ)
+            elif received_data is not None:
                 self.print_info(f"Connection closed by peer: {io_device.fileobj.getpeername()}")
                 self.sel.unregister(io_device.fileobj)
                 io_device.fileobj.close()
+                self.handle_connection_closed(io_device.data)
+                return
         # Handle WRITE event
         if event_mask & selectors.EVENT_WRITE:
-            buffer = io_device.data.write_buffer
-            if buffer:
-                # Send the contents of the write buffer
-                bytes_sent = io_device.fileobj.send(buffer)
-                io_device.data.write_buffer = buffer[bytes_sent:]
+            if io_device.data.write_buffer:
+                # Send as much of the write buffer as the socket will accept. Whatever is left over stays
+                # queued until the next write event. An edge-triggered selector only reports the socket again 
+                # once a full send buffer has room, so keep writing until it is full or nothing is left.
+                cork = self.tcp_cork and isinstance(io_device.data, ServerConnectionData)
+                self.compress_write_buffer(io_device.data)
+                if cork:
+                    self.set_cork(io_device.fileobj, True)
+                while True:
+                    try:
+                        io_device.data.bytes_sent += io_device.data.write_buffer.send(io_device.fileobj)
+                    except BlockingIOError:
+                        break
+                    io_device.data.writes += 1
+                    if not (self.edge_triggered and io_device.data.write_buffer):
+                        break
+                if cork:
+                    self.set_cork(io_device.fileobj, False)
+            if io_device.data.congested and len(io_device.data.write_buffer) <= self.low_watermark:
+                self.relieve_backpressure(io_device.data)
+            if not io_device.data.write_buffer:
+                # Nothing is left to send, so stop asking the selector about write events on this socket
+                self.update_io_device_events(io_device.data)
 
     
 
 
     
+    def handle_ready_connections(self):
+        """ Handles the messages received from every connection in self.ready_connections, up to each 
+        connection's message budget, in the order the connections became ready. With self.trunk_priority, 
+        links to other servers are served first. Connections that have messages left over go to the back of
+        self.ready_connections to be served again on the next pass of the select() loop.
+
+        Args:
+            None
+        Returns:
+            None        
+        """
+        ready_connections = self.ready_connections
+        self.ready_connections = {}
+        ready_sockets = ready_connections
+        if self.trunk_priority:
+            ready_sockets = sorted(ready_connections, 
+                                   key=lambda sock: not isinstance(ready_connections[sock], ServerConnectionData))
+        for sock in ready_sockets:
+            try:
+                io_device = self.sel.get_key(sock)
+            except (KeyError, ValueError):
+                continue            # Closed, or paused and unregistered (see relieve_backpressure())
+            if io_device.data.paused_by:
+                continue
+            if self.handle_read_buffer(io_device):
+                self.ready_connections[sock] = io_device.data
+
+    def handle_read_buffer(self, io_device):
+        """ Handles as many of the complete messages waiting in a connection's read buffer as its message 
+        budget allows.
+
+        Args:
+            io_device (SelectorKey): the io_device whose read buffer should be handled
+        Returns:
+            bool: True if complete messages are still waiting in the read buffer
+        """
+        budget = self.message_budget
+        if self.trunk_priority and isinstance(io_device.data, ServerConnectionData):
+            budget *= TRUNK_BUDGET_MULTIPLIER
+        read_buffer = io_device.data.read_buffer
+        complete_messages = MessageParser.split_complete_messages(read_buffer, budget)
+        if complete_messages:
+            self.handle_messages(io_device, complete_messages)
+        if MessageParser.has_complete_message(read_buffer):
+            self.exhausted_budgets += 1
+            return True
+        return False
+
     def handle_messages(self, io_device, recv_data):
         """ This function is responsible for parsing the received bytes into separate messages and then 
         passing each of the received messages to the appropriate message handler. Message parsing is offloaded
@@ -425,12 +1055,427 @@ class CRCServer(object):
         messages = MessageParser.parse_messages(recv_data)
 
         for message in messages:
-             # If we recognize the command, then process it using the assigned message handler
-            if message.message_type in self.message_handlers:
-                self.print_info("Received msg from Host ID #%s \"%s\"" % (message.source_id, message.bytes))
-                self.message_handlers[message.message_type](io_device, message)
+            self.handle_message(io_device, message)
+            # A registration message replaces the data object associated with this socket, so make sure the 
+            # next message is handled with the up to date io_device. A socket that has been paused is not 
+            # registered with the selector, but then its data object has not changed either.
+            try:
+                io_device = self.sel.get_key(io_device.fileobj)
+            except KeyError:
+                pass
+
+    def handle_message(self, io_device, message):
+        """ This function passes a single parsed message to the appropriate message handler.
+
+        Args:
+            io_device (SelectorKey): the io_device the message was received on
+            message (Message): the parsed message
+        Returns:
+            None        
+        """
+        # If we recognize the command, then process it using the assigned message handler
+        self.current_io_device = io_device
+        if message.message_type in self.message_handlers:
+            start = time.perf_counter()
+            self.logger.info("Received msg from Host ID #%s \"%s\"", message.source_id, message.bytes)
+            self.message_handlers[message.message_type](io_device, message)
+            self.metrics.record_message(message, time.perf_counter() - start)
+        else:
+            raise Exception("Unrecognized command: " + message)
+
+    def replace_connection_data(self, io_device, new_data):
+        """ Replaces the data object associated with a socket once we learn what kind of machine is on the 
+        other side of it. Any bytes still waiting in the old data object's read and write buffers are moved
+        to the new data object so that partially received messages and queued messages are not lost.
+
+        Args:
+            io_device (SelectorKey): the io_device whose associated data object is being replaced
+            new_data (BaseConnectionData): the new data object to associate with the socket
+        Returns:
+            None        
+        """
+        new_data.read_buffer = io_device.data.read_buffer
+        io_device.data.write_buffer.extend(new_data.write_buffer)
+        new_data.write_buffer = io_device.data.write_buffer
+        new_data.sock = io_device.data.sock
+        new_data.bytes_received = io_device.data.bytes_received
+        new_data.bytes_sent = io_device.data.bytes_sent
+        new_data.frames_queued = io_device.data.frames_queued
+        new_data.writes = io_device.data.writes
+        new_data.compressor = io_device.data.compressor
+        new_data.decompressor = io_device.data.decompressor
+        new_data.uncompressed_frames = io_device.data.uncompressed_frames
+        new_data.uncompressed_bytes = io_device.data.uncompressed_bytes
+        if io_device.data.idle_timer is not None:
+            io_device.data.idle_timer.cancel()
+            self.watch_connection(new_data)
+        self.flush_batch(io_device.data)
+
+        # Carry over any backpressure state, including the references other connections hold to the old object
+        new_data.congested = io_device.data.congested
+        new_data.paused_feeders = io_device.data.paused_feeders
+        new_data.paused_by = io_device.data.paused_by
+        for feeder in new_data.paused_feeders:
+            feeder.paused_by.discard(io_device.data)
+            feeder.paused_by.add(new_data)
+        for congested in new_data.paused_by:
+            congested.paused_feeders.discard(io_device.data)
+            congested.paused_feeders.add(new_data)
+
+        self.sel.modify(io_device.fileobj, self.io_device_events(new_data), new_data)
+        if isinstance(new_data, ServerConnectionData):
+            self.tune_server_link(new_data)
+
+    def io_device_events(self, connection_data):
+        """ Returns the selector events a socket should be registered for. Every socket is registered for READ
+        events, but a socket is only registered for WRITE events while its write buffer has messages waiting 
+        to be sent. Writable sockets are almost always ready, so registering idle sockets for WRITE events 
+        would wake the select() loop over and over again with nothing to do.
+
+        Args:
+            connection_data (BaseConnectionData): the data object associated with the socket
+        Returns:
+            int: the selector event mask for the socket
+        """
+        events = 0 if connection_data.paused_by else selectors.EVENT_READ
+        if connection_data.write_buffer:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def update_io_device_events(self, connection_data):
+        """ Updates the selector events a socket is registered for after its write buffer has changed between
+        being empty and having messages waiting to be sent. Hosts that are not adjacent to this server have no
+        socket, so there is nothing to update for them.
+
+        A socket that is neither being read from nor written to is unregistered from the selector until it is
+        needed again, since a selector cannot watch a socket for no events.
+
+        Args:
+            connection_data (BaseConnectionData): the data object associated with the socket
+        Returns:
+            None        
+        """
+        if connection_data.sock is None:
+            return
+        events = self.io_device_events(connection_data)
+        registered = connection_data.sock in self.sel.get_map()
+        if events and registered:
+            self.sel.modify(connection_data.sock, events, connection_data)
+        elif events:
+            self.sel.register(connection_data.sock, events, connection_data)
+        elif registered:
+            self.sel.unregister(connection_data.sock)
+
+    def queue_message(self, connection_data, message):
+        """ Appends a message to a connection's write buffer. If the write buffer was empty, the connection's 
+        socket is registered for WRITE events so that the message is sent the next time select() is called.
+        If the write buffer is above the high watermark, the server's backpressure policy is applied instead.
+        Writes to adjacent servers are held back for self.batch_window seconds if batching is enabled.
+
+        Args:
+            connection_data (BaseConnectionData): the data object associated with the destination socket
+            message (bytes): the packed message to be delivered
+        Returns:
+            None        
+        """
+        if connection_data.congested or len(connection_data.write_buffer) >= self.high_watermark:
+            if not self.apply_backpressure(connection_data):
+                return
+
+        was_idle = not connection_data.write_buffer
+        connection_data.write_buffer.append(message)
+        connection_data.frames_queued += 1
+        if connection_data.compressor is not None and message:
+            connection_data.uncompressed_frames += 1
+            connection_data.uncompressed_bytes += len(message)
+        if was_idle:
+            if self.batch_window and isinstance(connection_data, ServerConnectionData):
+                self.start_batch(connection_data)
             else:
-                raise Exception("Unrecognized command: " + message)
+                self.update_io_device_events(connection_data)
+        elif len(connection_data.write_buffer) >= self.batch_bytes and connection_data in self.pending_batches:
+            self.flush_batch(connection_data)
+
+    def start_batch(self, connection_data):
+        """ Holds back the writes to an adjacent server until self.batch_window seconds from now. The select()
+        loop sends the batch once it is due (see flush_due_batches()).
+        """
+        self.pending_batches[connection_data] = time.monotonic() + self.batch_window
+
+    def flush_batch(self, connection_data):
+        """ Stops holding back the writes to an adjacent server, so that its batch is sent the next time its
+        socket is writable
+        """
+        if self.pending_batches.pop(connection_data, False) is not False:
+            self.update_io_device_events(connection_data)
+
+    def flush_due_batches(self):
+        """ Sends every batch whose window has ended. Every batch is held back for the same length of time,
+        so the batches are due in the order they were started.
+        """
+        if not self.pending_batches:
+            return
+        now = time.monotonic()
+        while self.pending_batches:
+            connection_data, due = next(iter(self.pending_batches.items()))
+            if due > now:
+                break
+            self.flush_batch(connection_data)
+
+    def select_timeout(self):
+        """ Returns how long select() may wait: until the next timer or the next batch is due, whichever is
+        sooner. select() is woken up early if the server is asked to terminate.
+        """
+        timeout = self.timers.time_until_next()
+        if self.pending_batches:
+            batch_timeout = max(0, next(iter(self.pending_batches.values())) - time.monotonic())
+            timeout = batch_timeout if timeout is None else min(timeout, batch_timeout)
+        return timeout
+
+    def wake_up(self):
+        """ Wakes the event loop up from another thread """
+        if self.wakeup_sender is not None:
+            try:
+                self.wakeup_sender.send(b'\0')
+            except OSError:
+                pass            # Already woken up, or already closed
+
+    def schedule_timer(self, delay, callback, *args):
+        """ Schedules callback(*args) to be called by the event loop once delay seconds have passed.
+
+        Args:
+            delay (float): how long to wait, in seconds
+            callback (function): the function to call
+        Returns:
+            Timer: the scheduled timer, which can be cancelled
+        """
+        return self.timers.schedule(delay, callback, *args)
+
+    def start_timers(self):
+        """ Schedules the timers that keep running for as long as the server does. Called when the event loop
+        starts.
+        """
+        self.schedule_timer(self.snapshot_interval, self.checkpoint)
+        if self.link_state is not None:
+            self.schedule_timer(self.link_state.probe_interval, self.probe_links)
+
+    def watch_connection(self, connection_data):
+        """ Starts checking a new connection for heartbeats and idle timeouts, if they are enabled """
+        connection_data.idle_since = time.monotonic()
+        connection_data.idle_bytes_received = connection_data.bytes_received
+        if self.heartbeat_interval or self.idle_timeout:
+            connection_data.idle_timer = self.schedule_timer(self.heartbeat_interval or self.idle_timeout, 
+                                                             self.check_idle_connection, connection_data)
+
+    def check_idle_connection(self, connection_data):
+        """ Runs on the timer of every adjacent connection. A heartbeat is sent over a connection that 
+        nothing has been received from for self.heartbeat_interval seconds, and the connection is closed once
+        nothing has been received from it for self.idle_timeout seconds. Comparing bytes_received with its
+        value the last time the timer ran means that reading from a connection never touches its timer.
+
+        Args:
+            connection_data (BaseConnectionData): the data object of the connection
+        Returns:
+            None        
+        """
+        connection_data.idle_timer = None
+        if connection_data.sock is None:
+            return
+        now = time.monotonic()
+        if connection_data.bytes_received != connection_data.idle_bytes_received:
+            connection_data.idle_bytes_received = connection_data.bytes_received
+            connection_data.idle_since = now
+        idle = now - connection_data.idle_since
+
+        if self.idle_timeout and idle >= self.idle_timeout:
+            self.print_info("Disconnecting Host ID #%s since nothing has been received from it for %.1f seconds"
+                            % (getattr(connection_data, "id", None), idle))
+            self.idle_disconnects += 1
+            self.close_connection(connection_data)
+            return
+        if self.heartbeat_interval and idle >= self.heartbeat_interval:
+            self.queue_message(connection_data, HeartbeatMessage.bytes(self.id, 0))
+
+        delay = self.heartbeat_interval or self.idle_timeout
+        if self.idle_timeout:
+            delay = min(delay, self.idle_timeout - idle)
+        connection_data.idle_timer = self.schedule_timer(delay, self.check_idle_connection, connection_data)
+
+    def tune_server_link(self, connection_data):
+        """ Applies options.tcp_nodelay to the socket of a new link to an adjacent server. Batching and the
+        select() loop already coalesce small messages, so Nagle's algorithm only adds delay on these links.
+        """
+        sock = self.link_socket(connection_data)
+        if self.tcp_nodelay and sock is not None:
+            try:
+                sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            except OSError:
+                pass            # Not a TCP socket (e.g. a link between the workers of a sharded server)
+
+    def set_cork(self, sock, corked):
+        if sock is None:
+            return
+        try:
+            sock.setsockopt(IPPROTO_TCP, TCP_CORK_OPTION, 1 if corked else 0)
+        except OSError:
+            pass
+
+    def link_socket(self, connection_data):
+        """ Returns the socket of a connection, so that socket options can be set on it """
+        return connection_data.sock
+
+    def compress_write_buffer(self, connection_data):
+        """ Called just before a connection's write buffer is written. If the connection is a compressed link,
+        the messages queued since the previous write are replaced by a single CompressedMessage, unless they 
+        are too small to be worth compressing. Every earlier message has already been compressed or has been 
+        left as it is, and may already be partly sent.
+
+        Args:
+            connection_data (BaseConnectionData): the data object of the connection about to be written to
+        Returns:
+            None        
+        """
+        frames = connection_data.uncompressed_frames
+        uncompressed_bytes = connection_data.uncompressed_bytes
+        connection_data.uncompressed_frames = 0
+        connection_data.uncompressed_bytes = 0
+        if not frames or uncompressed_bytes < self.link_compression_threshold:
+            return
+
+        messages = connection_data.write_buffer.messages
+        uncompressed = [messages.pop() for _ in range(frames)]
+        uncompressed.reverse()
+        uncompressed = b''.join(uncompressed)
+        compressor = connection_data.compressor
+        compressed = CompressedMessage.bytes(self.id, compressor.compress(uncompressed) 
+                                             + compressor.flush(zlib.Z_SYNC_FLUSH))
+        connection_data.write_buffer.pending_bytes -= len(uncompressed)
+        connection_data.write_buffer.append(compressed)
+        self.compression_input_bytes += len(uncompressed)
+        self.compression_output_bytes += len(compressed)
+
+    def link_options_message(self):
+        """ Returns the LinkOptionsMessage sent ahead of the registration message on every link this server 
+        opens to another server, or nothing if there are no options to ask for
+        """
+        if not self.link_compression:
+            return b''
+        return LinkOptionsMessage.bytes(self.id, LinkOptionsMessage.COMPRESSION)
+
+    def start_link_compression(self, connection_data):
+        connection_data.compressor = zlib.compressobj(self.link_compression_level)
+        connection_data.decompressor = zlib.decompressobj()
+
+    def apply_backpressure(self, connection_data):
+        """ Applies the server's backpressure policy to a connection whose write buffer is above the high 
+        watermark. With the "pause" policy, the connection the current message was received from stops being 
+        read from until the congested connection's write buffer drains below the low watermark.
+
+        Args:
+            connection_data (BaseConnectionData): the data object of the congested connection
+        Returns:
+            bool: True if the message being queued should still be queued        
+        """
+        if not connection_data.congested:
+            connection_data.congested = True
+            self.backpressure_events += 1
+            self.print_info("Write buffer of Host ID #%s is above the high watermark (%i bytes)"
+                            % (getattr(connection_data, "id", None), len(connection_data.write_buffer)))
+
+        if self.backpressure_policy == "drop":
+            self.dropped_messages += 1
+            return False
+        if self.backpressure_policy == "disconnect":
+            if connection_data not in self.pending_disconnects:
+                self.pending_disconnects.append(connection_data)
+            return False
+
+        feeder = self.current_io_device.data if self.current_io_device else None
+        if feeder is not None and feeder is not connection_data and feeder not in connection_data.paused_feeders:
+            connection_data.paused_feeders.add(feeder)
+            feeder.paused_by.add(connection_data)
+            self.update_io_device_events(feeder)
+        return True
+
+    def relieve_backpressure(self, connection_data):
+        """ Lifts the backpressure policy from a connection once its write buffer has drained below the low
+        watermark (or the connection has closed) and resumes reading from every connection that was paused
+        because of it.
+
+        Args:
+            connection_data (BaseConnectionData): the data object of the connection that is no longer congested
+        Returns:
+            None        
+        """
+        connection_data.congested = False
+        for feeder in connection_data.paused_feeders:
+            feeder.paused_by.discard(connection_data)
+            if not feeder.paused_by:
+                self.update_io_device_events(feeder)
+                self.resume_ready_connection(feeder)
+        connection_data.paused_feeders.clear()
+
+    def resume_ready_connection(self, connection_data):
+        """ Puts a connection that is no longer paused back in self.ready_connections if messages it received
+        before it was paused are still waiting to be handled.
+        """
+        if connection_data.sock is not None and MessageParser.has_complete_message(connection_data.read_buffer):
+            self.ready_connections[connection_data.sock] = connection_data
+
+    def disconnect_pending_connections(self):
+        """ Disconnects the connections the "disconnect" backpressure policy was applied to. This is done after
+        all of the messages being handled have been handled, rather than in the middle of a broadcast. 
+        """
+        while self.pending_disconnects:
+            connection_data = self.pending_disconnects.pop()
+            if connection_data.sock is not None:
+                self.print_info("Disconnecting Host ID #%s since it is not reading its messages"
+                                % getattr(connection_data, "id", None))
+                self.close_connection(connection_data)
+
+    def close_connection(self, connection_data):
+        """ Closes the socket of a connection from this server's side and cleans up after it """
+        if connection_data.sock in self.sel.get_map():
+            self.sel.unregister(connection_data.sock)
+        connection_data.sock.close()
+        self.handle_connection_closed(connection_data)
+
+    def queue_depths(self):
+        """ Returns the number of bytes waiting in the write buffer of every adjacent server and client, which
+        shows which connections are slow to read their messages.
+
+        Args:
+            None
+        Returns:
+            dict: maps the ID of each adjacent host to the number of bytes waiting to be sent to it
+        """
+        depths = {}
+        for host_id, host in itertools.chain(self.adjacent_server_ids.items(), self.adjacent_user_ids.items()):
+            depths[host_id] = len(host.write_buffer)
+        return depths
+
+    def metrics_snapshot(self):
+        """ Returns this server's current metrics (message rates, message handling latency, select() loop 
+        iteration time, and the bytes read, written, and queued for every adjacent host) as a dictionary.
+        """
+        return self.metrics.snapshot(self)
+
+    def start_stats_server(self):
+        """ Starts serving this server's metrics over HTTP if options.stats_port was set """
+        if self.stats_port is None or self.stats_server is not None:
+            return
+        try:
+            self.stats_server = StatsServer(self, self.stats_port)
+            self.stats_server.start()
+            self.print_info(f"Serving metrics on http://127.0.0.1:{self.stats_server.port}/")
+        except OSError as e:
+            self.stats_server = None
+            self.print_info(f"Failed to start the metrics server: {e}")
+
+    def stop_stats_server(self):
+        if self.stats_server is not None:
+            self.stats_server.stop()
+            self.stats_server = None
 
 ##############################################################################################################
 
@@ -447,11 +1492,65 @@ class CRCServer(object):
         Returns:
             None        
         """
-        if destination_id in self.hosts_db:
-            self.print_info("Sending message to Host ID #%s \"%s\"" % (destination_id, message))
-            self.hosts_db[destination_id].write_buffer += message
+        next_hop = self.routes.get(destination_id)
+        if next_hop is not None:
+            self.logger.info("Sending message to Host ID #%s \"%s\"", destination_id, message)
+            self.queue_message(next_hop, message)
+
 
 
+    def add_route(self, host_id, host_data):
+        """ Adds the route to a newly registered host to self.routes. An adjacent host is its own next hop. Any
+        other host is reached through the same next hop as the adjacent server that told us about it 
+        (host_data.first_link_id).
+
+        In link-state mode the first_link_id of a host that is not adjacent is instead its home server (the 
+        server itself, or the server the client is connected to), and the host is reached through the adjacent
+        server on the shortest path to its home. Hosts whose home can't be reached yet are left without a 
+        route until recompute_routes() finds one.
+
+        Args:
+            host_id (int): the ID of the newly registered host
+            host_data (BaseConnectionData): the host's ServerConnectionData or ClientConnectionData
+        Returns:
+            None        
+        """
+        if self.link_state is not None and isinstance(host_data, (RemoteServerData, RemoteClientData)):
+            next_hop_id = self.link_state.next_hops.get(host_data.first_link_id)
+            if next_hop_id in self.adjacent_server_ids:
+                self.set_route(host_id, self.adjacent_server_ids[next_hop_id])
+        elif host_data.first_link_id == host_id:
+            self.set_route(host_id, host_data)
+        elif host_data.first_link_id in self.routes:
+            self.set_route(host_id, self.routes[host_data.first_link_id])
+
+    def set_route(self, host_id, next_hop):
+        """ Sends messages for a host through the given adjacent host, and keeps self.routed_hosts up to date.
+
+        Args:
+            host_id (int): the ID of the host
+            next_hop (BaseConnectionData): the connection data object of the adjacent host
+        Returns:
+            None        
+        """
+        previous_hop = self.routes.get(host_id)
+        if previous_hop is next_hop:
+            return
+        if previous_hop is not None:
+            self.remove_route(host_id)
+        self.routes[host_id] = next_hop
+        if next_hop.id != host_id:
+            self.routed_hosts.setdefault(next_hop, set()).add(host_id)
+
+    def remove_route(self, host_id):
+        """ Removes the route to a host from self.routes and self.routed_hosts, if it has one. """
+        next_hop = self.routes.pop(host_id, None)
+        if next_hop is not None and next_hop.id != host_id:
+            routed_hosts = self.routed_hosts.get(next_hop)
+            if routed_hosts is not None:
+                routed_hosts.discard(host_id)
+                if not routed_hosts:
+                    del self.routed_hosts[next_hop]
 
     def broadcast_message_to_servers(self, message, ignore_host_id=None):
         """ This is a helper function meant to encapsulate the code needed to broadcast a message to the 
@@ -475,9 +1574,34 @@ class CRCServer(object):
         Returns:
             None        
         """
-        for adjacent_server_id in self.adjacent_server_ids:
+        if self.link_state is not None:
+            # A message handled from a flood is passed on by handle_flood_message() instead
+            if self.current_flood is None:
+                self.flood_message_to_servers(message)
+            return
+        for adjacent_server_id, adjacent_server in self.adjacent_server_ids.items():
             if adjacent_server_id != ignore_host_id:
-                self.send_message_to_host(adjacent_server_id, message)
+                self.queue_message(adjacent_server, message)
+
+    def flood_message_to_servers(self, message, arrival_id=None):
+        """ Sends a FloodMessage to this server's neighbours in the broadcast spanning tree, except the one it 
+        arrived from. A server that is not in the tree yet (because the advertisements of its links have not 
+        reached every server) sends the flood to all of its adjacent servers instead. Repeats are discarded by
+        handle_flood_message(), so the flood still ends even if the servers disagree about the tree for a 
+        moment.
+
+        Args:
+            message (bytes): a packed FloodMessage, or the packed messages to start a new flood with
+            arrival_id (int): the ID of the adjacent server the flood arrived from, if any
+        Returns:
+            None        
+        """
+        if arrival_id is None:
+            message = FloodMessage.bytes(self.id, self.link_state.next_flood_sequence(), message)
+        neighbour_ids = self.link_state.tree_neighbours or self.adjacent_server_ids
+        for server_id in neighbour_ids:
+            if server_id != arrival_id and server_id in self.adjacent_server_ids:
+                self.queue_message(self.adjacent_server_ids[server_id], message)
 
 
 
@@ -498,9 +1622,9 @@ class CRCServer(object):
         Returns:
             None        
         """
-        for adjacent_client_id in self.adjacent_user_ids:
+        for adjacent_client_id, adjacent_client in self.adjacent_user_ids.items():
             if adjacent_client_id != ignore_host_id:
-                self.send_message_to_host(adjacent_client_id, message)
+                self.queue_message(adjacent_client, message)
 
     def send_message_to_unknown_io_device(self, io_device, message):
         """ The ID of a machine becomes known once it successfully registers with the network. In the event 
@@ -520,8 +1644,487 @@ class CRCServer(object):
         Returns:
             None        
         """
-        self.print_info("Sending message to an unknown IO device \"%s\"" % (message))
-        io_device.data.write_buffer += message
+        self.logger.info("Sending message to an unknown IO device \"%s\"", message)
+        self.queue_message(io_device.data, message)
+
+    def handle_connection_closed(self, connection_data):
+        """ This function cleans up after the socket connected to an adjacent machine has been closed. A client
+        that disconnects without sending a quit message is removed from the network as if it had quit. When an
+        adjacent server disconnects, every server and client that was reached through that server is removed 
+        from the network at once (see evict_hosts()).
+
+        Args:
+            connection_data (BaseConnectionData): the data object associated with the closed socket
+        Returns:
+            None        
+        """
+        self.ready_connections.pop(connection_data.sock, None)
+        connection_data.sock = None
+        self.pending_batches.pop(connection_data, None)
+        if connection_data.idle_timer is not None:
+            connection_data.idle_timer.cancel()
+            connection_data.idle_timer = None
+        self.relieve_backpressure(connection_data)
+        for congested in list(connection_data.paused_by):
+            congested.paused_feeders.discard(connection_data)
+        connection_data.paused_by.clear()
+        host_id = getattr(connection_data, "id", None)
+        if self.adjacent_user_ids.get(host_id) is connection_data:
+            self.remove_clients([host_id])
+        elif self.adjacent_server_ids.get(host_id) is connection_data:
+            del self.adjacent_server_ids[host_id]
+            self.update_channel_links()
+            if self.link_state is not None:
+                self.remove_server_link(connection_data)
+                return
+            # Every host on the far side of the link is now unreachable. Forget the server itself too, so that
+            # it can register again if it restarts.
+            host_ids = self.routed_hosts.pop(connection_data, set())
+            if self.hosts_db.get(host_id) is connection_data:
+                host_ids.add(host_id)
+            self.evict_hosts(host_ids, ignore_host_id=host_id)
+
+    def server_directory(self):
+        """ Returns the registration messages of every known server joined into a single buffer. The buffer is
+        cached until the next time a server joins the network.
+
+        Args:
+            None
+        Returns:
+            bytes: the registration messages of every known server
+        """
+        if self.server_directory_cache is None:
+            self.server_directory_cache = b''.join(host.registration_message for host in self.hosts_db.values() 
+                                                   if isinstance(host, ServerConnectionData))
+        return self.server_directory_cache
+
+    def client_directory(self):
+        """ Returns the registration messages of every known client joined into a single buffer. The buffer is
+        cached until the next time a client joins or leaves the network.
+
+        Args:
+            None
+        Returns:
+            bytes: the registration messages of every known client
+        """
+        if self.client_directory_cache is None:
+            self.client_directory_cache = b''.join(host.registration_message for host in self.hosts_db.values() 
+                                                   if isinstance(host, ClientConnectionData))
+        return self.client_directory_cache
+
+    def directory_snapshot(self):
+        """ Returns a DirectorySnapshotMessage containing every known server and client. This is sent to newly 
+        connected servers in place of one registration message per host. The message is cached until the next
+        time a host joins or leaves the network, and is compressed if it is large.
+
+        Args:
+            None
+        Returns:
+            bytes: the packed DirectorySnapshotMessage
+        """
+        if self.directory_snapshot_cache is None:
+            registration_messages = self.server_directory() + self.client_directory()
+            self.directory_snapshot_cache = DirectorySnapshotMessage.bytes(
+                self.id, self.id, registration_messages, 
+                len(registration_messages) >= DIRECTORY_COMPRESSION_THRESHOLD)
+        return self.directory_snapshot_cache
+
+    def record_directory_change(self, host, added):
+        """ Records that a host has joined or left the network. This advances the directory version, adds the
+        change to the changelog, and resets the cached directory buffers that include the host.
+
+        Args:
+            host (BaseConnectionData): the ServerConnectionData or ClientConnectionData of the host
+            added (bool): True if the host joined the network, False if it left
+        Returns:
+            None        
+        """
+        self.directory_version += 1
+        self.directory_changelog.append((self.directory_version, host.id, added))
+        if isinstance(host, ServerConnectionData):
+            self.server_directory_cache = None
+        else:
+            self.client_directory_cache = None
+        self.directory_snapshot_cache = None
+
+    def directory_resync(self, resync_request=None):
+        """ Returns the messages that bring a newly registered adjacent server's directory up to date. This is
+        normally a DirectoryVersionMessage followed by the full directory snapshot. If the server sent a resync
+        request for a version of this server's directory that the changelog still covers, only the IDs of 
+        the hosts removed since that version and a snapshot of the hosts added since then are sent.
+
+        Args:
+            resync_request (DirectoryVersionMessage): the resync request the server sent, if any
+        Returns:
+            bytes: the packed messages
+        """
+        base_version = self.directory_changelog[0][0] - 1 if self.directory_changelog else self.directory_version
+        if (resync_request is None or resync_request.epoch != self.directory_epoch 
+            or not base_version <= resync_request.version <= self.directory_version):
+            return (DirectoryVersionMessage.bytes(self.id, self.directory_epoch, self.directory_version) 
+                    + self.directory_snapshot())
+
+        added_ids = {}                          # Used as an ordered set
+        removed_ids = set()
+        for version, host_id, added in itertools.islice(self.directory_changelog, 
+                                                        resync_request.version - base_version, None):
+            if added:
+                added_ids[host_id] = None
+            else:
+                removed_ids.add(host_id)
+                added_ids.pop(host_id, None)
+        self.print_info("Resyncing Host ID #%s from directory version %i: %i hosts added, %i removed"
+                        % (resync_request.source_id, resync_request.version, len(added_ids), len(removed_ids)))
+
+        messages = DirectoryVersionMessage.bytes(self.id, self.directory_epoch, self.directory_version, 
+                                                 DirectoryVersionMessage.DELTA, sorted(removed_ids))
+        registration_messages = b''.join(self.hosts_db[host_id].registration_message for host_id in added_ids 
+                                         if host_id in self.hosts_db)
+        if registration_messages:
+            messages += DirectorySnapshotMessage.bytes(self.id, self.id, registration_messages, 
+                                                       len(registration_messages) >= DIRECTORY_COMPRESSION_THRESHOLD)
+        return messages
+
+    def server_startup_messages(self):
+        """ Returns the messages sent to the remote server this server registers with on startup. If a snapshot
+        of the directory was saved before this server restarted, it is loaded and a resync request is sent 
+        ahead of the registration message so that only the changes made since the snapshot are sent back.
+        """
+        messages = ServerRegistrationMessage.bytes(self.id, 0, self.server_name, self.server_info)
+        if self.load_snapshot():
+            messages = DirectoryVersionMessage.bytes(self.id, self.upstream_epoch, self.upstream_version, 
+                                                     DirectoryVersionMessage.RESYNC_REQUEST) + messages
+        return self.link_options_message() + messages
+
+    def checkpoint(self):
+        """ Runs every self.snapshot_interval seconds. If the directory has changed, its new version is 
+        announced to the adjacent servers so that they know how up to date a snapshot they take is. The 
+        directory is then saved to the snapshot file.
+        """
+        self.schedule_timer(self.snapshot_interval, self.checkpoint)
+        if self.directory_version != self.announced_directory_version:
+            self.announced_directory_version = self.directory_version
+            version_message = DirectoryVersionMessage.bytes(self.id, self.directory_epoch, self.directory_version)
+            for adjacent_server in self.adjacent_server_ids.values():
+                self.queue_message(adjacent_server, version_message)
+        self.save_snapshot()
+
+    def run_periodic_tasks(self):
+        """ Called by the event loop every time it wakes up. Runs every timer that is due. """
+        self.timers.run()
+
+    def probe_links(self):
+        """ Runs every link_state.probe_interval seconds in link-state mode. Probes the adjacent servers to 
+        measure the latency of each link, and removes the servers that have been unreachable for too long.
+        """
+        self.schedule_timer(self.link_state.probe_interval, self.probe_links)
+        probe = LinkProbeMessage.bytes(self.id, 0, time.monotonic())
+        for adjacent_server in self.adjacent_server_ids.values():
+            self.queue_message(adjacent_server, probe)
+        unreachable_server_ids = self.link_state.unreachable_servers()
+        if unreachable_server_ids:
+            self.remove_unreachable_hosts(unreachable_server_ids)
+
+    def save_snapshot(self):
+        """ Saves every known host, its first_link_id, and the version of the upstream server's directory 
+        they are up to date with to self.snapshot_file. The registration messages are written exactly as they 
+        are cached, so saving a snapshot does not encode anything. A snapshot is only useful to a server that
+        has an upstream server to resync with.
+        """
+        if not self.snapshot_file or self.upstream_id is None:
+            return
+        hosts = list(self.hosts_db.values())
+        temporary_file = self.snapshot_file + ".tmp"
+        try:
+            with open(temporary_file, "wb") as f:
+                f.write(struct.pack(SNAPSHOT_HEADER, SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, self.upstream_id, 
+                                    self.upstream_epoch, self.upstream_version, len(hosts)))
+                f.write(struct.pack("!%iI" % len(hosts), *(host.first_link_id for host in hosts)))
+                f.writelines(host.registration_message for host in hosts)
+            os.replace(temporary_file, self.snapshot_file)
+        except OSError as e:
+            self.print_error("Failed to save the directory snapshot: %s", e)
+
+    def load_snapshot(self):
+        """ Loads the hosts saved in self.snapshot_file. The file is memory-mapped and the registration 
+        messages are decoded straight out of the mapping. Only the hosts reached through the upstream server 
+        are kept, since every other connection this server had was lost when it stopped.
+
+        Args:
+            None
+        Returns:
+            bool: True if a snapshot was loaded
+        """
+        if not self.snapshot_file or not os.path.exists(self.snapshot_file):
+            return False
+        try:
+            with open(self.snapshot_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+                magic, format_version, upstream_id, upstream_epoch, upstream_version, host_count = \
+                    struct.unpack_from(SNAPSHOT_HEADER, snapshot)
+                if magic != SNAPSHOT_MAGIC or format_version != SNAPSHOT_FORMAT_VERSION:
+                    self.print_error("%s is not a directory snapshot", self.snapshot_file)
+                    return False
+                offset = struct.calcsize(SNAPSHOT_HEADER)
+                first_link_ids = struct.unpack_from("!%iI" % host_count, snapshot, offset)
+                with memoryview(snapshot) as view, view[offset + 4 * host_count:] as registration_messages:
+                    hosts = DirectorySnapshotMessage.decode_hosts(registration_messages)
+        except (OSError, ValueError, struct.error) as e:
+            self.print_error("Failed to load the directory snapshot: %s", e)
+            return False
+
+        self.upstream_id = upstream_id
+        self.upstream_epoch = upstream_epoch
+        self.upstream_version = upstream_version
+        self.restored_hosts = [host for host, first_link_id in zip(hosts, first_link_ids) 
+                               if first_link_id == upstream_id and host[1] not in (upstream_id, self.id)]
+        self.print_info("Loaded %i hosts from the directory snapshot %s"
+                        % (len(self.restored_hosts), self.snapshot_file))
+        return True
+
+    def remove_clients(self, client_ids, ignore_host_id=None):
+        """ This function removes many clients from the network at once, e.g. when the server they were 
+        connected through disappears. Each client is removed from self.hosts_db, self.routes and 
+        self.adjacent_user_ids, and a quit message for every client is broadcast to the rest of the network. 
+        The quit messages are packed into a single buffer that is queued once for each adjacent machine 
+        rather than once per client.
+
+        Args:
+            client_ids (list): the IDs of the clients to remove
+            ignore_host_id (int): the ID of a host that the quit messages should not be delivered to
+        Returns:
+            None        
+        """
+        quit_messages = []
+        for client_id in client_ids:
+            client = self.hosts_db.pop(client_id, None)
+            if client is not None:
+                self.remove_route(client_id)
+                if self.adjacent_user_ids.pop(client_id, None) is not None:
+                    self.leave_all_channels(client_id)
+                self.record_directory_change(client, False)
+                quit_messages.append(ClientQuitMessage.bytes(client_id, "Connection lost"))
+
+        if quit_messages:
+            quit_messages = b''.join(quit_messages)
+            self.broadcast_message_to_servers(quit_messages, ignore_host_id=ignore_host_id)
+            self.broadcast_message_to_adjacent_clients(quit_messages, ignore_host_id=ignore_host_id)
+
+    def evict_hosts(self, host_ids, ignore_host_id=None):
+        """ Removes servers and clients that were cut off from this server when the link to an adjacent 
+        server closed. Each host is removed from self.hosts_db and self.routes. The rest of the network is told
+        about all of them with a single HostsQuitMessage, and since clients only understand quit messages for
+        clients, every adjacent client is sent a ClientQuitMessage for each client that was removed, packed 
+        into a single buffer.
+
+        Args:
+            host_ids (iterable): the IDs of the hosts to remove
+            ignore_host_id (int): the ID of the server that the HostsQuitMessage should not be sent to
+        Returns:
+            list: the IDs of the hosts that were removed
+        """
+        removed_ids = []
+        quit_messages = []
+        for host_id in host_ids:
+            host = self.hosts_db.pop(host_id, None)
+            if host is None:
+                continue
+            self.remove_route(host_id)
+            self.record_directory_change(host, False)
+            removed_ids.append(host_id)
+            if isinstance(host, ClientConnectionData):
+                quit_messages.append(ClientQuitMessage.bytes(host_id, "Connection lost"))
+
+        if removed_ids:
+            self.evicted_hosts += len(removed_ids)
+            self.print_info("Removed %i hosts that can no longer be reached" % len(removed_ids))
+            self.broadcast_message_to_servers(HostsQuitMessage.bytes(self.id, removed_ids), ignore_host_id)
+        if quit_messages:
+            self.broadcast_message_to_adjacent_clients(b''.join(quit_messages))
+        return removed_ids
+
+    def advertised_last_hop(self, host):
+        """ Returns the last_hop_id this server writes into a host's registration message when passing it on. 
+        In tree mode this is this server's ID, as the protocol requires. In link-state mode it is the ID of 
+        the host's home server: the server itself, or the server the client is connected to. Every server 
+        routes to a host through the shortest path to its home, so the home has to travel with the host.
+
+        Args:
+            host (BaseConnectionData): the host's ServerConnectionData or ClientConnectionData
+        Returns:
+            int: the last_hop_id of the host's registration message
+        """
+        if self.link_state is None:
+            return self.id
+        if isinstance(host, ServerConnectionData):
+            return host.id
+        if isinstance(host, RemoteClientData):
+            return host.first_link_id
+        return self.id
+
+    def add_server_link(self, io_device, message):
+        """ Adds a link to a server that is already known through another path. This happens in link-state 
+        mode when a server opens an extra link to this server (see connect_to_peer()), or when this server 
+        opened one and the other server replies. The server's record becomes a full ServerConnectionData 
+        record associated with the new connection, but since the server is not new to the network nothing is
+        broadcast about it.
+
+        Args:
+            io_device (SelectorKey): the io_device the registration message was received on
+            message (ServerRegistrationMessage): the registration message received over the new link
+        Returns:
+            None        
+        """
+        remote_server = self.hosts_db[message.source_id]
+        server = ServerConnectionData(message.source_id, message.server_name, message.server_info)
+        server.first_link_id = message.source_id
+        server.registration_message = remote_server.registration_message
+        self.replace_connection_data(io_device, server)
+        self.hosts_db[message.source_id] = server
+        self.set_route(message.source_id, server)
+        if message.last_hop_id == 0:
+            self.queue_message(server, ServerRegistrationMessage.bytes(self.id, message.source_id, 
+                                                                       self.server_name, self.server_info))
+        self.adjacent_server_ids[message.source_id] = server
+        self.print_info("Added a link to Host ID #%s" % message.source_id)
+        self.add_link_state_adjacency(server)
+
+    def remove_server_link(self, server):
+        """ Handles the loss of the link to an adjacent server in link-state mode. The server may still be 
+        reachable through other links, so it stays in the directory as a remote server. The new set of links
+        is advertised, and the server and the hosts behind it are removed by remove_unreachable_hosts() 
+        if they stay unreachable.
+
+        Args:
+            server (ServerConnectionData): the data object of the closed connection
+        Returns:
+            None        
+        """
+        if self.hosts_db.get(server.id) is server:
+            remote_server = RemoteServerData(server.id, server.server_name, server.server_info, server.id)
+            remote_server.registration_message = server.registration_message
+            self.hosts_db[server.id] = remote_server
+            self.remove_route(server.id)
+        self.link_state.measured_costs.pop(server.id, None)
+        self.originate_link_state_advertisement()
+
+    def add_link_state_adjacency(self, server):
+        """ Sends every advertisement in the link state database to a newly adjacent server, so that it can 
+        compute routes right away, and then advertises this server's new set of links.
+        """
+        for origin_id, (sequence, links) in self.link_state.database.advertisements.items():
+            self.queue_message(server, LinkStateAdvertisementMessage.bytes(origin_id, sequence, links))
+        self.originate_link_state_advertisement()
+
+    def originate_link_state_advertisement(self):
+        """ Advertises this server's current links and their costs to every adjacent server, which pass the 
+        advertisement on to the rest of the network, and recomputes this server's routes.
+        """
+        advertisement = self.link_state.advertise(self.adjacent_server_ids)
+        for adjacent_server in self.adjacent_server_ids.values():
+            self.queue_message(adjacent_server, advertisement)
+        self.recompute_routes()
+
+    def recompute_routes(self):
+        """ Recomputes the shortest paths and the broadcast spanning tree after the link state database has
+        changed, and updates the route to every host that is not adjacent.
+        """
+        tree_neighbours = self.link_state.tree_neighbours
+        self.link_state.recompute()
+        for host_id, host in self.hosts_db.items():
+            if isinstance(host, (RemoteServerData, RemoteClientData)):
+                self.remove_route(host_id)
+                self.add_route(host_id, host)
+        if self.link_state.tree_neighbours != tree_neighbours:
+            self.update_channel_links()
+
+    def remove_unreachable_hosts(self, server_ids):
+        """ Removes servers that have been unreachable for a while, and every client connected to them, from
+        the directory. Each server works this out for itself from the same advertisements, so quit messages
+        are only sent to adjacent clients.
+
+        Args:
+            server_ids (list): the IDs of the unreachable servers
+        Returns:
+            None        
+        """
+        server_ids = set(server_ids)
+        for server_id in server_ids:
+            self.link_state.forget(server_id)
+        unreachable_hosts = [host for host in self.hosts_db.values() 
+                             if isinstance(host, (RemoteServerData, RemoteClientData)) 
+                             and host.first_link_id in server_ids]
+        quit_messages = []
+        for host in unreachable_hosts:
+            del self.hosts_db[host.id]
+            self.record_directory_change(host, False)
+            self.remove_route(host.id)
+            if isinstance(host, ClientConnectionData):
+                quit_messages.append(ClientQuitMessage.bytes(host.id, "Connection lost"))
+        if unreachable_hosts:
+            self.print_info("Removed %i hosts that can no longer be reached" % len(unreachable_hosts))
+        if quit_messages:
+            self.broadcast_message_to_adjacent_clients(b''.join(quit_messages))
+
+    def channel_links(self):
+        """ Returns the IDs of the adjacent servers that channel membership and channel messages are passed 
+        between. In tree mode this is every adjacent server. In link-state mode it is this server's neighbours
+        in the broadcast spanning tree, since the links of a mesh would carry a channel message around a loop.
+        """
+        if self.link_state is not None:
+            return self.link_state.tree_neighbours
+        return self.adjacent_server_ids
+
+    def update_channel(self, channel):
+        """ Tells each adjacent server whether this server has members of a channel behind it, if that has 
+        changed. This server has members behind it as far as an adjacent server is concerned if it has a 
+        member as an adjacent client or has members behind any of its other links. Joins and leaves are 
+        therefore only passed on when a link's state changes, not for every member that joins or leaves. A
+        channel that no longer has members anywhere is forgotten.
+
+        Args:
+            channel (ChannelData): the channel whose membership has changed
+        Returns:
+            None        
+        """
+        links = self.channel_links()
+        for link_id in list(channel.joined_links):
+            if link_id not in links:
+                channel.joined_links.discard(link_id)
+                if link_id in self.adjacent_server_ids:
+                    self.queue_message(self.adjacent_server_ids[link_id],
+                                       ChannelLeaveMessage.bytes(self.id, channel.name))
+        for link_id in links:
+            server = self.adjacent_server_ids.get(link_id)
+            if server is None:
+                continue
+            has_members = bool(channel.local_members) or any(
+                member_link_id != link_id and member_link_id in links for member_link_id in channel.member_links)
+            if has_members and link_id not in channel.joined_links:
+                channel.joined_links.add(link_id)
+                self.queue_message(server, ChannelJoinMessage.bytes(self.id, channel.name))
+            elif not has_members and link_id in channel.joined_links:
+                channel.joined_links.discard(link_id)
+                self.queue_message(server, ChannelLeaveMessage.bytes(self.id, channel.name))
+        if not channel.local_members and not channel.member_links and not channel.joined_links:
+            del self.channels[channel.name]
+
+    def update_channel_links(self):
+        """ Updates every channel after a link to an adjacent server has been added or lost, or the broadcast
+        spanning tree has changed. Member links that are gone are dropped, and new links are told about the
+        channels they now lead to.
+        """
+        links = self.channel_links()
+        for channel in list(self.channels.values()):
+            channel.member_links = {link_id for link_id in channel.member_links 
+                                    if link_id in links and link_id in self.adjacent_server_ids}
+            self.update_channel(channel)
+
+    def leave_all_channels(self, client_id):
+        """ Removes an adjacent client that has left the network from every channel it was a member of """
+        for channel in list(self.channels.values()):
+            if client_id in channel.local_members:
+                channel.local_members.discard(client_id)
+                self.update_channel(channel)
 
 ##############################################################################################################
 
@@ -540,11 +2143,9 @@ class CRCServer(object):
         ServerConnectionData object.
 
         You will need to determine if this new server is adjacent to the server processing this message. If 
-        the new server is adjacent, add its ID to self.adjacent_server_ids and modify the assocated io_device 
+        the new server is adjacent, add it to self.adjacent_server_ids and modify the assocated io_device 
         to replace the associated data object with your new ServerConnectionData object. You can do this by
-        calling: self.sel.modify(io_device.fileobj, 
-                                 selectors.EVENT_READ | selectors.EVENT_WRITE, 
-                                 my_new_server_connection_data_obj)
+        calling: self.replace_connection_data(io_device, my_new_server_connection_data_obj)
 
         If this registration message came from a brand new adjacent server then it is the responsibility of 
         the server processing this message to inform the new server of all other connected servers and 
@@ -565,48 +2166,63 @@ class CRCServer(object):
         Returns:
             None        
         """
+        # A restarting server sends a resync request on its new connection before registering
+        resync_request = io_device.data.resync_request
+        adjacent = self.current_flood is None and (message.last_hop_id == self.id or message.last_hop_id == 0)
     
         #check if id does not already exist
-        if message.source_id in self.hosts_db:
+        if message.source_id in self.hosts_db or message.source_id == self.id:
+            if self.link_state is not None:
+                # In a mesh the same registration arrives over every path, and a server we already know about 
+                # may open an extra link to us
+                if adjacent and isinstance(self.hosts_db.get(message.source_id), RemoteServerData):
+                    self.add_server_link(io_device, message)
+                    return
+                if self.current_flood is not None:
+                    return
             status_message = StatusUpdateMessage.bytes(self.id, 0, 0x02, "A machine has already registered with ID " + str(message.source_id))
-            io_device.data.write_buffer += status_message
+            self.queue_message(io_device.data, status_message)
             return
         
-        # Create new ServerConnectionData 
-        new_server = ServerConnectionData(message.source_id, message.server_name, message.server_info)
-        new_server.first_link_id = message.last_hop_id
-
-        # Modifies the associated io_device
-        if message.last_hop_id == self.id or message.last_hop_id == 0:
+        # This is the reply from the server we registered with on startup. Check before the connection's data 
+        # object is replaced below.
+        if message.last_hop_id == self.id and io_device.data is self.upstream_connection:
+            self.upstream_id = message.source_id
+
+        # Create new ServerConnectionData. Servers that are not adjacent get a smaller record without buffers
+        if adjacent:
+            new_server = ServerConnectionData(message.source_id, message.server_name, message.server_info)
             new_server.first_link_id = message.source_id
-            self.sel.modify(io_device.fileobj, selectors.EVENT_READ | selectors.EVENT_WRITE, new_server)
+            self.replace_connection_data(io_device, new_server)
+        else:
+            new_server = RemoteServerData(message.source_id, message.server_name, message.server_info, 
+                                          message.last_hop_id)
 
         # Check if the server is adjacent
-        if message.last_hop_id == 0:
+        if adjacent and message.last_hop_id == 0:
             server_reg_message = ServerRegistrationMessage.bytes(self.id, message.source_id, self.server_name, self.server_info)
-            new_server.write_buffer += server_reg_message
+            self.queue_message(new_server, server_reg_message)
             
-            # Send all known servers and clients to the new server
-            for host in self.hosts_db.values():
-                if isinstance(host, ServerConnectionData):
-                    reg_message = ServerRegistrationMessage.bytes(
-                        host.id, self.id, host.server_name, host.server_info
-                    )
-                    new_server.write_buffer += reg_message
-                elif isinstance(host, ClientConnectionData):
-                    client_reg_message = ClientRegistrationMessage.bytes(
-                        host.id, self.id, host.client_name, host.client_info
-                    )
-                    new_server.write_buffer += client_reg_message
-
-        # Stores the new server in the hosts_db
+            # Send all known servers and clients to the new server in a single directory snapshot, or only the 
+            # changes made since the snapshot it restarted from
+            self.queue_message(new_server, self.directory_resync(resync_request))
+
+        # Stores the new server in the hosts_db and routes messages to it through the host it was registered by
         self.hosts_db[message.source_id] = new_server
-        new_broadcast = ServerRegistrationMessage.bytes(message.source_id, self.id, message.server_name, message.server_info)
-        self.broadcast_message_to_servers(new_broadcast, ignore_host_id = message.last_hop_id)
+        self.add_route(message.source_id, new_server)
+        new_server.registration_message = ServerRegistrationMessage.bytes(message.source_id,
+                                                                          self.advertised_last_hop(new_server),
+                                                                          message.server_name, message.server_info)
+        self.record_directory_change(new_server, True)
+        self.broadcast_message_to_servers(new_server.registration_message, ignore_host_id = message.last_hop_id)
 
         # Adds server to the adjacent_server_ids 
-        if message.last_hop_id == self.id or message.last_hop_id == 0:
-            self.adjacent_server_ids.append(message.source_id)
+        if adjacent:
+            self.adjacent_server_ids[message.source_id] = new_server
+            if self.link_state is not None:
+                self.add_link_state_adjacency(new_server)
+            else:
+                self.update_channel_links()
                 
 
 ##############################################################################################################
@@ -626,11 +2242,9 @@ class CRCServer(object):
         ClientConnectionData object.
 
         You will need to determine if this new client is adjacent to the server processing this message. If 
-        the new client is adjacent, add its ID to self.adjacent_client_ids and modify the assocated io_device 
+        the new client is adjacent, add it to self.adjacent_user_ids and modify the assocated io_device 
         to replace the associated data object with your new ClientConnectionData object. You can do this by
-        calling: self.sel.modify(io_device.fileobj, 
-                                 selectors.EVENT_READ | selectors.EVENT_WRITE, 
-                                 my_new_client_connection_data_obj)
+        calling: self.replace_connection_data(io_device, my_new_client_connection_data_obj)
         You should also send a Welcome status update to the newly connected adjacent client. The message code 
         should be 0x00 and the message content should be "Welcome to the Clemson Relay Chat network [X]", 
         where [X] is the client's name. 
@@ -653,39 +2267,273 @@ class CRCServer(object):
         Returns:
             None        
         """
+        adjacent = self.current_flood is None and (message.last_hop_id == self.id or message.last_hop_id == 0)
         if message.source_id in self.hosts_db:
+            if self.current_flood is not None:
+                return          # The same registration arrives over every path in a mesh
             status_message = StatusUpdateMessage.bytes(self.id, 0, 0x02, "Someone has already registered with ID " + str(message.source_id))
-            io_device.data.write_buffer += status_message
+            self.queue_message(io_device.data, status_message)
             return
 
-        new_client = ClientConnectionData(message.source_id,message.client_name,message.client_info)
-        new_client.first_link_id = message.last_hop_id
-
-        # Modifies the associated io_device
-        if message.last_hop_id == self.id or message.last_hop_id == 0:
+        # Modifies the associated io_device. Clients that are not adjacent get a smaller record without buffers
+        if adjacent:
+            new_client = ClientConnectionData(message.source_id,message.client_name,message.client_info)
             new_client.first_link_id = message.source_id
-            self.sel.modify(io_device.fileobj, selectors.EVENT_READ | selectors.EVENT_WRITE, new_client)
+            if self.client_rate_limit:
+                new_client.rate_limiter = TokenBucket(self.client_rate_limit, self.client_burst)
+            self.replace_connection_data(io_device, new_client)
+        else:
+            new_client = RemoteClientData(message.source_id, message.client_name, message.client_info, 
+                                          message.last_hop_id)
         
         # Sends a welcome status update to the newly connected adjacent client
-        if message.last_hop_id == 0:
+        if adjacent and message.last_hop_id == 0:
             welcome_message = StatusUpdateMessage.bytes(self.id, message.source_id, 0x00, "Welcome to the Clemson Relay Chat network " + str(message.client_name))
-            new_client.write_buffer += welcome_message
-            for host in self.hosts_db.values():
-                if isinstance(host, ClientConnectionData):
-                    client_reg_message = ClientRegistrationMessage.bytes(host.id, self.id, host.client_name, host.client_info)
-                    new_client.write_buffer += client_reg_message
+            self.queue_message(new_client, welcome_message)
+            self.queue_message(new_client, self.client_directory())
 
-        # Stores the new client in the hosts_db
+        # Stores the new client in the hosts_db and routes messages to it through the host it was registered by
         self.hosts_db[message.source_id] = new_client
-        new_broadcast = ClientRegistrationMessage.bytes(message.source_id, self.id, message.client_name, message.client_info)
+        self.add_route(message.source_id, new_client)
+        new_client.registration_message = ClientRegistrationMessage.bytes(message.source_id,
+                                                                          self.advertised_last_hop(new_client),
+                                                                          message.client_name, message.client_info)
+        self.record_directory_change(new_client, True)
         
-        # Broadcasts the new client to the rest of the network
-        self.broadcast_message_to_servers(new_broadcast, ignore_host_id = message.last_hop_id)
-        self.broadcast_message_to_adjacent_clients(new_broadcast, ignore_host_id = message.last_hop_id)
+        # Broadcasts the new client to the rest of the network. The same packed message is shared by every 
+        # write buffer it is queued on.
+        self.broadcast_message_to_servers(new_client.registration_message, ignore_host_id = message.last_hop_id)
+        self.broadcast_message_to_adjacent_clients(new_client.registration_message,
+                                                   ignore_host_id = message.last_hop_id)
         
-        # Adds the new client to the adjacent_client_ids
-        if message.last_hop_id == self.id or message.last_hop_id == 0:
-            self.adjacent_user_ids.append(message.source_id)
+        # Adds the new client to the adjacent_user_ids
+        if adjacent:
+            self.adjacent_user_ids[message.source_id] = new_client
+##############################################################################################################
+
+    def handle_directory_snapshot_message(self, io_device, message):
+        """ This function handles the directory snapshot an adjacent server sends when this server registers 
+        with it. Every server and client in the snapshot that is not already known is added to self.hosts_db
+        and routed through the server the snapshot was received from (message.last_hop_id), just as if its 
+        registration message had been received from that server. The newly learned hosts are then passed on 
+        to the rest of the network: servers receive a single snapshot of the new hosts, and adjacent clients 
+        receive registration messages for the new clients.
+
+        Args:
+            io_device (SelectorKey): This object contains references to the socket (io_device.fileobj) and to 
+                the data associated with the socket on registering with the selector (io_device.data).
+            message (DirectorySnapshotMessage): The directory snapshot message that needs to be processed
+        Returns:
+            None        
+        """
+        self.add_directory_hosts(message.hosts, message.last_hop_id)
+
+    def add_directory_hosts(self, hosts, first_link_id):
+        """ Adds every host in a directory that is not already known to self.hosts_db, routed through the 
+        adjacent server first_link_id, and passes the newly learned hosts on to the rest of the network. In 
+        link-state mode each host is instead routed to its home server, which is the last_hop_id of its 
+        registration message (see advertised_last_hop()).
+
+        Args:
+            hosts (list): (message_type, host_id, name, info, last_hop_id) tuples, as in 
+                DirectorySnapshotMessage.hosts
+            first_link_id (int): the ID of the adjacent server the hosts are reached through
+        Returns:
+            None        
+        """
+        new_servers = []
+        new_clients = []
+        for message_type, host_id, name, info, last_hop_id in hosts:
+            if host_id in self.hosts_db or host_id == self.id:
+                continue
+            home_id = first_link_id
+            if self.link_state is not None:
+                home_id = last_hop_id
+                if home_id == self.id:
+                    continue    # A client that was connected to this server before it restarted
+            if message_type == 0x00:
+                host = RemoteServerData(host_id, name, info, home_id)
+                host.registration_message = ServerRegistrationMessage.bytes(host_id, self.advertised_last_hop(host),
+                                                                            name, info)
+                new_servers.append(host.registration_message)
+            else:
+                host = RemoteClientData(host_id, name, info, home_id)
+                host.registration_message = ClientRegistrationMessage.bytes(host_id, self.advertised_last_hop(host),
+                                                                            name, info)
+                new_clients.append(host.registration_message)
+            self.hosts_db[host_id] = host
+            self.add_route(host_id, host)
+            self.record_directory_change(host, True)
+
+        if new_servers or new_clients:
+            snapshot = DirectorySnapshotMessage.bytes(self.id, self.id, b''.join(new_servers + new_clients))
+            self.broadcast_message_to_servers(snapshot, ignore_host_id=first_link_id)
+        if new_clients:
+            self.broadcast_message_to_adjacent_clients(b''.join(new_clients), ignore_host_id=first_link_id)
+
+##############################################################################################################
+
+    def handle_directory_version_message(self, io_device, message):
+        """ This function handles directory version messages. A restarting server sends one as a resync 
+        request before its registration message, which is kept with the connection until the registration
+        message is handled (see directory_resync()). 
+
+        Otherwise the message comes from an adjacent server and tells us the version of its directory we are
+        now up to date with. Only the version of the server this server registered with on startup is kept,
+        since that is the server this server reconnects to after a restart. The first version message from it
+        after a restart also says whether the hosts restored from the snapshot are still up to date: if it 
+        is a DELTA, the restored hosts minus the removed ones are added to the directory before the changes 
+        that follow it. Otherwise the full directory follows and the restored hosts are thrown away.
+
+        Args:
+            io_device (SelectorKey): This object contains references to the socket (io_device.fileobj) and to 
+                the data associated with the socket on registering with the selector (io_device.data).
+            message (DirectoryVersionMessage): The directory version message that needs to be processed
+        Returns:
+            None        
+        """
+        if message.flags & DirectoryVersionMessage.RESYNC_REQUEST:
+            io_device.data.resync_request = message
+            return
+        if message.source_id != self.upstream_id:
+            return
+
+        self.upstream_epoch = message.epoch
+        self.upstream_version = message.version
+        if self.restored_hosts is not None:
+            restored_hosts, self.restored_hosts = self.restored_hosts, None
+            if message.flags & DirectoryVersionMessage.DELTA:
+                removed_ids = set(message.removed_ids)
+                current_hosts = [host for host in restored_hosts if host[1] not in removed_ids]
+                self.add_directory_hosts(current_hosts, message.source_id)
+                self.print_info("Restored %i hosts from the directory snapshot, %i had left the network"
+                                % (len(current_hosts), len(restored_hosts) - len(current_hosts)))
+            else:
+                self.print_info("The directory snapshot is out of date, the full directory will be resent")
+
+##############################################################################################################
+
+    def handle_link_state_advertisement_message(self, io_device, message):
+        """ This function handles link state advertisements in link-state mode. An advertisement that is 
+        newer than the one stored for its origin server is stored, passed on to every other adjacent server, 
+        and used to recompute this server's routes. Older advertisements and repeats are ignored, which is 
+        what stops an advertisement from circling a loop in the network.
+
+        Args:
+            io_device (SelectorKey): This object contains references to the socket (io_device.fileobj) and to 
+                the data associated with the socket on registering with the selector (io_device.data).
+            message (LinkStateAdvertisementMessage): The advertisement that needs to be processed
+        Returns:
+            None        
+        """
+        if self.link_state is None or message.source_id == self.id:
+            return
+        if self.link_state.database.update(message.source_id, message.sequence, message.links):
+            arrival_id = getattr(io_device.data, "id", None)
+            for adjacent_server_id, adjacent_server in self.adjacent_server_ids.items():
+                if adjacent_server_id != arrival_id:
+                    self.queue_message(adjacent_server, message.bytes)
+            self.recompute_routes()
+
+    def handle_link_probe_message(self, io_device, message):
+        """ This function handles link probes in link-state mode. A probe is echoed straight back to the 
+        adjacent server that sent it. A reply to one of this server's probes gives the round trip time of the
+        link, and the link is advertised again if its cost has changed enough.
+
+        Args:
+            io_device (SelectorKey): This object contains references to the socket (io_device.fileobj) and to 
+                the data associated with the socket on registering with the selector (io_device.data).
+            message (LinkProbeMessage): The probe that needs to be processed
+        Returns:
+            None        
+        """
+        if self.link_state is None:
+            return
+        if not message.flags & LinkProbeMessage.REPLY:
+            self.queue_message(io_device.data, LinkProbeMessage.bytes(self.id, LinkProbeMessage.REPLY, 
+                                                                      message.timestamp))
+        elif message.source_id in self.adjacent_server_ids:
+            if self.link_state.record_round_trip(message.source_id, time.monotonic() - message.timestamp):
+                self.originate_link_state_advertisement()
+
+    def handle_flood_message(self, io_device, message):
+        """ This function handles flooded broadcasts in link-state mode. A flood that has been seen before is
+        dropped. Otherwise it is passed on along the broadcast spanning tree and the messages it carries are 
+        handled as if they had arrived on their own, except that their handlers do not broadcast them again 
+        (see broadcast_message_to_servers()).
+
+        Args:
+            io_device (SelectorKey): This object contains references to the socket (io_device.fileobj) and to 
+                the data associated with the socket on registering with the selector (io_device.data).
+            message (FloodMessage): The flood message that needs to be processed
+        Returns:
+            None        
+        """
+        if (self.link_state is None or message.source_id == self.id 
+            or not self.link_state.accept_flood(message.source_id, message.sequence)):
+            return
+        self.flood_message_to_servers(message.bytes, arrival_id=getattr(io_device.data, "id", None))
+        self.current_flood = message
+        try:
+            for flooded_message in MessageParser.parse_messages(message.payload):
+                self.handle_message(io_device, flooded_message)
+        finally:
+            self.current_flood = None
+
+    def handle_link_options_message(self, io_device, message):
+        """ This function handles link options messages. A server that opens a link to this server asks for
+        the options it wants ahead of its registration message. The reply agrees to the options this server
+        also has enabled, and both servers start using them once the reply has been sent (or received).
+
+        Args:
+            io_device (SelectorKey): This object contains references to the socket (io_device.fileobj) and to 
+                the data associated with the socket on registering with the selector (io_device.data).
+            message (LinkOptionsMessage): The link options message that needs to be processed
+        Returns:
+            None        
+        """
+        if message.flags & LinkOptionsMessage.REPLY:
+            if self.link_compression and message.flags & LinkOptionsMessage.COMPRESSION:
+                self.start_link_compression(io_device.data)
+                self.print_info("Compressing the link to Host ID #%s" % message.source_id)
+            return
+
+        flags = message.flags & LinkOptionsMessage.COMPRESSION if self.link_compression else 0
+        self.queue_message(io_device.data, LinkOptionsMessage.bytes(self.id, flags | LinkOptionsMessage.REPLY))
+        if flags & LinkOptionsMessage.COMPRESSION:
+            self.start_link_compression(io_device.data)
+            self.print_info("Compressing the link to Host ID #%s" % message.source_id)
+
+    def handle_heartbeat_message(self, io_device, message):
+        """ This function handles heartbeats by answering them. Any message received over a connection, 
+        including a heartbeat or the answer to one, shows that the connection is still alive (see 
+        check_idle_connection()).
+
+        Args:
+            io_device (SelectorKey): This object contains references to the socket (io_device.fileobj) and to 
+                the data associated with the socket on registering with the selector (io_device.data).
+            message (HeartbeatMessage): The heartbeat that needs to be processed
+        Returns:
+            None        
+        """
+        if not message.flags & HeartbeatMessage.REPLY:
+            self.queue_message(io_device.data, HeartbeatMessage.bytes(self.id, HeartbeatMessage.REPLY))
+
+    def handle_compressed_message(self, io_device, message):
+        """ This function handles compressed messages. The payload is decompressed with the link's zlib 
+        stream and the messages in it are handled as if they had arrived on their own.
+
+        Args:
+            io_device (SelectorKey): This object contains references to the socket (io_device.fileobj) and to 
+                the data associated with the socket on registering with the selector (io_device.data).
+            message (CompressedMessage): The compressed message that needs to be processed
+        Returns:
+            None        
+        """
+        if io_device.data.decompressor is None:
+            raise Exception("Received a compressed message on a link that is not compressed")
+        self.handle_messages(io_device, io_device.data.decompressor.decompress(message.payload))
+
 ##############################################################################################################
 
     def handle_status_message(self, io_device, message):
@@ -727,14 +2575,45 @@ class CRCServer(object):
         Returns:
             None        
         """
-        if message.destination_id not in self.hosts_db:
+        if not self.admit_client_message(io_device, message):
+            return
+        if message.destination_id not in self.routes:
             no_destination = StatusUpdateMessage.bytes(self.id, message.source_id, 0x01, f"Unknown ID {message.destination_id}")
             self.send_message_to_unknown_io_device(io_device, no_destination)
         
-        # if the destination id exists, send the message to the intended destination
+        # if the destination id exists, forward the message as is to the next hop on the path to the destination
         else:
-            chat_message = ClientChatMessage.bytes(message.source_id, message.destination_id, message.content)
-            self.send_message_to_host(self.hosts_db[message.destination_id].first_link_id, chat_message)
+            self.queue_message(self.routes[message.destination_id], message.bytes)
+
+    def admit_client_message(self, io_device, message):
+        """ Checks a chat or channel message against the rate limits before it is routed. Only messages that
+        come straight from an adjacent client are limited; messages passed on by other servers were checked
+        by the server the client is connected to. The first message that is refused is answered with a 
+        throttling status update, and the client is not sent another one until a message gets through.
+
+        Args:
+            io_device (SelectorKey): the io_device the message was received on
+            message (ClientChatMessage or ChannelPublishMessage): the message to check
+        Returns:
+            bool: True if the message may be routed
+        """
+        client = io_device.data
+        if not isinstance(client, ClientConnectionData) or (client.rate_limiter is None 
+                                                            and self.server_rate_limiter is None):
+            return True
+        now = time.monotonic()
+        if client.rate_limiter is None or client.rate_limiter.take(now):
+            if self.server_rate_limiter is None or self.server_rate_limiter.take(now):
+                client.throttled = False
+                return True
+            if client.rate_limiter is not None:
+                client.rate_limiter.refund()        # The client's own token was not used after all
+        self.throttled_messages += 1
+        if not client.throttled:
+            client.throttled = True
+            self.queue_message(client, StatusUpdateMessage.bytes(self.id, client.id, THROTTLED_STATUS, 
+                                                                 "Rate limit exceeded, messages are being dropped"))
+        return False
 
 ##############################################################################################################
 
@@ -756,11 +2635,127 @@ class CRCServer(object):
         """
         client_id = message.source_id
         if client_id in self.hosts_db:
-            self.hosts_db.pop(client_id)
-            if client_id in self.adjacent_user_ids:
-                self.adjacent_user_ids.remove(client_id)
+            client = self.hosts_db.pop(client_id)
+            self.remove_route(client_id)
+            if self.adjacent_user_ids.pop(client_id, None) is not None:
+                self.leave_all_channels(client_id)
+            self.record_directory_change(client, False)
             self.broadcast_message_to_servers(message.bytes, ignore_host_id = client_id)
             self.broadcast_message_to_adjacent_clients(message.bytes, ignore_host_id = client_id) 
+
+    def handle_hosts_quit_message(self, io_device, message):
+        """ This function handles the message a server sends when the link to one of its adjacent servers 
+        closes, listing every host that was on the far side of the link. Only the hosts that this server 
+        reaches through the server the message came from are removed, so a message that arrives after a host
+        has registered again through another path does no harm. The hosts that were removed are passed on to
+        the rest of the network in a new HostsQuitMessage (see evict_hosts()).
+
+        Args:
+            io_device (SelectorKey): This object contains references to the socket (io_device.fileobj) and to 
+                the data associated with the socket on registering with the selector (io_device.data).
+            message (HostsQuitMessage): The hosts quit message that needs to be processed
+        Returns:
+            None        
+        """
+        routed_hosts = self.routed_hosts.get(io_device.data, ())
+        self.evict_hosts([host_id for host_id in message.host_ids if host_id in routed_hosts], 
+                         ignore_host_id=io_device.data.id)
+##############################################################################################################
+
+    def handle_channel_join_message(self, io_device, message):
+        """ This function handles channel join messages. A join from an adjacent client makes the client a 
+        member of the channel. A join from an adjacent server means that server has members of the channel 
+        behind it, so messages published to the channel must be sent over the link to it. Either way, the 
+        other adjacent servers are told that this server now has members behind it if they didn't know yet.
+
+        Args:
+            io_device (SelectorKey): This object contains references to the socket (io_device.fileobj) and to 
+                the data associated with the socket on registering with the selector (io_device.data).
+            message (ChannelJoinMessage): The channel join message that needs to be processed
+        Returns:
+            None        
+        """
+        host_id = getattr(io_device.data, "id", None)
+        channel = self.channels.get(message.channel)
+        if channel is None:
+            channel = self.channels[message.channel] = ChannelData(message.channel)
+        if self.adjacent_user_ids.get(host_id) is io_device.data:
+            channel.local_members.add(host_id)
+        elif self.adjacent_server_ids.get(host_id) is io_device.data and host_id in self.channel_links():
+            channel.member_links.add(host_id)
+        self.update_channel(channel)
+
+    def handle_channel_leave_message(self, io_device, message):
+        """ This function handles channel leave messages, which undo a join from the same client or server.
+
+        Args:
+            io_device (SelectorKey): This object contains references to the socket (io_device.fileobj) and to 
+                the data associated with the socket on registering with the selector (io_device.data).
+            message (ChannelLeaveMessage): The channel leave message that needs to be processed
+        Returns:
+            None        
+        """
+        host_id = getattr(io_device.data, "id", None)
+        channel = self.channels.get(message.channel)
+        if channel is None:
+            return
+        if self.adjacent_user_ids.get(host_id) is io_device.data:
+            channel.local_members.discard(host_id)
+        elif self.adjacent_server_ids.get(host_id) is io_device.data:
+            channel.member_links.discard(host_id)
+        self.update_channel(channel)
+
+    def handle_channel_publish_message(self, io_device, message):
+        """ This function handles messages published to a channel. The message is sent once over every link 
+        that leads to members of the channel, except the link it arrived on, and once to every adjacent 
+        client that is a member, except the client that published it. The same packed message is queued for 
+        every destination.
+
+        In link-state mode a message that has been seen before is dropped, in case the servers briefly
+        disagree about the spanning tree. The server a client is connected to replaces the client's sequence
+        number with its own, and repeats are recognised by that number and the ID of the client's server.
+
+        Args:
+            io_device (SelectorKey): This object contains references to the socket (io_device.fileobj) and to 
+                the data associated with the socket on registering with the selector (io_device.data).
+            message (ChannelPublishMessage): The channel publish message that needs to be processed
+        Returns:
+            None        
+        """
+        if not self.admit_client_message(io_device, message):
+            return
+        channel = self.channels.get(message.channel)
+        if channel is None:
+            return
+        if self.link_state is not None:
+            if io_device.data is self.adjacent_user_ids.get(message.source_id):
+                message.sequence = self.link_state.next_publish_sequence()
+                message.bytes = ChannelPublishMessage.bytes(message.source_id, message.sequence, message.channel,
+                                                            message.content)
+            host = self.hosts_db.get(message.source_id)
+            home_id = self.advertised_last_hop(host) if host is not None else None
+            if not self.link_state.accept_publish(home_id, message.sequence):
+                return
+        arrival_id = getattr(io_device.data, "id", None)
+        for link_id in channel.member_links:
+            if link_id != arrival_id and link_id in self.adjacent_server_ids:
+                self.queue_message(self.adjacent_server_ids[link_id], message.bytes)
+        for member_id in channel.local_members:
+            if member_id != message.source_id:
+                self.queue_message(self.adjacent_user_ids[member_id], message.bytes)
+
+
+    ######################################################################
+    # Logging helpers that sit alongside the template's print_info(). The values to be formatted into the
+    # message are passed as separate arguments (e.g. self.print_debug("Sent %s", message)), and CRCLog only
+    # formats a message if it is at or above the log level. Messages logged for every message the server
+    # handles call self.logger.info() the same way, so they cost one comparison when info logging is off.
+
+    def print_debug(self, msg, *args):
+        self.logger.debug(msg, *args)
+
+    def print_error(self, msg, *args):
+        self.logger.error(msg, *args)
 ##############################################################################################################    
     
 
@@ -776,35 +2771,11 @@ class CRCServer(object):
     # messages useful to you in development
 
     def init_logging(self):
-        # If we don't include a log file name, then don't log
-        if not self.log_file:
-            return
-
-        # Get a reference to the logger for this program
-        self.logger = logging.getLogger("IRCServer")
-        __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
-
-        # Create a file handler to store the log files
-        fh = logging.FileHandler(os.path.join(__location__, 'Logs', '%s' % self.log_file), mode='w')
-
-        # Set up the logging level. It defaults to INFO
-        log_level = logging.INFO
-        
-        # Define a formatter that will be used to format each line in the log
-        formatter = logging.Formatter(
-            ("%(asctime)s - %(name)s[%(process)d] - "
-             "%(levelname)s - %(message)s"))
-
-        # Assign all of the necessary parameters
-        fh.setLevel(log_level)
-        fh.setFormatter(formatter)
-        self.logger.setLevel(log_level)
-        self.logger.addHandler(fh)
+        # See CRCLogging.CRCLog for the log level, log file and log queue options
+        self.logger = CRCLog(self.server_name, self.log_file, self.log_level, self.log_queue)
 
     def print_info(self, msg):
-        print("[%s] \t%s" % (self.server_name,msg))
-        if self.logger:
-            self.logger.info(msg)
+        self.logger.info(msg)
 
 
 
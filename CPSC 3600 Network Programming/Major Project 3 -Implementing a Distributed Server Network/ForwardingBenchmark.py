@@ -0,0 +1,87 @@
+import random, time, types
+from optparse import OptionParser
+from ChatServer import *
+
+# Measures how many chat messages per second a single CRCServer can forward as the number of hosts it knows
+# about grows. The server under test is connected to its adjacent servers over local socket pairs, and the
+# rest of the network is registered through those servers, exactly as it would be in a real mesh. Messages
+# are handed straight to the message handlers so that only routing and queueing are measured, not the
+# network. Logging is disabled for the same reason.
+
+class ForwardingBenchmark(object):
+
+    def __init__(self, mesh_size, adjacent_servers, message_count, seed=0):
+        self.mesh_size = mesh_size
+        self.adjacent_servers = adjacent_servers
+        self.message_count = message_count
+        self.random = random.Random(seed)
+        self.io_devices = []
+        self.remote_sockets = []
+
+        options = types.SimpleNamespace(id=1, servername="Benchmark", info="", port=0, connect_to_host=None,
+                                        connect_to_port=None, log_file=None, log_level="off")
+        self.server = CRCServer(options)
+
+    def build_mesh(self):
+        """ Registers the adjacent servers and then registers mesh_size clients spread across them. """
+        for i in range(self.adjacent_servers):
+            local, remote = socketpair()
+            local.setblocking(False)
+            self.remote_sockets.append(remote)
+            data = BaseConnectionData()
+            data.sock = local
+            io_device = self.server.sel.register(local, self.server.io_device_events(data), data)
+            self.deliver(io_device, ServerRegistrationMessage.bytes(100 + i, 0, "Server%i" % i, ""))
+            self.io_devices.append(self.server.sel.get_key(local))
+
+        self.client_ids = list(range(1000, 1000 + self.mesh_size))
+        for client_id in self.client_ids:
+            io_device = self.random.choice(self.io_devices)
+            self.deliver(io_device, ClientRegistrationMessage.bytes(client_id, io_device.data.id, "c%i" % client_id, ""))
+        self.clear_write_buffers()
+
+    def deliver(self, io_device, message_bytes):
+        for message in MessageParser.parse_messages(message_bytes):
+            self.server.handle_message(io_device, message)
+
+    def clear_write_buffers(self):
+        for io_device in self.io_devices:
+            io_device.data.write_buffer = SendQueue()
+
+    def run(self):
+        self.build_mesh()
+
+        # Parse the messages ahead of time so that only forwarding is timed
+        messages = []
+        for i in range(self.message_count):
+            source_id, destination_id = self.random.sample(self.client_ids, 2)
+            messages.extend(MessageParser.parse_messages(ClientChatMessage.bytes(source_id, destination_id, "benchmark")))
+        io_device = self.io_devices[0]
+
+        start = time.perf_counter()
+        for i, message in enumerate(messages):
+            self.server.handle_message(io_device, message)
+            if i % 10000 == 9999:
+                self.clear_write_buffers()
+        elapsed = time.perf_counter() - start
+
+        self.server.cleanup()
+        for remote in self.remote_sockets:
+            remote.close()
+        return self.message_count / elapsed
+
+
+if __name__ == "__main__":
+    op = OptionParser(description="Measures the CRCServer chat forwarding rate against mesh size")
+    op.add_option("--sizes", default="10,100,1000,10000,100000",
+                  help="A comma separated list of the number of hosts in the mesh")
+    op.add_option("--adjacent_servers", type="int", default=8,
+                  help="The number of servers adjacent to the server under test")
+    op.add_option("--messages", type="int", default=200000,
+                  help="The number of chat messages to forward for each mesh size")
+    options, args = op.parse_args()
+
+    print("%12s %16s" % ("mesh size", "messages/sec"))
+    for size in [int(size) for size in options.sizes.split(",")]:
+        rate = ForwardingBenchmark(size, options.adjacent_servers, options.messages).run()
+        print("%12i %16.0f" % (size, rate))
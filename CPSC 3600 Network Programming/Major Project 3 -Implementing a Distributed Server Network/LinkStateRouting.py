@@ -0,0 +1,242 @@
+import collections
+import heapq
+import time
+from ChatMessageParser import LinkStateAdvertisementMessage
+
+# How often, in seconds, each adjacent server is probed to measure the round trip time of the link to it.
+# Can be overridden with options.link_probe_interval.
+DEFAULT_LINK_PROBE_INTERVAL = 1.0
+
+# The cost, in microseconds, of a link whose round trip time has not been measured yet
+DEFAULT_LINK_COST = 1000
+
+# A link's advertised cost is only updated once its measured cost has changed by more than this fraction, so
+# that small variations in the round trip time don't cause a stream of advertisements
+LINK_COST_CHANGE_THRESHOLD = 0.5
+
+# The weight of each new round trip time measurement in a link's smoothed cost
+LINK_COST_SMOOTHING = 0.25
+
+# How long, in seconds, a server must stay unreachable before it and the clients connected to it are removed 
+# from the directory. Advertisements from different servers arrive one at a time, so a server can look 
+# unreachable for a moment while the network is changing even though it never was.
+UNREACHABLE_HOLD_TIME = 2.0
+
+# The number of floods remembered so that repeats can be dropped, and how long, in seconds, each one is 
+# remembered for. A flood can only arrive again while it is still travelling around a loop in the network, 
+# so it only needs to be remembered for a short time. Can be overridden with options.seen_cache_size and 
+# options.seen_cache_ttl.
+DEFAULT_SEEN_CACHE_SIZE = 65536
+DEFAULT_SEEN_CACHE_TTL = 30.0
+
+##############################################################################################################
+
+class SeenMessageCache():
+    """ SeenMessageCache remembers the (source ID, sequence number) of every flooded message seen recently so
+    that copies arriving over other paths can be dropped. Entries are kept in an OrderedDict in the order they
+    were seen, which is also the order they expire in, so checking a message, remembering it, and evicting 
+    the oldest entries are all O(1). The cache never holds more than max_entries entries, whatever the rate 
+    of messages, and an entry is forgotten once it is older than ttl seconds.
+    """
+    def __init__(self, max_entries=None, ttl=None):
+        self.max_entries = max_entries or DEFAULT_SEEN_CACHE_SIZE
+        self.ttl = ttl or DEFAULT_SEEN_CACHE_TTL
+        self.entries = collections.OrderedDict()        # Maps (source ID, sequence) to when it expires
+        self.suppressed = 0                             # The number of repeats that have been dropped
+
+    def __len__(self):
+        return len(self.entries)
+
+    def accept(self, source_id, sequence):
+        """ Returns True the first time a message is seen and False for any repeat seen within ttl seconds """
+        now = time.monotonic()
+        entries = self.entries
+        key = (source_id, sequence)
+        expires = entries.get(key)
+        if expires is not None and expires > now:
+            self.suppressed += 1
+            return False
+
+        # Every entry lives for the same ttl, so the entries that have expired are all at the front
+        while entries:
+            oldest_expires = next(iter(entries.values()))
+            if oldest_expires > now and len(entries) < self.max_entries:
+                break
+            entries.popitem(last=False)
+        entries[key] = now + self.ttl
+        return True
+
+##############################################################################################################
+
+class LinkStateDatabase():
+    """ LinkStateDatabase stores the newest link state advertisement received from every server and computes
+    shortest paths over the links they describe. A link is only used if the servers at both of its ends
+    advertise it, so a server that has gone away stops being reachable as soon as its neighbours advertise
+    that they have lost their links to it, whether or not it ever sends another advertisement itself.
+    """
+    def __init__(self):
+        self.advertisements = {}                # Maps server IDs to (sequence, {adjacent server ID: cost})
+
+    def update(self, origin_id, sequence, links):
+        """ Stores an advertisement if it is newer than the one already stored for its origin.
+
+        Returns:
+            bool: True if the advertisement was new
+        """
+        current = self.advertisements.get(origin_id)
+        if current is not None and current[0] >= sequence:
+            return False
+        self.advertisements[origin_id] = (sequence, links)
+        return True
+
+    def shortest_path_tree(self, root_id):
+        """ Runs Dijkstra's algorithm from root_id. Ties are broken by server ID so that every server that
+        holds the same advertisements computes exactly the same tree.
+
+        Args:
+            root_id (int): the ID of the server the tree is rooted at
+        Returns:
+            list: the servers reachable from root_id in the order they were reached, starting with root_id
+            dict: maps each reachable server to its parent in the tree (None for root_id)
+        """
+        distances = {root_id: 0}
+        parents = {root_id: None}
+        order = []
+        reached = set()
+        heap = [(0, root_id)]
+        while heap:
+            distance, server_id = heapq.heappop(heap)
+            if server_id in reached:
+                continue
+            reached.add(server_id)
+            order.append(server_id)
+            for neighbour_id, cost in self.advertisements.get(server_id, (0, {}))[1].items():
+                if neighbour_id in reached or server_id not in self.advertisements.get(neighbour_id, (0, {}))[1]:
+                    continue                    # Already reached, or only one end advertises this link
+                new_distance = distance + cost
+                best = distances.get(neighbour_id)
+                if best is None or new_distance < best or new_distance == best and server_id < parents[neighbour_id]:
+                    distances[neighbour_id] = new_distance
+                    parents[neighbour_id] = server_id
+                    heapq.heappush(heap, (new_distance, neighbour_id))
+        return order, parents
+
+    def next_hops(self, source_id):
+        """ Returns a dictionary mapping every server reachable from source_id to the adjacent server that is
+        the first hop on the shortest path to it.
+        """
+        order, parents = self.shortest_path_tree(source_id)
+        next_hops = {}
+        for server_id in order[1:]:
+            parent_id = parents[server_id]
+            next_hops[server_id] = server_id if parent_id == source_id else next_hops[parent_id]
+        return next_hops
+
+    def tree_neighbours(self, server_id):
+        """ Returns the IDs of server_id's neighbours in the spanning tree used for broadcasts. The tree is
+        the shortest path tree rooted at the lowest server ID reachable from server_id, so every server
+        computes the same tree from the same advertisements.
+        """
+        order, parents = self.shortest_path_tree(server_id)
+        order, parents = self.shortest_path_tree(min(order))
+        neighbours = {child_id for child_id, parent_id in parents.items() if parent_id == server_id}
+        if parents.get(server_id) is not None:
+            neighbours.add(parents[server_id])
+        return neighbours
+
+##############################################################################################################
+
+class LinkStateRouting():
+    """ LinkStateRouting holds the link-state routing state of a single CRCServer: the costs it has measured
+    for its own links, the advertisements it has received, and the routes and broadcast tree computed from
+    them. The server calls recompute() whenever an advertisement changes and reads next_hops and
+    tree_neighbours afterwards.
+    """
+    def __init__(self, server_id, probe_interval=None, seen_cache_size=None, seen_cache_ttl=None):
+        self.server_id = server_id
+        self.probe_interval = probe_interval or DEFAULT_LINK_PROBE_INTERVAL
+        self.database = LinkStateDatabase()
+        self.measured_costs = {}                # Maps adjacent server IDs to their smoothed round trip times
+        self.advertised_costs = {}              # The link costs in this server's newest advertisement
+        self.sequence = time.time_ns() // 1000  # Starts from the clock so it keeps increasing after a restart
+        self.flood_sequence = self.sequence
+        self.seen_floods = SeenMessageCache(seen_cache_size, seen_cache_ttl)
+        self.publish_sequence = self.sequence   # Numbers the channel messages published by this server's clients
+        self.seen_publishes = SeenMessageCache(seen_cache_size, seen_cache_ttl)
+        self.next_hops = {}                     # Maps server IDs to the adjacent server on the shortest path
+        self.tree_neighbours = set()            # This server's neighbours in the broadcast spanning tree
+        self.unreachable_since = {}             # Maps unreachable server IDs to when they became unreachable
+
+    def record_round_trip(self, server_id, seconds):
+        """ Folds a measured round trip time into the smoothed cost of the link to an adjacent server.
+
+        Returns:
+            bool: True if the cost has changed enough that the link should be advertised again
+        """
+        cost = max(1, int(seconds * 1000000))
+        previous = self.measured_costs.get(server_id)
+        if previous is not None:
+            cost = int(previous + LINK_COST_SMOOTHING * (cost - previous))
+        self.measured_costs[server_id] = cost
+        advertised = self.advertised_costs.get(server_id)
+        return advertised is not None and abs(cost - advertised) > LINK_COST_CHANGE_THRESHOLD * advertised
+
+    def advertise(self, adjacent_server_ids):
+        """ Builds a new advertisement of this server's links, stores it in the database, and returns it. """
+        self.sequence += 1
+        self.advertised_costs = {server_id: self.measured_costs.get(server_id, DEFAULT_LINK_COST)
+                                 for server_id in adjacent_server_ids}
+        self.database.update(self.server_id, self.sequence, self.advertised_costs)
+        return LinkStateAdvertisementMessage.bytes(self.server_id, self.sequence, self.advertised_costs)
+
+    def next_flood_sequence(self):
+        self.flood_sequence += 1
+        return self.flood_sequence
+
+    def accept_flood(self, origin_id, sequence):
+        """ Returns True the first time a flood is seen and False for any repeat """
+        return self.seen_floods.accept(origin_id, sequence)
+
+    def next_publish_sequence(self):
+        """ Returns the sequence number to stamp on a channel message published by one of this server's own
+        clients. The number keeps up with the clock in microseconds, so it keeps increasing after a restart,
+        and only wraps around the 32 bits of the message field every 71 minutes, long after seen_publishes
+        has forgotten it.
+        """
+        self.publish_sequence = max(self.publish_sequence + 1, time.time_ns() // 1000)
+        return self.publish_sequence & 0xFFFFFFFF
+
+    def accept_publish(self, home_id, sequence):
+        """ Returns True the first time a channel message stamped by the server home_id is seen and False for
+        any repeat. A client numbers its messages from 1 again every time it connects, so the client's own
+        numbers can't be used to recognise repeats.
+        """
+        return self.seen_publishes.accept(home_id, sequence)
+
+    def recompute(self):
+        """ Recomputes the routes and the broadcast tree, and notes which servers have become unreachable. A 
+        server is unreachable if its advertisement has been received but there is no path to it. A server 
+        whose advertisement has not arrived yet may just have joined, so it is not considered unreachable.
+        """
+        self.next_hops = self.database.next_hops(self.server_id)
+        self.tree_neighbours = self.database.tree_neighbours(self.server_id)
+        now = time.monotonic()
+        for server_id in self.database.advertisements:
+            if server_id == self.server_id or server_id in self.next_hops:
+                self.unreachable_since.pop(server_id, None)
+            else:
+                self.unreachable_since.setdefault(server_id, now)
+
+    def unreachable_servers(self):
+        """ Returns the IDs of the servers that have been unreachable for at least UNREACHABLE_HOLD_TIME """
+        now = time.monotonic()
+        return [server_id for server_id, since in self.unreachable_since.items() 
+                if now - since >= UNREACHABLE_HOLD_TIME]
+
+    def forget(self, server_id):
+        """ Drops everything stored about a server that can no longer be reached. Otherwise the server's last
+        advertisement would make it look unreachable when it restarts, until its new advertisement arrived.
+        """
+        self.database.advertisements.pop(server_id, None)
+        self.unreachable_since.pop(server_id, None)
+
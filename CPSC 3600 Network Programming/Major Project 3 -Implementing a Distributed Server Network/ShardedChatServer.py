@@ -0,0 +1,208 @@
+import multiprocessing
+from ChatServer import *
+
+# Sibling worker links are addressed with IDs from this range so that they can be used as the first_link_id
+# of a host without colliding with the ID of a real server or client on the network.
+WORKER_LINK_ID_BASE = 0xFFFFFF00
+
+# How often, in seconds, each worker checks whether it has been asked to stop. The stop event is shared with
+# the parent process and can't wake up a worker's select() loop the way request_terminate does for CRCServer.
+STOP_CHECK_INTERVAL = 0.1
+
+##############################################################################################################
+
+class WorkerLinkData(ServerConnectionData):
+    """ WorkerLinkData encapsulates data associated with the local IPC link between two worker processes of the
+    same sharded server. Worker links carry ordinary CRC messages, but they are never stored in hosts_db or in
+    self.adjacent_server_ids since the workers of a sharded server appear to the rest of the network as a
+    single server.
+    """
+    __slots__ = ("worker_index",)
+
+    def __init__(self, link_id, server_name, worker_index):
+        super(WorkerLinkData, self).__init__(link_id, "%s/worker%i" % (server_name, worker_index), "")
+        self.first_link_id = link_id
+        self.worker_index = worker_index
+
+##############################################################################################################
+
+class CRCWorkerServer(CRCServer):
+    """ CRCWorkerServer is a single worker process of a ShardedCRCServer. Every worker listens on the same port
+    using SO_REUSEPORT, so the operating system spreads new connections across the workers and each worker
+    owns a subset of the adjacent clients and servers.
+
+    Each worker is connected to every other worker by a local socket pair. Any message a worker would
+    broadcast to its adjacent servers is also sent over these links, which keeps the hosts_db of every worker
+    in sync. A host owned by another worker is routed through the link to that worker, so chat messages
+    between clients on different workers are routed over the link just like they would be routed to an
+    adjacent server. Messages received from another worker are never sent on to a third worker because the
+    worker they came from has already sent them to every other worker.
+    """
+    def __init__(self, options, worker_index, worker_sockets, stop_event, run_on_localhost=False):
+        self.stop_event = stop_event
+        self.worker_index = worker_index
+        super(CRCWorkerServer, self).__init__(options, run_on_localhost)
+        self.worker_sockets = worker_sockets            # Maps the index of each other worker to its socket
+        self.worker_links = {}                          # Maps worker link IDs to their WorkerLinkData
+        self.handling_worker_message = False            # True while handling a message from another worker
+        if self.stats_port:
+            self.stats_port += worker_index             # Each worker serves its own metrics on its own port
+        if worker_index != 0:
+            self.snapshot_file = None                   # Only the worker connected upstream can resync
+
+    # The testing application sets request_terminate on the ShardedCRCServer in the parent process, so every
+    # worker checks a shared event instead of its own flag.
+    @property
+    def request_terminate(self):
+        return self.stop_event.is_set()
+
+    @request_terminate.setter
+    def request_terminate(self, value):
+        if value:
+            self.stop_event.set()
+
+    def run(self):
+        self.connect_to_workers()
+        super(CRCWorkerServer, self).run()
+
+    def start_timers(self):
+        super(CRCWorkerServer, self).start_timers()
+        self.schedule_timer(STOP_CHECK_INTERVAL, self.check_stop_event)
+
+    def check_stop_event(self):
+        # Waking up is all that is needed, since the select() loop checks request_terminate every time it does
+        self.schedule_timer(STOP_CHECK_INTERVAL, self.check_stop_event)
+
+    def setup_server_socket(self):
+        """ Sets up this worker's listening socket. SO_REUSEPORT allows every worker to bind the same port. """
+        self.print_info("Configuring the server socket...")
+
+        server_socket = socket(AF_INET, SOCK_STREAM)
+        server_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        server_socket.bind(('', self.port))
+        server_socket.listen(100)
+        server_socket.setblocking(False)
+        self.sel.register(server_socket, selectors.EVENT_READ, None)
+
+        self.print_info(f"Server socket configured and listening on port {self.port}")
+
+    def connect_to_server(self):
+        """ Only the first worker registers with the remote server. Everything the remote server tells us about
+        the network is then shared with the other workers over the worker links.
+        """
+        if self.worker_index == 0:
+            super(CRCWorkerServer, self).connect_to_server()
+
+    def connect_to_workers(self):
+        """ Registers the socket connected to each of the other workers with the selector. """
+        for worker_index, worker_socket in self.worker_sockets.items():
+            worker_socket.setblocking(False)
+            link = WorkerLinkData(WORKER_LINK_ID_BASE + worker_index, self.server_name, worker_index)
+            link.sock = worker_socket
+            self.worker_links[link.id] = link
+            self.set_route(link.id, link)
+            self.sel.register(worker_socket, self.io_device_events(link), link)
+
+    def handle_message(self, io_device, message):
+        """ Messages received from another worker are forwarded with this server's ID as their last hop, which
+        would make the host look adjacent to this worker. Replace the last hop with the ID of the worker link
+        the message arrived on so that the host is routed through that worker instead.
+        """
+        self.handling_worker_message = isinstance(io_device.data, WorkerLinkData)
+        if self.handling_worker_message and hasattr(message, "last_hop_id"):
+            message.last_hop_id = io_device.data.id
+        try:
+            super(CRCWorkerServer, self).handle_message(io_device, message)
+        finally:
+            self.handling_worker_message = False
+
+    def handle_connection_closed(self, connection_data):
+        """ The link to another worker only closes when that worker has exited. Every host that was connected
+        to it is then removed from the network, just as if the link to an adjacent server had closed.
+        """
+        super(CRCWorkerServer, self).handle_connection_closed(connection_data)
+        if isinstance(connection_data, WorkerLinkData) and self.worker_links.pop(connection_data.id, None):
+            self.remove_route(connection_data.id)
+            self.evict_hosts(self.routed_hosts.pop(connection_data, set()))
+
+    def broadcast_message_to_servers(self, message, ignore_host_id=None):
+        super(CRCWorkerServer, self).broadcast_message_to_servers(message, ignore_host_id)
+        if not self.handling_worker_message:
+            for link in self.worker_links.values():
+                self.queue_message(link, message)
+
+    def init_logging(self):
+        self.logger = CRCLog("%s (worker %i)" % (self.server_name, self.worker_index), self.log_file and
+                             "%s.worker%i" % (self.log_file, self.worker_index), self.log_level, self.log_queue)
+
+
+def run_worker(options, worker_index, worker_sockets, stop_event, run_on_localhost):
+    """ The entry point of each worker process. Every worker inherits both ends of every worker link when it
+    is forked, so it first closes the sockets that belong to the other workers. Otherwise the other end of
+    each of its own links would stay open in its own process, and a worker would never see the link to a
+    worker that has exited close, and so never remove the hosts that were connected to it.
+
+    Args:
+        worker_sockets (list): maps the index of each worker to the sockets leading from it to every other
+            worker
+    """
+    for index, sockets in enumerate(worker_sockets):
+        if index != worker_index:
+            for worker_socket in sockets.values():
+                worker_socket.close()
+    CRCWorkerServer(options, worker_index, worker_sockets[worker_index], stop_event, run_on_localhost).run()
+
+##############################################################################################################
+
+class ShardedCRCServer(object):
+    """ ShardedCRCServer runs a single logical CRC server as several worker processes so that it is not limited
+    to one core by the GIL. The number of workers is taken from options.workers and defaults to the number of
+    cores. See CRCWorkerServer for how the workers share the listening port and the state of the network.
+
+    Workers are started with the fork start method so that the local socket pairs connecting them are
+    inherited by each worker process.
+    """
+    def __init__(self, options, run_on_localhost=False):
+        if getattr(options, "routing", None) == "link_state":
+            raise ValueError("Link-state routing is not supported by the sharded server")
+        self.options = options
+        self.run_on_localhost = run_on_localhost
+        self.server_name = options.servername
+        self.worker_count = getattr(options, "workers", None) or os.cpu_count() or 1
+        self.context = multiprocessing.get_context("fork")
+        self.stop_event = self.context.Event()
+        self.workers = []
+
+    @property
+    def request_terminate(self):
+        return self.stop_event.is_set()
+
+    @request_terminate.setter
+    def request_terminate(self, value):
+        if value:
+            self.stop_event.set()
+
+    def run(self):
+        """ Starts every worker process and waits for them to finish. """
+        # Create a local socket pair between every two workers. Worker i keeps the sockets leading to every
+        # other worker and closes the rest once it has started (see run_worker()).
+        worker_sockets = [{} for i in range(self.worker_count)]
+        for i in range(self.worker_count):
+            for j in range(i + 1, self.worker_count):
+                worker_sockets[i][j], worker_sockets[j][i] = socketpair(AF_UNIX, SOCK_STREAM)
+
+        for worker_index in range(self.worker_count):
+            worker = self.context.Process(target=run_worker,
+                                          args=(self.options, worker_index, worker_sockets, self.stop_event,
+                                                self.run_on_localhost),
+                                          daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        # The parent process does not use any of the worker links itself
+        for sockets in worker_sockets:
+            for worker_socket in sockets.values():
+                worker_socket.close()
+
+        for worker in self.workers:
+            worker.join()
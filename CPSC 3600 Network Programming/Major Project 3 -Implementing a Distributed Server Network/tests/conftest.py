@@ -0,0 +1,96 @@
+import os
+import socket
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+# The project's modules import each other by name, so the tests import them the same way
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ChatServer import CRCServer
+from ChatClient import CRCClient
+
+
+def free_port():
+    """ Returns a TCP port that nothing is listening on """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_options(server_id, port, connect_to_port=None, **options):
+    return types.SimpleNamespace(id=server_id, servername="Server%i" % server_id, info="", port=port,
+                                 connect_to_host="127.0.0.1" if connect_to_port else None,
+                                 connect_to_port=connect_to_port, log_file=None, log_level="off", **options)
+
+
+def client_options(client_id, port):
+    return types.SimpleNamespace(id=client_id, username="Client%i" % client_id, info="", serverhost="127.0.0.1",
+                                 serverport=port, log_file=None, log_level="off")
+
+
+def wait_for(condition, timeout=5.0):
+    """ Polls condition() until it returns True or timeout seconds have passed. Returns its last result. """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return condition()
+        time.sleep(0.02)
+    return True
+
+
+class LocalClient(CRCClient):
+    """ A CRCClient that treats a reset connection like a closed one, since a test may kill its server """
+    def listen_for_server_input(self):
+        try:
+            super(LocalClient, self).listen_for_server_input()
+        except OSError:
+            self.request_terminate = True
+
+
+class Network():
+    """ Starts servers and clients on the local machine and stops all of them when the test ends """
+    def __init__(self):
+        self.servers = []
+        self.clients = []
+
+    def start_server(self, server, wait_for_port=None):
+        self.servers.append(server)
+        threading.Thread(target=server.run, daemon=True).start()
+        if wait_for_port is not None:
+            assert wait_for(lambda: port_is_open(wait_for_port))
+        return server
+
+    def start_client(self, client_id, port):
+        client = LocalClient(client_options(client_id, port), run_on_localhost=True)
+        self.clients.append(client)
+        client.run()
+        return client
+
+    def stop_client(self, client):
+        client.request_terminate = True
+        try:
+            client.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def stop(self):
+        for client in self.clients:
+            self.stop_client(client)
+        for server in self.servers:
+            server.request_terminate = True
+
+
+def port_is_open(port):
+    with socket.socket() as sock:
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+
+@pytest.fixture
+def network():
+    network = Network()
+    yield network
+    network.stop()
@@ -0,0 +1,34 @@
+import pytest
+
+from conftest import free_port, server_options, wait_for
+from ChatServer import CRCServer
+
+
+@pytest.mark.parametrize("routing", ["tree", "link_state"])
+def test_publish_after_reconnecting(network, routing):
+    first_port, second_port = free_port(), free_port()
+    options = dict(routing=routing, link_probe_interval=0.1)
+    first = network.start_server(CRCServer(server_options(1, first_port, **options), run_on_localhost=True),
+                                 wait_for_port=first_port)
+    second = network.start_server(CRCServer(server_options(2, second_port, first_port, **options),
+                                            run_on_localhost=True), wait_for_port=second_port)
+    if routing == "link_state":
+        assert wait_for(lambda: first.link_state.tree_neighbours and second.link_state.tree_neighbours)
+
+    member = network.start_client(10, first_port)
+    member.join_channel("room")
+    assert wait_for(lambda: "room" in second.channels)
+
+    publisher = network.start_client(20, second_port)
+    publisher.publish_to_channel("room", "before")
+    assert wait_for(lambda: ("room", "before") in member.channel_messages_log)
+    publisher.quit()
+    network.stop_client(publisher)
+    assert wait_for(lambda: 20 not in first.hosts_db and 20 not in second.hosts_db)
+
+    # The new connection numbers its messages from 1 again
+    publisher = network.start_client(20, second_port)
+    assert wait_for(lambda: 20 in first.hosts_db)
+    publisher.publish_to_channel("room", "after")
+    assert wait_for(lambda: ("room", "after") in member.channel_messages_log)
+    assert member.channel_messages_log == [("room", "before"), ("room", "after")]
@@ -0,0 +1,115 @@
+from ChatServer import SendQueue, TokenBucket
+
+
+def test_token_bucket_allows_a_burst_then_refills_at_its_rate():
+    bucket = TokenBucket(10, 5)
+    now = bucket.updated
+    assert all(bucket.take(now) for i in range(5))
+    assert not bucket.take(now)
+    assert not bucket.take(now + 0.05)          # Half a token
+    assert bucket.take(now + 0.1)
+    assert not bucket.take(now + 0.1)
+
+
+def test_token_bucket_never_holds_more_than_its_burst():
+    bucket = TokenBucket(10, 3)
+    now = bucket.updated + 60
+    assert all(bucket.take(now) for i in range(3))
+    assert not bucket.take(now)
+
+
+def test_token_bucket_burst_defaults_to_one_second_of_tokens():
+    assert TokenBucket(20).burst == 20
+    assert TokenBucket(0.5).burst == 1
+
+
+def test_token_bucket_refund():
+    bucket = TokenBucket(1, 2)
+    now = bucket.updated
+    assert bucket.take(now) and bucket.take(now)
+    bucket.refund()
+    assert bucket.take(now)
+    assert not bucket.take(now)
+
+    bucket = TokenBucket(1, 2)
+    bucket.refund()
+    assert bucket.tokens == 2
+
+
+class PartialSocket():
+    """ A socket that accepts at most limit bytes per call and records everything it was sent """
+    def __init__(self, limit):
+        self.limit = limit
+        self.sent = bytearray()
+        self.calls = []
+
+    def sendmsg(self, buffers):
+        self.calls.append(len(buffers))
+        data = b''.join(bytes(buffer) for buffer in buffers)[:self.limit]
+        self.sent += data
+        return len(data)
+
+
+class SendOnlySocket():
+    """ A socket without sendmsg(), as on platforms that don't have it """
+    def __init__(self, limit):
+        self.limit = limit
+        self.sent = bytearray()
+
+    def send(self, data):
+        data = bytes(data)[:self.limit]
+        self.sent += data
+        return len(data)
+
+
+def test_send_queue_resumes_part_way_through_a_message():
+    queue = SendQueue()
+    for message in (b"abc", b"defg", b"hi"):
+        queue.append(message)
+    assert len(queue) == 9
+
+    sock = PartialSocket(5)
+    assert queue.send(sock) == 5
+    assert sock.calls == [3]                    # Every queued message is handed over in one call
+    assert len(queue) == 4 and queue.offset == 2 and list(queue.messages) == [b"defg", b"hi"]
+
+    assert queue.send(sock) == 4
+    assert sock.sent == b"abcdefghi"
+    assert len(queue) == 0 and queue.offset == 0 and not queue.messages
+    assert queue.send(sock) == 0
+
+
+def test_send_queue_consumes_whole_messages_exactly():
+    queue = SendQueue()
+    for message in (b"ab", b"cd", b"ef"):
+        queue.append(message)
+    assert queue.send(PartialSocket(4)) == 4
+    assert queue.offset == 0 and list(queue.messages) == [b"ef"]
+
+
+def test_send_queue_without_sendmsg_sends_one_message_at_a_time():
+    queue = SendQueue()
+    queue.append(b"abc")
+    queue.append(b"def")
+    sock = SendOnlySocket(2)
+    sent = [queue.send(sock) for i in range(4)]
+    assert sent == [2, 1, 2, 1] and sock.sent == b"abcdef" and len(queue) == 0
+
+
+def test_send_queue_ignores_empty_messages_and_extends_from_a_partly_sent_queue():
+    first = SendQueue()
+    first.append(b"")
+    assert len(first) == 0 and not first.messages
+    first.append(b"abcd")
+    first.append(b"ef")
+    first.send(PartialSocket(1))
+
+    second = SendQueue()
+    second.append(b"xy")
+    second.extend(first)
+    assert len(first) == 0 and not first.messages and first.offset == 0
+    assert len(second) == 7
+
+    sock = PartialSocket(100)
+    second.send(sock)
+    assert sock.sent == b"xybcdef"
@@ -0,0 +1,109 @@
+import pytest
+
+import LinkStateRouting
+from LinkStateRouting import LinkStateDatabase, SeenMessageCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ Replaces time.monotonic() with a clock that only moves when the test sets clock.now """
+    class Clock():
+        now = 100.0
+    clock = Clock()
+    monkeypatch.setattr(LinkStateRouting.time, "monotonic", lambda: clock.now)
+    return clock
+
+
+def test_seen_message_cache_drops_repeats(clock):
+    cache = SeenMessageCache(max_entries=10, ttl=5)
+    assert cache.accept(1, 1)
+    assert cache.accept(1, 2)
+    assert cache.accept(2, 1)
+    assert not cache.accept(1, 1)
+    assert not cache.accept(2, 1)
+    assert cache.suppressed == 2 and len(cache) == 3
+
+
+def test_seen_message_cache_forgets_entries_after_their_ttl(clock):
+    cache = SeenMessageCache(max_entries=10, ttl=5)
+    cache.accept(1, 1)
+    clock.now += 2
+    cache.accept(1, 2)
+    clock.now += 2.9
+    assert not cache.accept(1, 1)
+    clock.now += 0.1
+    assert cache.accept(1, 1)                   # Remembered again from now on
+    assert not cache.accept(1, 2)
+    clock.now += 10
+    assert cache.accept(1, 3)
+    assert len(cache) == 1                      # Every expired entry was dropped
+
+
+def test_seen_message_cache_evicts_the_oldest_entry_when_full(clock):
+    cache = SeenMessageCache(max_entries=3, ttl=60)
+    for sequence in range(1, 5):
+        assert cache.accept(7, sequence)
+        clock.now += 1
+    assert len(cache) == 3
+    assert cache.accept(7, 1)                   # Evicted to make room for sequence 4
+    assert not cache.accept(7, 3)
+    assert not cache.accept(7, 4)
+    assert len(cache) == 3
+
+
+def make_database(links, order=None):
+    """ Builds a LinkStateDatabase in which every server advertises its end of each of the given links """
+    advertised = {}
+    for (first_id, second_id), cost in links.items():
+        advertised.setdefault(first_id, {})[second_id] = cost
+        advertised.setdefault(second_id, {})[first_id] = cost
+    database = LinkStateDatabase()
+    for server_id in order or sorted(advertised):
+        database.update(server_id, 1, advertised[server_id])
+    return database
+
+
+def test_equal_cost_paths_are_broken_by_the_lowest_server_id():
+    square = {(1, 2): 1, (1, 3): 1, (2, 4): 1, (3, 4): 1}
+    for order in ([1, 2, 3, 4], [4, 3, 2, 1], [3, 1, 4, 2]):
+        database = make_database(square, order)
+        reached, parents = database.shortest_path_tree(1)
+        assert reached == [1, 2, 3, 4]
+        assert parents == {1: None, 2: 1, 3: 1, 4: 2}
+        assert database.next_hops(1) == {2: 2, 3: 3, 4: 2}
+        assert database.next_hops(4) == {2: 2, 3: 3, 1: 2}
+
+
+def test_shortest_paths_follow_the_link_costs():
+    database = make_database({(1, 2): 1, (2, 3): 1, (1, 3): 5, (3, 4): 1})
+    assert database.next_hops(1) == {2: 2, 3: 2, 4: 2}
+    assert database.next_hops(3) == {2: 2, 1: 2, 4: 4}
+
+
+def test_links_advertised_by_only_one_end_are_not_used():
+    database = make_database({(1, 2): 1})
+    database.update(1, 2, {2: 1, 3: 1})
+    database.update(3, 1, {})
+    assert database.next_hops(1) == {2: 2}
+
+
+def test_routes_change_when_a_link_is_withdrawn():
+    database = make_database({(1, 2): 1, (2, 4): 1, (1, 3): 5, (3, 4): 5})
+    assert database.next_hops(1)[4] == 2
+
+    assert database.update(2, 2, {1: 1})        # Server 2 loses its link to server 4
+    assert database.next_hops(1)[4] == 3
+    assert database.next_hops(4) == {3: 3, 1: 3, 2: 3}
+
+    assert not database.update(2, 1, {1: 1, 4: 1})  # An older advertisement is ignored
+    assert database.next_hops(1)[4] == 3
+
+    assert database.update(2, 3, {1: 1})
+    assert database.update(3, 2, {1: 5})        # Server 4 can no longer be reached at all
+    assert 4 not in database.next_hops(1)
+
+
+def test_every_server_computes_the_same_broadcast_tree():
+    database = make_database({(1, 2): 1, (1, 3): 1, (2, 4): 1, (3, 4): 1, (4, 5): 1})
+    neighbours = {server_id: database.tree_neighbours(server_id) for server_id in range(1, 6)}
+    assert neighbours == {1: {2, 3}, 2: {1, 4}, 3: {1}, 4: {2, 5}, 5: {4}}
@@ -0,0 +1,148 @@
+import pytest
+
+from ChatMessageParser import *
+
+
+def registrations():
+    return (ServerRegistrationMessage.bytes(2, 1, "Server2", "info") +
+            ClientRegistrationMessage.bytes(10, 2, "Client10", "") +
+            ClientRegistrationMessage.bytes(11, 3, "Client11", "info11"))
+
+
+# Each new message type, encoded with its bytes() method, and the fields it should decode to
+ROUND_TRIPS = [
+    (ServerQuitMessage.bytes(5, 6, "Shutting down"),
+     ServerQuitMessage, dict(source_id=5, replacement_id=6, content="Shutting down")),
+    (DirectorySnapshotMessage.bytes(1, 2, registrations()),
+     DirectorySnapshotMessage, dict(source_id=1, last_hop_id=2, flags=0, hosts=[
+         (0x00, 2, "Server2", "info", 1), (0x80, 10, "Client10", "", 2), (0x80, 11, "Client11", "info11", 3)])),
+    (DirectorySnapshotMessage.bytes(1, 2, registrations(), compress=True),
+     DirectorySnapshotMessage, dict(flags=DirectorySnapshotMessage.COMPRESSED, hosts=[
+         (0x00, 2, "Server2", "info", 1), (0x80, 10, "Client10", "", 2), (0x80, 11, "Client11", "info11", 3)])),
+    (DirectorySnapshotMessage.bytes(1, 0, b""),
+     DirectorySnapshotMessage, dict(hosts=[])),
+    (DirectoryVersionMessage.bytes(3, 0xDEADBEEF, 2 ** 40 + 5, DirectoryVersionMessage.DELTA, [7, 8, 9]),
+     DirectoryVersionMessage, dict(source_id=3, epoch=0xDEADBEEF, version=2 ** 40 + 5,
+                                   flags=DirectoryVersionMessage.DELTA, removed_ids=(7, 8, 9))),
+    (DirectoryVersionMessage.bytes(3, 1, 0),
+     DirectoryVersionMessage, dict(flags=0, removed_ids=())),
+    (LinkStateAdvertisementMessage.bytes(4, 2 ** 50, {1: 100, 2: 250}),
+     LinkStateAdvertisementMessage, dict(source_id=4, sequence=2 ** 50, links={1: 100, 2: 250})),
+    (LinkStateAdvertisementMessage.bytes(4, 1, {}),
+     LinkStateAdvertisementMessage, dict(links={})),
+    (LinkProbeMessage.bytes(4, LinkProbeMessage.REPLY, 123456789),
+     LinkProbeMessage, dict(source_id=4, flags=LinkProbeMessage.REPLY, timestamp=123456789)),
+    (FloodMessage.bytes(4, 2 ** 60, ClientQuitMessage.bytes(10, "bye")),
+     FloodMessage, dict(source_id=4, sequence=2 ** 60, payload=ClientQuitMessage.bytes(10, "bye"))),
+    (LinkOptionsMessage.bytes(4, LinkOptionsMessage.COMPRESSION | LinkOptionsMessage.REPLY),
+     LinkOptionsMessage, dict(source_id=4, flags=LinkOptionsMessage.COMPRESSION | LinkOptionsMessage.REPLY)),
+    (CompressedMessage.bytes(4, b"\x00\x01\x02"),
+     CompressedMessage, dict(source_id=4, payload=b"\x00\x01\x02")),
+    (HeartbeatMessage.bytes(4, HeartbeatMessage.REPLY),
+     HeartbeatMessage, dict(source_id=4, flags=HeartbeatMessage.REPLY)),
+    (HostsQuitMessage.bytes(4, [10, 11, 2 ** 32 - 1]),
+     HostsQuitMessage, dict(source_id=4, host_ids=(10, 11, 2 ** 32 - 1))),
+    (ChannelJoinMessage.bytes(10, "général"),
+     ChannelJoinMessage, dict(message_type=0x83, source_id=10, channel="général")),
+    (ChannelLeaveMessage.bytes(10, "room"),
+     ChannelLeaveMessage, dict(message_type=0x84, source_id=10, channel="room")),
+    (ChannelPublishMessage.bytes(10, 42, "room", "hello, room"),
+     ChannelPublishMessage, dict(source_id=10, sequence=42, channel="room", content="hello, room")),
+    (ChannelPublishMessage.bytes(10, 0, "", ""),
+     ChannelPublishMessage, dict(channel="", content="")),
+]
+
+
+@pytest.mark.parametrize("data, message_class, fields", ROUND_TRIPS)
+def test_round_trip(data, message_class, fields):
+    assert MessageParser.message_length(data) == len(data)
+    messages = MessageParser.parse_messages(data)
+    assert len(messages) == 1
+    message = messages[0]
+    assert type(message) is message_class
+    assert message.message_type == data[0]
+    assert message.variable_message_length == len(data)
+    assert bytes(message.bytes) == data
+    for name, value in fields.items():
+        assert getattr(message, name) == value, name
+
+
+def test_every_message_type_has_a_header():
+    assert {data[0] for data, message_class, fields in ROUND_TRIPS} | {0x00, 0x01, 0x80, 0x81, 0x82} == set(
+        MESSAGE_HEADERS)
+
+
+def stream():
+    """ A few messages of different types back to back, as they would arrive on a socket """
+    return (ServerRegistrationMessage.bytes(2, 1, "Server2", "info") +
+            ServerQuitMessage.bytes(2, 0, "going") +
+            StatusUpdateMessage.bytes(1, 10, 0x00, "Welcome") +
+            ClientChatMessage.bytes(10, 11, "hi") +
+            ChannelPublishMessage.bytes(10, 1, "room", "x" * 300) +
+            ClientQuitMessage.bytes(10, ""))
+
+
+def test_messages_back_to_back_are_all_parsed():
+    messages = MessageParser.parse_messages(stream())
+    assert [message.message_type for message in messages] == [0x00, 0x02, 0x01, 0x81, 0x85, 0x82]
+    assert messages[1].content == "going"
+    assert messages[3].content == "hi"
+
+
+@pytest.mark.parametrize("read_size", [1, 2, 5, 13, 64, 1000])
+def test_messages_split_across_reads_are_reassembled(read_size):
+    data = stream()
+    buffer = bytearray()
+    complete = b""
+    for start in range(0, len(data), read_size):
+        buffer += data[start:start + read_size]
+        received = MessageParser.split_complete_messages(buffer)
+        assert len(received) + len(buffer) == len(data[len(complete):start + read_size])
+        complete += received
+        # Only whole messages are ever returned
+        assert complete == data[:len(complete)]
+        if received:
+            MessageParser.parse_messages(received)
+    assert complete == data and not buffer
+
+
+def test_a_message_ending_exactly_at_the_end_of_the_buffer():
+    message = ClientChatMessage.bytes(10, 11, "hello")
+    buffer = bytearray(message)
+    assert MessageParser.has_complete_message(buffer)
+    assert MessageParser.split_complete_messages(buffer) == message
+    assert buffer == b"" and not MessageParser.has_complete_message(buffer)
+
+
+def test_a_partial_message_is_left_in_the_buffer():
+    first = ClientChatMessage.bytes(10, 11, "hello")
+    second = ClientChatMessage.bytes(11, 10, "hello yourself")
+    for cut in (1, 12, 13, len(second) - 1):      # Inside the header, at its end, and inside the content
+        buffer = bytearray(first + second[:cut])
+        assert MessageParser.split_complete_messages(buffer) == first
+        assert buffer == second[:cut]
+        assert not MessageParser.has_complete_message(buffer)
+        buffer += second[cut:]
+        assert MessageParser.split_complete_messages(buffer) == second and not buffer
+
+
+def test_the_length_of_a_message_is_unknown_until_its_header_has_arrived():
+    message = ChannelPublishMessage.bytes(10, 1, "room", "hello")
+    for cut in range(1, 14):
+        assert MessageParser.message_length(message[:cut]) is None
+    assert MessageParser.message_length(message[:14]) == len(message)
+    assert MessageParser.message_length(b"\x00" + message, 1) == len(message)
+
+
+def test_split_complete_messages_stops_after_max_messages():
+    data = stream()
+    buffer = bytearray(data)
+    first_two = MessageParser.split_complete_messages(buffer, max_messages=2)
+    assert [message.message_type for message in MessageParser.parse_messages(first_two)] == [0x00, 0x02]
+    assert first_two + buffer == data
+    assert MessageParser.has_complete_message(buffer)
+
+
+def test_an_unknown_message_type_is_rejected():
+    with pytest.raises(Exception):
+        MessageParser.split_complete_messages(bytearray(b"\x7f\x00\x00\x00\x01"))
@@ -0,0 +1,26 @@
+import os
+import signal
+import time
+
+from conftest import free_port, server_options, wait_for
+from ShardedChatServer import ShardedCRCServer
+
+
+def test_clients_of_a_killed_worker_are_evicted(network):
+    port = free_port()
+    sharded = ShardedCRCServer(server_options(1, port, workers=2), run_on_localhost=True)
+    network.start_server(sharded, wait_for_port=port)
+
+    client_ids = list(range(10, 26))
+    clients = [network.start_client(client_id, port) for client_id in client_ids]
+    assert wait_for(lambda: all(len(client.connected_user_ids) == len(client_ids) - 1 for client in clients))
+
+    os.kill(sharded.workers[1].pid, signal.SIGKILL)
+    assert wait_for(lambda: any(client.request_terminate for client in clients))
+    time.sleep(0.5)                             # Every client of the killed worker sees its connection close
+    lost_ids = {client.id for client in clients if client.request_terminate}
+    survivors = [client for client in clients if not client.request_terminate]
+    assert survivors, "every client was accepted by the same worker"
+
+    assert wait_for(lambda: all(not lost_ids & set(client.connected_user_ids) for client in survivors))
+    assert all(len(client.connected_user_ids) == len(survivors) - 1 for client in survivors)
@@ -0,0 +1,93 @@
+import pytest
+
+import CRCTimers
+from CRCTimers import TimerWheel, WHEEL_SLOTS
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ Replaces time.monotonic() with a clock that only moves when the test sets clock.now """
+    class Clock():
+        now = 0.0
+    clock = Clock()
+    monkeypatch.setattr(CRCTimers.time, "monotonic", lambda: clock.now)
+    return clock
+
+
+def test_timers_run_in_the_order_they_are_due(clock):
+    wheel = TimerWheel(tick_length=1.0)
+    fired = []
+    for delay in (30, 5, 5000, 70, 5, 1):
+        wheel.schedule(delay, fired.append, delay)
+    assert len(wheel) == 6
+    assert wheel.run(10000) == 6
+    assert fired == [1, 5, 5, 30, 70, 5000]
+    assert len(wheel) == 0
+
+
+@pytest.mark.parametrize("delay, level", [(WHEEL_SLOTS - 1, 0), (WHEEL_SLOTS, 1), (100, 1),
+                                          (WHEEL_SLOTS ** 2 + 7, 2), (WHEEL_SLOTS ** 3 + 300, 3)])
+def test_timers_cascade_down_the_levels_and_run_on_their_tick(clock, delay, level):
+    wheel = TimerWheel(tick_length=1.0)
+    fired = []
+    wheel.schedule(delay, fired.append, delay)
+    assert sum(len(slot) for slot in wheel.levels[level]) == 1
+
+    assert wheel.run(delay - 1) == 0
+    assert fired == []
+    assert wheel.run(delay) == 1
+    assert fired == [delay]
+
+
+def test_timers_scheduled_at_different_times_keep_their_order(clock):
+    wheel = TimerWheel(tick_length=1.0)
+    fired = []
+    wheel.schedule(200, fired.append, "first")
+    for now in range(1, 150):
+        clock.now = now
+        wheel.run()
+    wheel.schedule(20, fired.append, "second")      # Due at 169, on level 0 while "first" is still above it
+    wheel.schedule(60, fired.append, "third")       # Due at 209
+    clock.now = 300
+    wheel.run()
+    assert fired == ["second", "first", "third"]
+
+
+def test_cancelled_timers_never_run(clock):
+    wheel = TimerWheel(tick_length=1.0)
+    fired = []
+    timer = wheel.schedule(100, fired.append, "cancelled")
+    wheel.schedule(150, fired.append, "kept")
+    timer.cancel()
+    timer.cancel()
+    assert len(wheel) == 1
+    assert wheel.run(1000) == 1
+    assert fired == ["kept"]
+    assert wheel.cancelled == 0
+
+
+def test_a_timer_scheduled_by_a_callback_runs_in_the_same_call_when_due(clock):
+    wheel = TimerWheel(tick_length=1.0)
+    fired = []
+    wheel.schedule(5, lambda: wheel.schedule(0, fired.append, "again"))
+    assert wheel.run(5) == 2
+    assert fired == ["again"]
+
+
+def test_time_until_next(clock):
+    clock.now = 1.0
+    wheel = TimerWheel(tick_length=1.0)
+    assert wheel.time_until_next() is None
+    wheel.schedule(10, lambda: None)
+    assert wheel.time_until_next() == 10
+    wheel.schedule(3, lambda: None)
+    assert wheel.time_until_next() == 3
+    clock.now = 3.5
+    assert wheel.time_until_next() == 0.5
+
+
+def test_time_until_next_wakes_up_to_move_timers_down_a_level(clock):
+    clock.now = 1.0
+    wheel = TimerWheel(tick_length=1.0)
+    wheel.schedule(100, lambda: None)
+    assert wheel.time_until_next() == WHEEL_SLOTS - 1